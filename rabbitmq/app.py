@@ -3,6 +3,13 @@ import mysql.connector
 import pandas as pd
 import os
 from dotenv import load_dotenv
+from bulk_writer import quote_identifier
+from change_capture import TRACKING_COLUMNS, VERSIONS_TABLE, is_internal_table
+from connections import MySQLPool, Publisher
+from poll_scheduler import load_schedule, request_poll
+from row_identity import ROW_ID_COLUMN
+from table_edits import apply_edits, grid_edits
+from table_views import APP_PAGE_SIZE, FILTER_OPERATORS, page_cursor, page_query
 
 # Load environment variables
 load_dotenv()
@@ -15,60 +22,144 @@ mysql_config = {
     'database': 'superjoin'
 }
 
-def get_tables():
-    try:
-        conn = mysql.connector.connect(**mysql_config)
+# Edits are published to the sync queue as they are written, so they reach the
+# sheet without waiting for the producer's next scan
+rabbitmq_host = os.getenv('RABBITMQ_HOST', 'localhost')
+rabbitmq_queue = 'conflict_queue'
+APP_WRITE_THROUGH = os.getenv('APP_WRITE_THROUGH', 'true').lower() in ('1', 'true', 'yes')
+
+APP_POOL_SIZE = int(os.getenv('APP_POOL_SIZE', '4'))
+
+# Cached pages and table lists expire after this long even if nothing in the
+# app wrote to the table (edits from the sheet or other users)
+APP_CACHE_TTL_SECONDS = int(os.getenv('APP_CACHE_TTL_SECONDS', '60'))
+
+# row_version/updated_at are maintained by triggers and _row_id by the sync,
+# so none of them are shown or edited by hand
+HIDDEN_COLUMNS = TRACKING_COLUMNS + (ROW_ID_COLUMN,)
+
+# One pool for the whole Streamlit server, shared by every session and rerun
+@st.cache_resource
+def get_pool():
+    return MySQLPool(mysql_config, pool_size=APP_POOL_SIZE, pool_name='app_pool')
+
+# One RabbitMQ connection for the whole server; publishes are serialized by its lock
+@st.cache_resource
+def get_publisher():
+    return Publisher(rabbitmq_host, rabbitmq_queue)
+
+def run_query(sql, params=()):
+    with get_pool().connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SHOW TABLES")
-        tables = [table[0] for table in cursor.fetchall()]
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
         cursor.close()
-        conn.close()
-        return tables
-    except Exception as e:
-        st.error(f"Error: {e}")
-        return []
+    return rows
 
-def get_table_data(table_name):
+@st.cache_data(ttl=APP_CACHE_TTL_SECONDS)
+def get_tables():
+    return [table[0] for table in run_query("SHOW TABLES") if not is_internal_table(table[0])]
+
+# Visible columns and the primary key column (the first column if there is none)
+@st.cache_data(ttl=APP_CACHE_TTL_SECONDS)
+def get_table_layout(table_name):
+    columns = [row[0] for row in run_query(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s ORDER BY ordinal_position",
+        (table_name,)
+    )]
+    keys = [row[0] for row in run_query(
+        "SELECT column_name FROM information_schema.key_column_usage "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND constraint_name = 'PRIMARY' ORDER BY ordinal_position",
+        (table_name,)
+    )]
+    visible = [column for column in columns if column not in HIDDEN_COLUMNS]
+    return visible, keys[0] if keys else visible[0]
+
+# The table's change counter, bumped by triggers on every write from anywhere.
+# Cached pages are keyed on it, so a page is re-read as soon as the table
+# changes and served from the cache otherwise.
+def table_version(table_name):
     try:
-        conn = mysql.connector.connect(**mysql_config)
-        query = f"SELECT * FROM `{table_name}`"
-        df = pd.read_sql(query, conn)
-        conn.close()
-        return df
-    except Exception as e:
-        st.error(f"Error: {e}")
-        return pd.DataFrame()
+        rows = run_query(f"SELECT version FROM {VERSIONS_TABLE} WHERE table_name = %s", (table_name,))
+    except mysql.connector.Error:
+        return None  # change tracking not set up yet; the TTL still applies
+    return rows[0][0] if rows else None
+
+# One page of rows plus the cursor of the next page (None on the last page)
+@st.cache_data(ttl=APP_CACHE_TTL_SECONDS, max_entries=1000)
+def get_page(table_name, version, columns, key, sort_column, descending, filters, after):
+    sql, params = page_query(table_name, list(columns), key, sort_column, descending, filters, after)
+    rows = run_query(sql, params)
+    next_cursor = page_cursor(rows[APP_PAGE_SIZE - 1], list(columns), key, sort_column) if len(rows) > APP_PAGE_SIZE else None
+    return pd.DataFrame(rows[:APP_PAGE_SIZE], columns=list(columns)), next_cursor
+
+def get_row(table_name, columns, key, key_value):
+    column_list = ', '.join(quote_identifier(col) for col in columns)
+    rows = run_query(
+        f"SELECT {column_list} FROM {quote_identifier(table_name)} WHERE {quote_identifier(key)} = %s", (key_value,)
+    )
+    return dict(zip(columns, rows[0])) if rows else None
+
+# Writes from the app show up on the next rerun instead of after the TTL
+def invalidate_caches():
+    get_page.clear()
+    get_tables.clear()
 
-def insert_row(table_name, values):
+# Ask the producer to poll the table now instead of waiting out its interval.
+# Before the producer's first run there is no schedule table yet, and every
+# table is polled on start anyway.
+def notify_producer(conn, table_name):
     try:
-        conn = mysql.connector.connect(**mysql_config)
         cursor = conn.cursor()
-        placeholders = ', '.join(['%s'] * len(values))
-        sql = f"INSERT INTO `{table_name}` VALUES ({placeholders})"
-        cursor.execute(sql, values)
+        request_poll(cursor, table_name)
         conn.commit()
         cursor.close()
-        conn.close()
+    except mysql.connector.Error:
+        pass
+
+@st.cache_data(ttl=APP_CACHE_TTL_SECONDS)
+def get_poll_schedule():
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            rows = load_schedule(cursor)
+            cursor.close()
+        columns = ['table', 'interval (s)', 'effective (s)', 'heat', 'polls', 'changes', 'next poll in (s)', 'updated at']
+        return pd.DataFrame(rows, columns=columns)
+    except mysql.connector.Error:
+        return pd.DataFrame()
+
+# Publish the change message of a write. Without RabbitMQ (or with write-through
+# off) the producer is asked to poll the table instead, which finds the same rows.
+def publish_change(conn, table_name, message):
+    if APP_WRITE_THROUGH:
+        try:
+            get_publisher().publish(message, table_name)
+            return
+        except Exception as e:
+            st.warning(f"Could not publish the change, it will sync on the next poll: {e}")
+    notify_producer(conn, table_name)
+
+# Write a batch of edits in one transaction and publish one change for all of them
+def save_edits(table_name, key, inserts=(), updates=(), deletes=()):
+    with get_pool().connection() as conn:
+        message = apply_edits(conn, table_name, key, inserts, updates, deletes)
+        if message is not None:
+            publish_change(conn, table_name, message)
+    invalidate_caches()
+    return message is not None
+
+def insert_row(table_name, key, columns, values):
+    try:
+        save_edits(table_name, key, inserts=[dict(zip(columns, values))])
         st.success("Row inserted successfully!")
     except Exception as e:
         st.error(f"Error: {e}")
 
-def update_row(table_name, primary_key, primary_value, values):
+def update_row(table_name, columns, primary_key, primary_value, values):
     try:
-        conn = mysql.connector.connect(**mysql_config)
-        cursor = conn.cursor()
-        columns_query = f"SHOW COLUMNS FROM `{table_name}`"
-        cursor.execute(columns_query)
-        columns = [column[0] for column in cursor.fetchall()]
-
-        update_query = ', '.join([f"{col}=%s" for col in columns])
-        sql = f"UPDATE `{table_name}` SET {update_query} WHERE {primary_key} = %s"
-        
-        # Append primary key value to values for WHERE clause
-        cursor.execute(sql, values + [primary_value])
-        conn.commit()
-        cursor.close()
-        conn.close()
+        save_edits(table_name, primary_key, updates=[(primary_value, dict(zip(columns, values)))])
         st.success("Row updated successfully!")
     except Exception as e:
         st.error(f"Error: {e}")
@@ -76,41 +167,123 @@ def update_row(table_name, primary_key, primary_value, values):
 # Streamlit app layout
 st.title('MySQL Database Editor')
 
-tables = get_tables()
+try:
+    tables = get_tables()
+except Exception as e:
+    st.error(f"Error: {e}")
+    tables = []
+
 if tables:
     selected_table = st.selectbox('Select a table', tables)
 
     if selected_table:
+        try:
+            columns, key = get_table_layout(selected_table)
+        except Exception as e:
+            st.error(f"Error: {e}")
+            st.stop()
+        editable = [col for col in columns if col != key]
+
+        # Sorting and filtering happen in MySQL. Forms only rerun the script
+        # on submit, not on every keystroke.
+        with st.form("view"):
+            sort_col, direction_col = st.columns(2)
+            sort_column = sort_col.selectbox("Sort by", columns, index=columns.index(key))
+            descending = direction_col.radio("Order", ["Ascending", "Descending"], horizontal=True) == "Descending"
+            filter_col, operator_col, value_col = st.columns(3)
+            filter_column = filter_col.selectbox("Filter column", ["(none)"] + columns)
+            operator = operator_col.selectbox("Operator", list(FILTER_OPERATORS))
+            filter_value = value_col.text_input("Value")
+            st.form_submit_button("Apply")
+
+        filters = ()
+        if filter_column != "(none)":
+            filters = ((filter_column, operator, filter_value),)
+
+        # Keyset pagination: the session keeps the start cursor of every page
+        # visited, so "Previous" is a pop and "Next" a push
+        view = (selected_table, sort_column, descending, filters)
+        if st.session_state.get('view') != view:
+            st.session_state.view = view
+            st.session_state.page_starts = [None]
+        page_starts = st.session_state.page_starts
+
+        try:
+            df, next_cursor = get_page(
+                selected_table, table_version(selected_table), tuple(columns), key,
+                sort_column, descending, filters, page_starts[-1]
+            )
+        except Exception as e:
+            st.error(f"Error: {e}")
+            df, next_cursor = pd.DataFrame(columns=columns), None
+
         st.write(f"### Data in table: {selected_table}")
-        df = get_table_data(selected_table)
-        st.dataframe(df)
+        grid_mode = st.toggle("Edit in grid", help="Edit, add and delete rows on this page, then save them together")
+        if grid_mode:
+            # The editor's state is keyed per page; a new key after saving starts it afresh
+            editor_key = f"grid-{selected_table}-{len(page_starts)}-{st.session_state.get('grid_saves', 0)}"
+            st.data_editor(df, key=editor_key, num_rows="dynamic", disabled=[key], hide_index=True)
+            if st.button("Save changes"):
+                inserts, updates, deletes = grid_edits(df[key].tolist(), st.session_state[editor_key], key)
+                try:
+                    saved = save_edits(selected_table, key, inserts, updates, deletes)
+                except Exception as e:
+                    st.error(f"Error: {e}")
+                    saved = None
+                if saved:
+                    st.session_state.grid_saves = st.session_state.get('grid_saves', 0) + 1
+                    st.toast(f"Saved {len(inserts)} inserted, {len(updates)} updated and {len(deletes)} deleted rows")
+                    st.rerun()
+                elif saved is not None:
+                    st.info("Nothing to save")
+        else:
+            st.dataframe(df)
+
+        previous_col, page_col, next_col = st.columns(3)
+        if previous_col.button("Previous", disabled=len(page_starts) == 1):
+            page_starts.pop()
+            st.rerun()
+        page_col.write(f"Page {len(page_starts)}")
+        if next_col.button("Next", disabled=next_cursor is None):
+            page_starts.append(next_cursor)
+            st.rerun()
 
         # Insert New Row
         st.write(f"### Insert a new row into {selected_table}")
-        num_columns = len(df.columns)
-        insert_values = [st.text_input(f"Column {i+1} (for insert)") for i in range(num_columns)]
-        
-        if st.button("Insert Row"):
-            insert_row(selected_table, insert_values)
+        with st.form("insert", clear_on_submit=True):
+            insert_values = [st.text_input(col) for col in editable]
+            if st.form_submit_button("Insert Row"):
+                insert_row(selected_table, key, editable, insert_values)
 
-        # Update Existing Row
+        # Update Existing Row, looked up by key rather than picked from every key in the table
         st.write(f"### Update an existing row in {selected_table}")
-        
-        # Select primary key column
-        primary_key = st.selectbox("Select the primary key column", df.columns)
-        
-        # Select the row based on primary key value
-        primary_values = df[primary_key].tolist()
-        selected_row_value = st.selectbox(f"Select {primary_key} value to update", primary_values)
-        
-        # Get the current row data based on the selected primary key value
-        selected_row = df[df[primary_key] == selected_row_value].iloc[0]
-        
-        # Display text inputs with pre-filled values from the selected row
-        update_values = [st.text_input(f"Update {col}", value=selected_row[col]) for col in df.columns]
-
-        if st.button("Update Row"):
-            update_row(selected_table, primary_key, selected_row_value, update_values)
+        key_value = st.text_input(f"{key} of the row to update")
+        if key_value:
+            try:
+                selected_row = get_row(selected_table, columns, key, key_value)
+            except Exception as e:
+                st.error(f"Error: {e}")
+                selected_row = None
+
+            if selected_row is None:
+                st.warning(f"No row with {key} = {key_value}")
+            else:
+                with st.form("update"):
+                    # Display text inputs with pre-filled values from the selected row
+                    update_values = [
+                        st.text_input(f"Update {col}", value='' if selected_row[col] is None else str(selected_row[col]))
+                        for col in editable
+                    ]
+                    if st.form_submit_button("Update Row"):
+                        update_row(selected_table, editable, key, key_value, update_values)
 
 else:
     st.write("No tables found in the database.")
+
+# Where the producer's polling budget goes
+with st.expander("Polling schedule"):
+    schedule = get_poll_schedule()
+    if schedule.empty:
+        st.write("The producer has not recorded a schedule yet.")
+    else:
+        st.dataframe(schedule)
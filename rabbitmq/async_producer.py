@@ -0,0 +1,375 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+import gspread
+import mysql.connector
+
+try:
+    import aiomysql
+except ImportError:  # optional dependency, only needed for the asyncio producer
+    aiomysql = None
+
+try:
+    import aio_pika
+except ImportError:  # optional dependency, only needed for the asyncio producer
+    aio_pika = None
+
+from binlog_cdc import advance_watermarks, streamed_tables
+from bulk_writer import quote_identifier
+from change_capture import (
+    INITIAL_WATERMARK, TOMBSTONES_TABLE, TRACKING_COLUMNS, VERSIONS_TABLE, ensure_change_tracking, prune_tombstones
+)
+from coalescer import group_by_table
+from drive_watch import DRIVE_WEBHOOK_ADDRESS, DRIVE_WEBHOOK_PORT, ChangeProbe, keep_watching, start_webhook_server
+from messages import DeltaRows, encode_change
+from poll_scheduler import (
+    POLL_MIN_INTERVAL_SECONDS, POLL_REPORT_SECONDS, PollScheduler, create_schedule_table, store_schedule,
+    take_poll_requests
+)
+from row_identity import sheet_identity_key
+from row_index import RowIndex, db_row_key, has_changes
+from schema import create_or_update_table, get_table_columns, schema_catalog
+from sharding import SHARD_COUNT, SYNC_EXCHANGE, routing_key_for, shard_queue
+from sheet_reader import SHEET_PAGE_SIZE, iter_sheet_rows
+from sheets_api import batch_get_sheets, call_sheets
+from sync_state import open_state_store
+from telemetry import PRODUCER_METRICS_PORT, changes_published, count_rows, rows_read, stage, start_metrics_server
+from type_inference import TYPE_SAMPLE_ROWS
+
+# How many worksheets are read at once and how many MySQL connections the
+# table probes share
+ASYNC_SHEETS_CONCURRENCY = int(os.getenv('ASYNC_SHEETS_CONCURRENCY', '4'))
+ASYNC_DB_CONCURRENCY = int(os.getenv('ASYNC_DB_CONCURRENCY', '8'))
+
+
+def aiomysql_config(mysql_config):
+    return {
+        'host': mysql_config['host'],
+        'user': mysql_config['user'],
+        'password': mysql_config['password'],
+        'db': mysql_config['database'],
+    }
+
+
+# Producer mode that polls every worksheet and every table concurrently on one
+# event loop. The Sheets side and the MySQL side run in parallel, so a poll
+# takes as long as its slowest table rather than the sum of all of them. Which
+# tables a poll covers is up to the same PollScheduler the threaded producer uses.
+# gspread is synchronous, so Sheets reads run on worker threads (still through
+# call_sheets and its rate limits); MySQL is read with aiomysql and changes are
+# published with aio_pika.
+class AsyncProducer:
+    def __init__(self, client, mysql_config, rabbitmq_host, queue_base, binlog_sources=()):
+        if aiomysql is None or aio_pika is None:
+            raise RuntimeError("The asyncio producer needs aiomysql and aio-pika (pip install aiomysql aio-pika)")
+        self.client = client
+        self.mysql_config = mysql_config
+        self.rabbitmq_host = rabbitmq_host
+        self.queue_base = queue_base
+        self.binlog_sources = binlog_sources  # their tables are skipped while they stream
+        self.sheet_slots = asyncio.Semaphore(ASYNC_SHEETS_CONCURRENCY)
+        self.wake = asyncio.Event()
+        self.worksheets = None
+        self.scheduler = PollScheduler()
+        self.stale_sheets = set()
+        self.last_report = time.monotonic()
+        # Blocking connection for the rare schema changes and the once-a-poll
+        # schedule bookkeeping, always used from a worker thread
+        self.setup_connection = None
+
+    async def start(self):
+        self.spreadsheet = await asyncio.to_thread(call_sheets, 'read', self.client.open, "superjoin")
+
+        self.state = await asyncio.to_thread(open_state_store)
+        self.sheet_index = RowIndex(self.state, 'sheet')
+        self.db_index = RowIndex(self.state, 'db')
+        self.watermarks = self.state.get('watermarks', {})
+        self.scheduler.restore(self.state.get('poll_schedule'))
+        self.stale_sheets = set(self.state.get('stale_sheets', []))
+        await asyncio.to_thread(self.run_setup, create_schedule_table)
+
+        self.probe = ChangeProbe(self.client, self.spreadsheet.id)
+        self.probe.mark_seen(self.state.get('drive_version'))
+        if DRIVE_WEBHOOK_PORT and DRIVE_WEBHOOK_ADDRESS:
+            loop = asyncio.get_running_loop()
+            webhook_token = uuid.uuid4().hex
+
+            def on_drive_notification():
+                self.probe.notify()
+                self.scheduler.bump_all()
+                loop.call_soon_threadsafe(self.wake.set)
+
+            start_webhook_server(DRIVE_WEBHOOK_PORT, webhook_token, on_drive_notification)
+            keep_watching(self.client, self.spreadsheet.id, DRIVE_WEBHOOK_ADDRESS, webhook_token)
+
+        self.pool = await aiomysql.create_pool(
+            minsize=1, maxsize=ASYNC_DB_CONCURRENCY, autocommit=False, **aiomysql_config(self.mysql_config)
+        )
+
+        self.amqp = await aio_pika.connect_robust(host=self.rabbitmq_host)
+        channel = await self.amqp.channel()
+        self.exchange = await channel.declare_exchange(SYNC_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True)
+        for shard in range(SHARD_COUNT):
+            queue = await channel.declare_queue(
+                shard_queue(self.queue_base, shard), durable=True, arguments={'x-single-active-consumer': True}
+            )
+            await queue.bind(self.exchange, routing_key=str(shard))
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+        await self.amqp.close()
+        if self.setup_connection is not None:
+            self.setup_connection.close()
+        self.state.close()
+
+    def run_setup(self, func, *args):
+        if self.setup_connection is None:
+            self.setup_connection = mysql.connector.connect(**self.mysql_config)
+        cursor = self.setup_connection.cursor()
+        try:
+            result = func(cursor, *args)
+            self.setup_connection.commit()
+            return result
+        finally:
+            cursor.close()
+
+    def refresh_worksheets(self):
+        self.worksheets = call_sheets('read', self.spreadsheet.worksheets)
+        self.scheduler.track([sheet.title for sheet in self.worksheets])
+
+    async def read_sheet(self, sheet, rows, delta_rows):
+        async with self.sheet_slots:
+            if rows is None:
+                # Larger worksheets are streamed page by page on a worker thread
+                rows = iter_sheet_rows(sheet)
+            with stage('producer', 'sheet_diff', table=sheet.title):
+                change_set = await asyncio.to_thread(
+                    self.sheet_index.diff, sheet.title, count_rows(delta_rows.sheet_rows(rows), sheet.title, 'sheet'),
+                    sheet_identity_key(sheet.title), delta_rows.add
+                )
+            delta_rows.stamp(time.time())
+            return change_set
+
+    # Sheet side of a poll: one Drive probe, then every due worksheet it marked
+    # stale diffed at once. Deltas for the messages are added to `deltas`.
+    async def poll_sheets(self, due, deltas):
+        base_version = self.probe.last_seen
+        try:
+            sheets_changed, drive_version = await asyncio.to_thread(self.probe.check)
+            if sheets_changed:
+                await asyncio.to_thread(self.refresh_worksheets)
+                self.stale_sheets.update(sheet.title for sheet in self.worksheets)
+
+            read_sheets = [sheet for sheet in self.worksheets if sheet.title in due and sheet.title in self.stale_sheets]
+            small_titles = [sheet.title for sheet in read_sheets if sheet.row_count <= SHEET_PAGE_SIZE]
+            sheet_values = await asyncio.to_thread(batch_get_sheets, self.spreadsheet, small_titles)
+
+            delta_rows = {sheet.title: DeltaRows() for sheet in read_sheets}
+            change_sets = await asyncio.gather(*[
+                self.read_sheet(sheet, sheet_values.get(sheet.title), delta_rows[sheet.title]) for sheet in read_sheets
+            ])
+        except gspread.exceptions.APIError as e:
+            # Retries are exhausted; the probe is not marked seen, so the next poll tries again
+            logging.error(f"Error reading Google Sheets, skipping the sheet side of this poll: {e}")
+            return []
+
+        self.stale_sheets.difference_update(sheet.title for sheet in read_sheets)
+        if sheets_changed:
+            self.probe.mark_seen(drive_version)
+        for sheet, change_set in zip(read_sheets, change_sets):
+            deltas[(sheet.title, 'sheet')] = (
+                delta_rows[sheet.title].delta(change_set['deleted']), base_version,
+                drive_version if sheets_changed else base_version
+            )
+        return [
+            (sheet.title, 'sheet', change_set)
+            for sheet, change_set in zip(read_sheets, change_sets) if has_changes(change_set)
+        ]
+
+    # Every table's version counter in one query
+    async def read_versions(self):
+        async with self.pool.acquire() as connection:
+            async with connection.cursor() as cursor:
+                try:
+                    await cursor.execute(f"SELECT table_name, version FROM {VERSIONS_TABLE}")
+                    versions = dict(await cursor.fetchall())
+                except aiomysql.ProgrammingError:
+                    versions = {}  # no table is tracked yet
+            await connection.commit()
+        return versions
+
+    # Create missing tables and add change tracking to old ones. These are rare
+    # one-off schema changes, so they reuse the blocking schema code on a thread.
+    def prepare_tables(self, cursor, sheets):
+        for sheet in sheets:
+            if not schema_catalog.table_exists(cursor, sheet.title):
+                values = call_sheets('read', sheet.get_values, f"1:{TYPE_SAMPLE_ROWS + 1}")
+                if values:
+                    create_or_update_table(cursor, sheet.title, values[0], values[1:])
+            elif ensure_change_tracking(cursor, sheet.title, get_table_columns(cursor, sheet.title)):
+                schema_catalog.invalidate()
+            self.setup_connection.commit()
+
+    # Tombstones at or below the saved watermarks have been published
+    def prune_published(self, cursor, watermarks):
+        for table_name, watermark in watermarks.items():
+            prune_tombstones(cursor, table_name, watermark)
+
+    # Rows and tombstones above the watermark, read in one transaction together
+    # with the table's version counter (see change_capture.fetch_changes). The
+    # new watermark goes into `watermarks` and only replaces the current one
+    # once the change is published and the state saved.
+    async def fetch_table_changes(self, table_name, deltas, watermarks):
+        base_watermark = watermark = self.watermarks.get(table_name, INITIAL_WATERMARK)
+        async with self.pool.acquire() as connection:
+            async with connection.cursor() as cursor:
+                await connection.begin()
+                await cursor.execute(f"SELECT version FROM {VERSIONS_TABLE} WHERE table_name = %s", (table_name,))
+                row = await cursor.fetchone()
+                version = row[0] if row else INITIAL_WATERMARK
+
+                await cursor.execute(
+                    f"SELECT *, UNIX_TIMESTAMP(updated_at) FROM {quote_identifier(table_name)} "
+                    f"WHERE row_version > %s ORDER BY row_version",
+                    (watermark,)
+                )
+                names = [desc[0] for desc in cursor.description][:-1]
+                keep = [i for i, name in enumerate(names) if name not in TRACKING_COLUMNS]
+                records = await cursor.fetchall()
+                rows = [[record[i] for i in keep] for record in records]
+                times = [float(record[-1]) if record[-1] is not None else None for record in records]
+
+                await cursor.execute(
+                    f"SELECT row_id FROM {TOMBSTONES_TABLE} WHERE table_name = %s AND row_version > %s",
+                    (table_name, watermark)
+                )
+                deleted_ids = [row[0] for row in await cursor.fetchall()]
+            await connection.commit()
+        watermark = max(watermark, version)
+
+        rows_read.inc(len(rows), table=table_name, source='db')
+        delta_rows = DeltaRows([names[i] for i in keep])
+        delta_rows.times = {db_row_key(position, row): times[position] for position, row in enumerate(rows)}
+        change_set = self.db_index.apply(table_name, rows, deleted_ids, db_row_key, delta_rows.add)
+        deltas[(table_name, 'db')] = (delta_rows.delta(change_set['deleted']), base_watermark, watermark)
+        watermarks[table_name] = watermark
+        return change_set
+
+    async def poll_table(self, table_name, deltas, watermarks):
+        try:
+            return await self.fetch_table_changes(table_name, deltas, watermarks)
+        except aiomysql.Error as e:
+            logging.error(f"Error fetching data from table '{table_name}': {e}")
+            return None
+
+    # MySQL side of a poll: one query for all version counters, then every due
+    # table whose counter moved is read at once, bounded by the pool size.
+    # Worksheets added since the last sheet read are picked up on the next poll.
+    async def poll_tables(self, due, deltas, watermarks):
+        streamed = streamed_tables(self.binlog_sources)
+        advance_watermarks(self.watermarks, self.binlog_sources, INITIAL_WATERMARK)
+        sheets = [sheet for sheet in self.worksheets if sheet.title in due and sheet.title not in streamed]
+        try:
+            versions = await self.read_versions()
+            untracked = [sheet for sheet in sheets if sheet.title not in versions]
+            if untracked:
+                await asyncio.to_thread(self.run_setup, self.prepare_tables, untracked)
+        except (aiomysql.Error, mysql.connector.Error, gspread.exceptions.APIError) as e:
+            logging.error(f"Error checking MySQL tables, skipping the MySQL side of this poll: {e}")
+            return []
+
+        moved = [
+            sheet.title for sheet in sheets
+            if sheet.title in versions and versions[sheet.title] > self.watermarks.get(sheet.title, INITIAL_WATERMARK)
+        ]
+        change_sets = await asyncio.gather(*[self.poll_table(table_name, deltas, watermarks) for table_name in moved])
+        return [
+            (table_name, 'db', change_set)
+            for table_name, change_set in zip(moved, change_sets) if change_set and has_changes(change_set)
+        ]
+
+    async def publish(self, table_name, source, change_set, detected_at, deltas):
+        delta, base_version, version = deltas.get((table_name, source), (None, None, None))
+        message = aio_pika.Message(
+            encode_change(table_name, source, change_set, detected_at, delta, base_version, version),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+        )
+        await self.exchange.publish(message, routing_key=routing_key_for(table_name))
+        changes_published.inc(table=table_name, source=source)
+
+    async def poll_once(self):
+        started = time.monotonic()
+        # Edits made through the app ask for their table to be polled now
+        for table_name in await asyncio.to_thread(self.run_setup, take_poll_requests):
+            self.scheduler.bump(table_name)
+        due = set(self.scheduler.due())
+        if not due:
+            return 0
+
+        deltas = {}
+        watermarks = {}  # table -> watermark read up to in this poll
+        with stage('producer', 'detect'):
+            sheet_changes, db_changes = await asyncio.gather(
+                self.poll_sheets(due, deltas), self.poll_tables(due, deltas, watermarks)
+            )
+        detected_at = time.time()
+
+        grouped = group_by_table(sheet_changes + db_changes)
+        with stage('producer', 'publish'):
+            await asyncio.gather(*[
+                self.publish(table_name, source, change_set, detected_at, deltas)
+                for table_name, (source, change_set) in grouped.items()
+            ])
+        for table_name in due:
+            self.scheduler.record(table_name, table_name in grouped, started)
+
+        # Saved only once every publish is confirmed, as in the threaded producer.
+        # Tombstones are pruned after that: a failure before then reads them again.
+        with stage('producer', 'state_save'):
+            await asyncio.to_thread(
+                self.state.save,
+                self.sheet_index.take_dirty() + self.db_index.take_dirty(),
+                {
+                    'watermarks': {**self.watermarks, **watermarks}, 'drive_version': self.probe.last_seen,
+                    'poll_schedule': self.scheduler.dump(), 'stale_sheets': sorted(self.stale_sheets)
+                }
+            )
+        self.watermarks.update(watermarks)
+        await asyncio.to_thread(self.run_setup, self.prune_published, watermarks)
+        await asyncio.to_thread(self.run_setup, store_schedule, self.scheduler)
+
+        logging.info(f"Polled {len(due)} table(s), published {len(grouped)} change(s) in {time.monotonic() - started:.2f}s")
+        if time.monotonic() - self.last_report >= POLL_REPORT_SECONDS:
+            logging.info(f"Polling schedule:\n{self.scheduler.describe()}")
+            self.last_report = time.monotonic()
+        return len(grouped)
+
+    # Sleep until the next table is due or a Drive notification arrives, waking
+    # at least every POLL_MIN_INTERVAL_SECONDS for poll requests
+    async def wait_for_next_poll(self):
+        try:
+            await asyncio.wait_for(
+                self.wake.wait(), timeout=min(self.scheduler.seconds_until_next(), POLL_MIN_INTERVAL_SECONDS)
+            )
+        except asyncio.TimeoutError:
+            pass
+        self.wake.clear()
+
+    async def run(self):
+        start_metrics_server(PRODUCER_METRICS_PORT)
+        await self.start()
+        try:
+            await asyncio.to_thread(self.refresh_worksheets)
+            while True:
+                await self.poll_once()
+                await self.wait_for_next_poll()
+        finally:
+            await self.close()
+
+
+async def run_async_producer(client, mysql_config, rabbitmq_host, queue_base, binlog_sources=()):
+    await AsyncProducer(client, mysql_config, rabbitmq_host, queue_base, binlog_sources).run()
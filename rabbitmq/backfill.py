@@ -0,0 +1,616 @@
+import argparse
+import json
+import logging
+import os
+import socket
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import gspread
+import mysql.connector
+
+from bulk_writer import BULK_CHUNK_SIZE, chunked, normalize_row, quote_identifier, table_is_empty, write_rows
+from change_capture import SKIP_VERSION_VARIABLE, bump_version, create_change_triggers
+from conflict_resolver import BASE_TABLE, create_base_table, store_base
+from connections import Publisher
+from messages import encode_change
+from row_identity import (
+    ROW_ID_COLUMN, SheetRowKeys, assign_missing_row_ids, create_identity_tables, is_row_id, key_columns, row_key,
+    sheet_columns, store_sheet_keys, uses_row_ids
+)
+from row_index import empty_change_set
+from schema import create_or_update_table, get_table_columns, table_column_types
+from sheet_reader import SHEET_PAGE_SIZE, fetch_page
+from sheet_writer import row_block_updates, set_hidden_columns
+from sheets_api import call_sheets
+from type_inference import TYPE_SAMPLE_ROWS, canonical_value
+
+# Parallel first sync of a large worksheet or table. The source is split into
+# ranges (sheet row numbers, or primary-key ranges of MySQL's id column) that
+# a process pool copies independently, each worker with its own MySQL
+# connection and Sheets client. Every finished range is checkpointed, so a
+# backfill that crashes resumes with the ranges still left. The sync base for
+# the table is staged while the backfill runs and swapped in in one
+# transaction at the end; until then the consumer leaves the table alone, and
+# afterwards one full reconcile picks up whatever changed during the backfill.
+# The workers' MySQL writes skip the table's version counter, which would
+# otherwise make them take turns on its one row; finish_backfill() bumps it once.
+
+# Sheet rows or MySQL ids per range
+BACKFILL_RANGE_ROWS = int(os.getenv('BACKFILL_RANGE_ROWS', '50000'))
+BACKFILL_PROCESSES = int(os.getenv('BACKFILL_PROCESSES', str(min(os.cpu_count() or 4, 8))))
+
+# A first sync of a worksheet with more data rows than this is handed to a
+# backfill instead of being loaded on a consumer thread
+BACKFILL_THRESHOLD_ROWS = int(os.getenv('BACKFILL_THRESHOLD_ROWS', '100000'))
+
+# A running backfill that hasn't checkpointed for this long is presumed dead
+# and resumed by the next message for its table (failed ones are retried after
+# the same delay)
+BACKFILL_STALE_SECONDS = int(os.getenv('BACKFILL_STALE_SECONDS', '900'))
+
+# Rows per batch_update when writing a range to the sheet
+BACKFILL_WRITE_ROWS = int(os.getenv('BACKFILL_WRITE_ROWS', '2000'))
+
+BACKFILLS_TABLE = '_sync_backfills'
+BACKFILL_RANGES_TABLE = '_sync_backfill_ranges'
+BACKFILL_BASE_TABLE = '_sync_backfill_base'
+
+DIRECTIONS = ('sheet', 'db')  # sheet -> MySQL, MySQL -> sheet
+
+
+def create_backfill_tables(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {BACKFILLS_TABLE} (
+        table_name VARCHAR(64) PRIMARY KEY,
+        direction VARCHAR(8) NOT NULL,
+        status VARCHAR(16) NOT NULL,
+        owner VARCHAR(128),
+        headers MEDIUMTEXT,
+        first_load BOOLEAN NOT NULL DEFAULT FALSE,
+        ranges_total INT NOT NULL DEFAULT 0,
+        ranges_done INT NOT NULL DEFAULT 0,
+        rows_done BIGINT NOT NULL DEFAULT 0,
+        error TEXT,
+        started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        heartbeat_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP NULL
+    )
+    """)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {BACKFILL_RANGES_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        range_start BIGINT NOT NULL,
+        range_end BIGINT NOT NULL,
+        sheet_row BIGINT,
+        planned_rows BIGINT,
+        done BOOLEAN NOT NULL DEFAULT FALSE,
+        rows_written BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (table_name, range_start)
+    )
+    """)
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {BACKFILL_BASE_TABLE} LIKE {BASE_TABLE}")
+
+
+# (state, direction) of the table's backfill: state is None (never, or
+# finished), 'running' or 'failed' (recently; leave the table alone), or
+# 'stale' (nothing heard for BACKFILL_STALE_SECONDS; resume it)
+def backfill_status(cursor, table_name):
+    try:
+        cursor.execute(
+            f"SELECT status, direction, TIMESTAMPDIFF(SECOND, heartbeat_at, NOW()) FROM {BACKFILLS_TABLE} "
+            f"WHERE table_name = %s",
+            (table_name,)
+        )
+        row = cursor.fetchone()
+    except mysql.connector.errors.ProgrammingError:
+        return None, None  # no backfill has ever run
+    if row is None or row[0] == 'done':
+        return None, None
+    status, direction, age = row
+    return ('stale' if age >= BACKFILL_STALE_SECONDS else status), direction
+
+
+# InnoDB's row estimate; enough to tell a large table from a small one
+def estimated_rows(cursor, table_name):
+    cursor.execute(
+        "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+        (table_name,)
+    )
+    row = cursor.fetchone()
+    return (row[0] or 0) if row else 0
+
+
+# Whether the sheet has more than `rows` data rows below its header. The grid
+# (row_count) is often much larger than the data in it, so the row just past
+# that many is read instead, assuming the data has no gap that long.
+def sheet_has_more_rows(sheet, rows):
+    if sheet.row_count - 1 <= rows:
+        return False
+    return any(call_sheets('read', sheet.row_values, rows + 2))
+
+
+# Sheet ranges of `range_rows` rows from row 2 (below the header) to `row_count`
+def plan_sheet_ranges(row_count, range_rows=BACKFILL_RANGE_ROWS):
+    return [
+        (start, min(start + range_rows - 1, row_count), None, None)
+        for start in range(2, row_count + 1, range_rows)
+    ]
+
+
+# Id ranges from [(bucket, row count)], bucket being (id - lowest id) //
+# range_rows. Each range's rows go to the sheet right after the previous
+# range's, so its first sheet row is known before any of them is read.
+def plan_db_ranges(buckets, lowest_id, range_rows=BACKFILL_RANGE_ROWS):
+    ranges = []
+    sheet_row = 2
+    for bucket, count in sorted(buckets):
+        start = lowest_id + int(bucket) * range_rows
+        ranges.append((start, start + range_rows - 1, sheet_row, count))
+        sheet_row += count
+    return ranges
+
+
+# Take the table's backfill for this process. Returns False if another one is
+# running; otherwise a finished, restarted or differently directed backfill
+# starts over and an interrupted one resumes from its checkpoints.
+def claim_backfill(connection, table_name, direction, restart=False):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            f"SELECT status, direction, TIMESTAMPDIFF(SECOND, heartbeat_at, NOW()) FROM {BACKFILLS_TABLE} "
+            f"WHERE table_name = %s FOR UPDATE",
+            (table_name,)
+        )
+        row = cursor.fetchone()
+        if row is not None and row[0] == 'running' and row[2] < BACKFILL_STALE_SECONDS and not restart:
+            connection.rollback()
+            return False
+
+        if row is None or restart or row[0] == 'done' or row[1] != direction:
+            for table in (BACKFILL_RANGES_TABLE, BACKFILL_BASE_TABLE):
+                cursor.execute(f"DELETE FROM {table} WHERE table_name = %s", (table_name,))
+            cursor.execute(
+                f"REPLACE INTO {BACKFILLS_TABLE} (table_name, direction, status, owner) VALUES (%s, %s, 'running', %s)",
+                (table_name, direction, owner)
+            )
+        else:
+            cursor.execute(
+                f"UPDATE {BACKFILLS_TABLE} SET status = 'running', owner = %s, error = NULL, heartbeat_at = NOW() "
+                f"WHERE table_name = %s",
+                (owner, table_name)
+            )
+        connection.commit()
+        return True
+    finally:
+        cursor.close()
+
+
+# Header row, table and _row_id column for a sheet -> MySQL backfill. Column
+# types come from the first rows, as in a regular first sync.
+def prepare_sheet_backfill(connection, sheet, range_rows):
+    values = call_sheets('read', sheet.get_values, f"1:{TYPE_SAMPLE_ROWS + 1}")
+    if not values or not values[0]:
+        raise ValueError(f"Sheet '{sheet.title}' has no header row")
+
+    keys = SheetRowKeys(sheet, values[0])
+    sample = [[normalize_row(row, len(keys.headers))[index] for index in keys.write_indexes] for row in values[1:]]
+    cursor = connection.cursor()
+    try:
+        create_or_update_table(cursor, sheet.title, keys.write_headers, sample)
+        # Tables tracked before the workers could skip the version counter get the current triggers
+        create_change_triggers(cursor, sheet.title)
+        first_load = table_is_empty(cursor, sheet.title)
+        connection.commit()
+    finally:
+        cursor.close()
+
+    # Adds and hides the _row_id column the first time; row ids are written by the workers
+    keys.write_back()
+    return keys.headers, first_load, plan_sheet_ranges(sheet.row_count, range_rows)
+
+
+# Header row and sheet size for a MySQL -> sheet backfill, with every row given
+# its _row_id up front so the workers only read
+def prepare_db_backfill(connection, sheet, range_rows):
+    table = quote_identifier(sheet.title)
+    cursor = connection.cursor()
+    try:
+        assign_missing_row_ids(cursor, sheet.title)
+        headers = sheet_columns(get_table_columns(cursor, sheet.title))
+        cursor.execute(f"SELECT MIN(id) FROM {table}")
+        lowest_id = cursor.fetchone()[0]
+        buckets = []
+        if lowest_id is not None:
+            cursor.execute(
+                f"SELECT FLOOR((id - %s) / %s) AS bucket, COUNT(*) FROM {table} GROUP BY bucket",
+                (lowest_id, range_rows)
+            )
+            buckets = cursor.fetchall()
+        connection.commit()
+    finally:
+        cursor.close()
+
+    ranges = plan_db_ranges(buckets, lowest_id, range_rows) if buckets else []
+    total_rows = sum(count for _, count in buckets) + 1
+    if total_rows > sheet.row_count:
+        call_sheets('write', sheet.add_rows, total_rows - sheet.row_count)
+    if len(headers) > sheet.col_count:
+        call_sheets('write', sheet.add_cols, len(headers) - sheet.col_count)
+    call_sheets('write', sheet.batch_update, row_block_updates([(1, headers)]))
+    set_hidden_columns(sheet, headers, {ROW_ID_COLUMN})
+    return headers, False, ranges
+
+
+def save_plan(connection, table_name, headers, first_load, ranges):
+    cursor = connection.cursor()
+    try:
+        for chunk in chunked(ranges, BULK_CHUNK_SIZE):
+            cursor.execute(
+                f"INSERT IGNORE INTO {BACKFILL_RANGES_TABLE} (table_name, range_start, range_end, sheet_row, planned_rows) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(chunk))}",
+                [value for planned in chunk for value in (table_name,) + tuple(planned)]
+            )
+        cursor.execute(
+            f"UPDATE {BACKFILLS_TABLE} SET headers = %s, first_load = %s, ranges_total = %s WHERE table_name = %s",
+            (json.dumps(headers), first_load, len(ranges), table_name)
+        )
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+# Headers and first_load the backfill was planned with (None before planning),
+# and the ranges not yet done
+def load_plan(connection, table_name):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"SELECT headers, first_load FROM {BACKFILLS_TABLE} WHERE table_name = %s", (table_name,))
+        headers, first_load = cursor.fetchone()
+        cursor.execute(
+            f"SELECT range_start, range_end, sheet_row, planned_rows FROM {BACKFILL_RANGES_TABLE} "
+            f"WHERE table_name = %s AND NOT done ORDER BY range_start",
+            (table_name,)
+        )
+        pending = cursor.fetchall()
+        connection.commit()
+    finally:
+        cursor.close()
+    return (json.loads(headers) if headers else None), bool(first_load), pending
+
+
+def record_progress(connection, table_name):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            f"UPDATE {BACKFILLS_TABLE} b SET heartbeat_at = NOW(), "
+            f"ranges_done = (SELECT COUNT(*) FROM {BACKFILL_RANGES_TABLE} r WHERE r.table_name = b.table_name AND r.done), "
+            f"rows_done = (SELECT COALESCE(SUM(rows_written), 0) FROM {BACKFILL_RANGES_TABLE} r WHERE r.table_name = b.table_name) "
+            f"WHERE table_name = %s",
+            (table_name,)
+        )
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+def record_failure(connection, table_name, error):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            f"UPDATE {BACKFILLS_TABLE} SET status = 'failed', error = %s, heartbeat_at = NOW() WHERE table_name = %s",
+            (str(error)[:10000], table_name)
+        )
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+# _row_ids that more than one sheet row carries, e.g. a row pasted with its id
+# into another range. Each worker only gives fresh ids to repeats within its
+# own range, so across ranges the rows were upserted over each other. That
+# shows as fewer staged base rows than rows written; only then is the sheet's
+# _row_id column read to find them.
+def duplicate_row_ids(connection, sheet, table_name, headers):
+    if not uses_row_ids(table_name):
+        return set()
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            f"SELECT COALESCE(SUM(rows_written), 0) FROM {BACKFILL_RANGES_TABLE} WHERE table_name = %s", (table_name,)
+        )
+        written = cursor.fetchone()[0]
+        cursor.execute(f"SELECT COUNT(*) FROM {BACKFILL_BASE_TABLE} WHERE table_name = %s", (table_name,))
+        staged = cursor.fetchone()[0]
+        connection.commit()
+    finally:
+        cursor.close()
+    if written <= staged:
+        return set()
+
+    ids = call_sheets('read', sheet.col_values, headers.index(ROW_ID_COLUMN) + 1)[1:]
+    return {row_id for row_id, count in Counter(row_id for row_id in ids if is_row_id(row_id)).items() if count > 1}
+
+
+# Swap the staged base in and mark the backfill done in one transaction. From
+# that commit on the table is synced by deltas like any other. The MySQL row
+# and base of each `duplicates` id are dropped first: which sheet row they hold
+# depends on which worker wrote last, and the reconcile after the backfill
+# inserts every copy again, giving the repeats new ids.
+def finish_backfill(connection, table_name, duplicates=()):
+    cursor = connection.cursor()
+    try:
+        for chunk in chunked(sorted(duplicates), BULK_CHUNK_SIZE):
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(
+                f"DELETE FROM {BACKFILL_BASE_TABLE} WHERE table_name = %s AND row_key IN ({placeholders})",
+                [table_name] + chunk
+            )
+            cursor.execute(
+                f"DELETE FROM {quote_identifier(table_name)} WHERE {quote_identifier(ROW_ID_COLUMN)} IN ({placeholders})",
+                chunk
+            )
+        if duplicates:
+            logging.warning(f"{len(duplicates)} _row_ids of '{table_name}' are on several sheet rows; they are resynced")
+        bump_version(cursor, table_name)
+        create_base_table(cursor)
+        cursor.execute(f"DELETE FROM {BASE_TABLE} WHERE table_name = %s", (table_name,))
+        cursor.execute(
+            f"INSERT INTO {BASE_TABLE} (table_name, row_key, cells) "
+            f"SELECT table_name, row_key, cells FROM {BACKFILL_BASE_TABLE} WHERE table_name = %s",
+            (table_name,)
+        )
+        cursor.execute(f"DELETE FROM {BACKFILL_BASE_TABLE} WHERE table_name = %s", (table_name,))
+        cursor.execute(f"DELETE FROM {BACKFILL_RANGES_TABLE} WHERE table_name = %s", (table_name,))
+        cursor.execute(
+            f"UPDATE {BACKFILLS_TABLE} SET status = 'done', finished_at = NOW(), heartbeat_at = NOW() WHERE table_name = %s",
+            (table_name,)
+        )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Per-process connections for the pool's workers, opened on first use
+worker = {}
+
+
+def init_worker(mysql_config, credentials, spreadsheet_name):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    worker.update(mysql_config=mysql_config, credentials=credentials, spreadsheet_name=spreadsheet_name)
+
+
+def worker_connection():
+    if worker.get('connection') is None or not worker['connection'].is_connected():
+        worker['connection'] = mysql.connector.connect(**worker['mysql_config'])
+        cursor = worker['connection'].cursor()
+        cursor.execute(f"SET {SKIP_VERSION_VARIABLE} = 1")
+        cursor.close()
+    return worker['connection']
+
+
+def worker_sheet(table_name):
+    if worker.get('spreadsheet') is None:
+        client = gspread.authorize(worker['credentials'])
+        worker['spreadsheet'] = call_sheets('read', client.open, worker['spreadsheet_name'])
+    return call_sheets('read', worker['spreadsheet'].worksheet, table_name)
+
+
+# Base rows, stored sheet keys and the range's checkpoint, in one transaction
+# so a range is either entirely done or redone on resume
+def complete_range(connection, table_name, range_start, base, sheet_keys):
+    cursor = connection.cursor()
+    try:
+        store_base(cursor, table_name, {}, base, base_table=BACKFILL_BASE_TABLE)
+        create_identity_tables(cursor)
+        store_sheet_keys(cursor, table_name, set(), set(sheet_keys))
+        cursor.execute(
+            f"UPDATE {BACKFILL_RANGES_TABLE} SET done = TRUE, rows_written = %s WHERE table_name = %s AND range_start = %s",
+            (len(base), table_name, range_start)
+        )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Canonical base row for each written row, as the first reconcile would store it
+def base_rows(table_name, headers, rows, column_types):
+    columns = [column for column in headers if column != ROW_ID_COLUMN and column in column_types]
+    key_positions = [headers.index(column) for column in key_columns(table_name)]
+    base = {}
+    for row in rows:
+        values = dict(zip(headers, row))
+        key = row_key(table_name, [row[position] for position in key_positions])
+        base[key] = {column: canonical_value(values[column], column_types.get(column)) for column in columns}
+    return base
+
+
+# Worker: copy sheet rows start..end to MySQL. Ids for rows that have none are
+# written to the sheet before the rows reach MySQL, so a redone range finds
+# the same ids and upserts in place.
+def backfill_sheet_range(job):
+    table_name, start, end = job['table'], job['start'], job['end']
+    connection = worker_connection()
+    sheet = worker_sheet(table_name)
+
+    def read_range():
+        for page_start in range(start, end + 1, SHEET_PAGE_SIZE):
+            page_end = min(page_start + SHEET_PAGE_SIZE - 1, end)
+            page = fetch_page(sheet, page_start, page_end)
+            yield from page
+            # Trailing blank rows are trimmed by the API; keep row numbers aligned
+            yield from [[]] * (page_end - page_start + 1 - len(page))
+
+    keys = SheetRowKeys(sheet, job['headers'])
+    rows = list(keys.rows(read_range(), first_row_number=start))
+    keys.write_back()
+
+    cursor = connection.cursor()
+    try:
+        column_types = table_column_types(cursor, table_name)
+    finally:
+        cursor.close()
+    write_rows(
+        connection, table_name, keys.write_headers, rows,
+        first_load=job['first_load'], expected_rows=len(rows), column_types=column_types
+    )
+    base = base_rows(table_name, keys.write_headers, rows, column_types.types)
+    complete_range(connection, table_name, start, base, keys.keys)
+    return start, len(rows)
+
+
+# Worker: copy the MySQL rows with ids start..end to the sheet rows reserved
+# for them. Rows inserted into the range after planning don't fit there and are
+# left to the reconcile that follows the backfill.
+def backfill_db_range(job):
+    table_name, headers = job['table'], job['headers']
+    connection = worker_connection()
+    sheet = worker_sheet(table_name)
+
+    cursor = connection.cursor()
+    try:
+        column_types = table_column_types(cursor, table_name)
+        cursor.execute(
+            f"SELECT {', '.join(quote_identifier(column) for column in headers)} FROM {quote_identifier(table_name)} "
+            f"WHERE id BETWEEN %s AND %s ORDER BY id LIMIT %s",
+            (job['start'], job['end'], job['planned_rows'])
+        )
+        rows = [list(row) for row in cursor.fetchall()]
+        connection.commit()
+    finally:
+        cursor.close()
+
+    for offset in range(0, len(rows), BACKFILL_WRITE_ROWS):
+        block = rows[offset:offset + BACKFILL_WRITE_ROWS]
+        first_row = job['sheet_row'] + offset
+        call_sheets(
+            'write', sheet.batch_update,
+            row_block_updates([(first_row + index, row) for index, row in enumerate(block)])
+        )
+
+    base = base_rows(table_name, headers, rows, column_types.types)
+    complete_range(connection, table_name, job['start'], base, base.keys())
+    return job['start'], len(rows)
+
+
+# Run (or resume) the backfill of one table to completion. `direction` is
+# 'sheet' (sheet -> MySQL) or 'db' (MySQL -> sheet). When rabbitmq_host is
+# given, a full-reconcile message for the table is published at the end to
+# pick up edits made while the backfill ran. Returns True once the table is
+# switched over to delta sync.
+def run_backfill(table_name, direction, mysql_config, credentials_loader, spreadsheet_name='superjoin',
+                 processes=BACKFILL_PROCESSES, range_rows=BACKFILL_RANGE_ROWS, restart=False,
+                 rabbitmq_host=None, queue_base=None):
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Unknown backfill direction '{direction}'")
+
+    connection = mysql.connector.connect(**mysql_config)
+    try:
+        cursor = connection.cursor()
+        create_backfill_tables(cursor)
+        cursor.close()
+        connection.commit()
+        if not claim_backfill(connection, table_name, direction, restart):
+            logging.info(f"A backfill of '{table_name}' is already running")
+            return False
+
+        try:
+            credentials = credentials_loader()
+            spreadsheet = call_sheets('read', gspread.authorize(credentials).open, spreadsheet_name)
+            sheet = call_sheets('read', spreadsheet.worksheet, table_name)
+
+            headers, first_load, pending = load_plan(connection, table_name)
+            if headers is None:
+                prepare = prepare_sheet_backfill if direction == 'sheet' else prepare_db_backfill
+                headers, first_load, ranges = prepare(connection, sheet, range_rows)
+                save_plan(connection, table_name, headers, first_load, ranges)
+                pending = ranges
+            logging.info(f"Backfilling '{table_name}' ({direction}): {len(pending)} ranges left on {processes} processes")
+
+            copy_range = backfill_sheet_range if direction == 'sheet' else backfill_db_range
+            jobs = [
+                {'table': table_name, 'headers': headers, 'first_load': first_load,
+                 'start': start, 'end': end, 'sheet_row': sheet_row, 'planned_rows': planned_rows}
+                for start, end, sheet_row, planned_rows in pending
+            ]
+            with ProcessPoolExecutor(
+                max_workers=processes, initializer=init_worker, initargs=(mysql_config, credentials, spreadsheet_name)
+            ) as pool:
+                running = {pool.submit(copy_range, job) for job in jobs}
+                while running:
+                    # Checkpoint at least once a minute so a slow range doesn't look dead
+                    done, running = wait(running, timeout=60, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        start, written = future.result()
+                        logging.info(f"Backfilled {written} rows of '{table_name}' from {start}")
+                    record_progress(connection, table_name)
+
+            duplicates = duplicate_row_ids(connection, sheet, table_name, headers) if direction == 'sheet' else set()
+            finish_backfill(connection, table_name, duplicates)
+        except Exception as e:
+            logging.exception(f"Backfill of '{table_name}' failed; it resumes from its last checkpoint")
+            record_failure(connection, table_name, e)
+            return False
+    finally:
+        connection.close()
+
+    logging.info(f"Backfill of '{table_name}' finished; switched to delta sync")
+    if rabbitmq_host:
+        publisher = Publisher(rabbitmq_host, queue_base)
+        publisher.publish(encode_change(table_name, 'both', empty_change_set()), table_name)
+        publisher.close()
+    return True
+
+
+def print_status(mysql_config):
+    connection = mysql.connector.connect(**mysql_config)
+    try:
+        cursor = connection.cursor()
+        create_backfill_tables(cursor)
+        cursor.execute(
+            f"SELECT table_name, direction, status, ranges_done, ranges_total, rows_done, heartbeat_at, error "
+            f"FROM {BACKFILLS_TABLE} ORDER BY started_at"
+        )
+        for table_name, direction, status, ranges_done, ranges_total, rows_done, heartbeat_at, error in cursor.fetchall():
+            print(
+                f"{table_name} ({direction}): {status}, {ranges_done}/{ranges_total} ranges, {rows_done} rows, "
+                f"last checkpoint {heartbeat_at}" + (f", error: {error}" if error else '')
+            )
+        cursor.close()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    # Reuse the consumer's configuration and credentials
+    from consumer import get_google_credentials, mysql_config, rabbitmq_host, rabbitmq_queue
+    from messages import encode_backfill
+
+    parser = argparse.ArgumentParser(description="Parallel first sync of a large worksheet or table")
+    parser.add_argument('table', nargs='?', help="worksheet/table to backfill")
+    parser.add_argument('--direction', choices=DIRECTIONS, default='sheet', help="sheet: sheet -> MySQL, db: MySQL -> sheet")
+    parser.add_argument('--processes', type=int, default=BACKFILL_PROCESSES)
+    parser.add_argument('--range-rows', type=int, default=BACKFILL_RANGE_ROWS)
+    parser.add_argument('--restart', action='store_true', help="discard checkpoints and start over")
+    parser.add_argument('--enqueue', action='store_true', help="have a consumer run it instead of this process")
+    parser.add_argument('--status', action='store_true', help="show the progress of every backfill")
+    args = parser.parse_args()
+
+    if args.status or not args.table:
+        print_status(mysql_config)
+    elif args.enqueue:
+        queue_publisher = Publisher(rabbitmq_host, rabbitmq_queue)
+        queue_publisher.publish(encode_backfill(args.table, args.direction), args.table)
+        queue_publisher.close()
+    else:
+        run_backfill(
+            args.table, args.direction, mysql_config, get_google_credentials, processes=args.processes,
+            range_rows=args.range_rows, restart=args.restart, rabbitmq_host=rabbitmq_host, queue_base=rabbitmq_queue
+        )
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from row_index import empty_change_set, has_changes
+from telemetry import binlog_failures, binlog_streaming
+
+try:
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import HeartbeatLogEvent, RotateEvent
+    from pymysqlreplication.row_event import DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent
+except ImportError:  # optional dependency, only needed when CDC_TABLES is set
+    BinLogStreamReader = None
+
+# Tables whose changes come from the binlog instead of polling, e.g. "orders,customers"
+CDC_TABLES = [table.strip() for table in os.getenv('CDC_TABLES', '').split(',') if table.strip()]
+BINLOG_SERVER_ID = int(os.getenv('BINLOG_SERVER_ID', '4242'))
+BINLOG_POSITION_FILE = os.getenv('BINLOG_POSITION_FILE', 'binlog_position.json')
+
+# A failed stream is reopened from the saved position after 1, 2, 4, ... seconds, up to this
+BINLOG_RETRY_MAX_SECONDS = float(os.getenv('BINLOG_RETRY_MAX_SECONDS', '60'))
+# How often the server sends a heartbeat on an idle stream, so it is known to be up
+BINLOG_HEARTBEAT_SECONDS = float(os.getenv('BINLOG_HEARTBEAT_SECONDS', '5'))
+
+
+def load_position(path=BINLOG_POSITION_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path) as position_file:
+        return json.load(position_file)
+
+
+# Written to a temp file and renamed so a crash never leaves a torn position
+def save_position(log_file, log_pos, path=BINLOG_POSITION_FILE):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as position_file:
+        json.dump({'log_file': log_file, 'log_pos': log_pos}, position_file)
+    os.replace(temp_path, path)
+
+
+# Turn one row event into a change set keyed by primary key. `event_type` is
+# 'write', 'update' or 'delete'; `rows` uses the binlog reader's row layout.
+def rows_event_to_change(event_type, rows):
+    change_set = empty_change_set()
+    for row in rows:
+        if event_type == 'write':
+            change_set['inserted'].append(row['values']['id'])
+        elif event_type == 'update':
+            change_set['updated'].append(row['after_values']['id'])
+        elif event_type == 'delete':
+            change_set['deleted'].append(row['values']['id'])
+    return change_set
+
+
+# Highest row_version among the rows of one row event (before and after images)
+def highest_version(rows):
+    versions = [
+        values['row_version'] for row in rows for values in (row.get('values'), row.get('after_values'))
+        if values and values.get('row_version') is not None
+    ]
+    return max(versions, default=None)
+
+
+def is_row_event(event):
+    return isinstance(event, (WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent))
+
+
+def event_type_of(event):
+    if isinstance(event, WriteRowsEvent):
+        return 'write'
+    if isinstance(event, UpdateRowsEvent):
+        return 'update'
+    return 'delete'
+
+
+# Tails the row-based binlog (binlog_format=ROW) for the configured tables and
+# calls on_change(table, change_set) for every row event. The position is saved
+# after each event has been handed off, so a restart resumes where it stopped
+# and at worst re-delivers the last event. `streaming` is True only once the
+# server has sent something on the stream (the rotate event on connect, or a
+# heartbeat) and until it fails, so pollers can take the tables back whenever
+# it is down. `versions` is the highest row_version handed off per table.
+class BinlogChangeSource:
+    def __init__(self, mysql_config, tables, on_change, position_file=BINLOG_POSITION_FILE):
+        if BinLogStreamReader is None:
+            raise RuntimeError("CDC_TABLES is set but mysql-replication is not installed (pip install mysql-replication)")
+
+        self.mysql_config = mysql_config
+        self.tables = tables
+        self.on_change = on_change
+        self.position_file = position_file
+        self.streaming = False
+        self.versions = {}
+
+    def run(self):
+        position = load_position(self.position_file)
+        stream = BinLogStreamReader(
+            connection_settings={
+                'host': self.mysql_config['host'],
+                'port': int(os.getenv('MYSQL_PORT', '3306')),
+                'user': self.mysql_config['user'],
+                'passwd': self.mysql_config['password'],
+            },
+            server_id=BINLOG_SERVER_ID,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, RotateEvent, HeartbeatLogEvent],
+            only_schemas=[self.mysql_config['database']],
+            only_tables=self.tables,
+            blocking=True,
+            slave_heartbeat=BINLOG_HEARTBEAT_SECONDS,
+            resume_stream=position is not None,
+            log_file=position['log_file'] if position else None,
+            log_pos=position['log_pos'] if position else None,
+        )
+        logging.info(f"Tailing binlog for tables {self.tables} from {position or 'current position'}")
+
+        try:
+            for event in stream:
+                if not self.streaming:
+                    self.streaming = True
+                    binlog_streaming.set(1)
+                if not is_row_event(event):
+                    continue
+                change_set = rows_event_to_change(event_type_of(event), event.rows)
+                if has_changes(change_set):
+                    self.on_change(event.table, change_set)
+                version = highest_version(event.rows)
+                if version is not None and version > self.versions.get(event.table, 0):
+                    self.versions[event.table] = version
+                save_position(stream.log_file, stream.log_pos, self.position_file)
+        finally:
+            self.streaming = False
+            binlog_streaming.set(0)
+            stream.close()
+
+    # run() until `stop` is set, reopening the stream with backoff whenever it
+    # fails (or ends). Each attempt resumes from the last saved position.
+    def run_forever(self, stop=None, sleep=time.sleep):
+        failures = 0
+        while stop is None or not stop.is_set():
+            opened_at = time.monotonic()
+            try:
+                self.run()
+                logging.warning(f"Binlog stream for {self.tables} ended; reopening it")
+            except Exception:
+                logging.exception(f"Binlog stream for {self.tables} failed; polling those tables until it is back")
+            binlog_failures.inc()
+            # A stream that ran for a while starts the backoff over
+            failures = 1 if time.monotonic() - opened_at > BINLOG_RETRY_MAX_SECONDS else failures + 1
+            sleep(min(2 ** (failures - 1), BINLOG_RETRY_MAX_SECONDS))
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever, daemon=True, name='binlog-cdc')
+        thread.start()
+        return thread
+
+
+# Tables currently streamed by any of `sources`; the rest of CDC_TABLES are polled
+def streamed_tables(sources):
+    return {table for source in sources if source.streaming for table in source.tables}
+
+
+# Move poll watermarks up to the row_version each streamed table has been
+# published to, so a table that falls back to polling picks up after what the
+# stream already sent instead of publishing it all again. Row versions come
+# from a counter row locked until commit, so the binlog sees them in order.
+def advance_watermarks(watermarks, sources, initial):
+    for source in sources:
+        for table_name, version in list(source.versions.items()):
+            if version > watermarks.get(table_name, initial):
+                watermarks[table_name] = version
+
+
+# Replay a recorded fixture instead of a live server. Each line is a JSON object
+# {"table": ..., "type": "write" | "update" | "delete", "rows": [...]} using the
+# same row layout as the binlog reader, so tests don't need a MySQL container.
+def replay_fixture(path, on_change):
+    with open(path) as fixture:
+        for line in fixture:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            change_set = rows_event_to_change(event['type'], event['rows'])
+            if has_changes(change_set):
+                on_change(event['table'], change_set)
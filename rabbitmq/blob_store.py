@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+# Claim-check store for change payloads too large to travel in the message
+# itself: the producer writes the payload here and the message only carries
+# its reference. Blobs are plain files named by the SHA-256 of their content,
+# so the producer and consumer must share the directory (same host or a
+# shared volume).
+CLAIM_CHECK_DIR = os.getenv('CLAIM_CHECK_DIR', 'sync_blobs')
+
+# Messages whose inline payload would be larger than this many bytes use the
+# claim check; 0 keeps every payload inline
+CLAIM_CHECK_BYTES = int(os.getenv('CLAIM_CHECK_BYTES', str(256 * 1024)))
+
+# The consumer deletes a blob once its change is applied. Blobs left behind
+# (discarded changes, messages still retrying or parked) are removed after
+# this long, whether or not a queued message still refers to them: such a
+# message then syncs its whole table instead of applying the delta.
+CLAIM_CHECK_TTL_SECONDS = int(os.getenv('CLAIM_CHECK_TTL_SECONDS', '86400'))
+
+BLOB_REF_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlobStore:
+    def __init__(self, directory=CLAIM_CHECK_DIR, ttl=CLAIM_CHECK_TTL_SECONDS):
+        self.directory = directory
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.last_pruned = 0.0
+
+    def path(self, ref):
+        if not BLOB_REF_PATTERN.match(ref):
+            raise ValueError(f"Invalid blob reference {ref!r}")
+        return os.path.join(self.directory, ref)
+
+    # Written to a temporary file first and renamed into place, so a reader
+    # never sees half a blob
+    def put(self, data):
+        ref = hashlib.sha256(data).hexdigest()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(ref)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as blob:
+            blob.write(data)
+        os.replace(temporary, path)
+        self.prune_if_due()
+        return ref
+
+    # Raises KeyError when the blob is gone (pruned, or written on another host)
+    def get(self, ref):
+        try:
+            with open(self.path(ref), 'rb') as blob:
+                return blob.read()
+        except FileNotFoundError:
+            raise KeyError(ref) from None
+
+    def delete(self, ref):
+        try:
+            os.remove(self.path(ref))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, now=None):
+        cutoff = (now or time.time()) - self.ttl
+        removed = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logging.info(f"Pruned {removed} expired blobs from {self.directory}")
+        return removed
+
+    # At most one directory scan per tenth of the TTL
+    def prune_if_due(self):
+        now = time.time()
+        with self.lock:
+            if now - self.last_pruned < self.ttl / 10:
+                return
+            self.last_pruned = now
+        self.prune(now)
+
+
+blob_store = BlobStore()
@@ -0,0 +1,144 @@
+import logging
+import os
+import tempfile
+import time
+
+# Rows sent per multi-row INSERT; each chunk is committed as its own transaction
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '1000'))
+
+# LOAD DATA LOCAL INFILE is only used for first-time loads of at least this many
+# rows, and only when enabled (the server must also have local_infile=ON)
+USE_LOAD_DATA_INFILE = os.getenv('USE_LOAD_DATA_INFILE', '0') == '1'
+LOAD_DATA_INFILE_THRESHOLD = int(os.getenv('LOAD_DATA_INFILE_THRESHOLD', '50000'))
+
+
+def quote_identifier(name):
+    return '`' + str(name).replace('`', '``') + '`'
+
+
+# Split any iterable of rows into lists of at most `size` rows
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Sheet rows can be shorter or longer than the header row; pad/trim to fit
+def normalize_row(row, width):
+    row = list(row[:width])
+    return row + [''] * (width - len(row))
+
+
+def build_upsert_sql(table, headers, row_count):
+    columns = ', '.join(quote_identifier(header) for header in headers)
+    row_placeholder = '(' + ', '.join(['%s'] * len(headers)) + ')'
+    updates = ', '.join(f'{quote_identifier(header)}=VALUES({quote_identifier(header)})' for header in headers)
+    return (
+        f"INSERT INTO {quote_identifier(table)} ({columns}) "
+        f"VALUES {', '.join([row_placeholder] * row_count)} "
+        f"ON DUPLICATE KEY UPDATE {updates}"
+    )
+
+
+def table_is_empty(cursor, table):
+    cursor.execute(f"SELECT 1 FROM {quote_identifier(table)} LIMIT 1")
+    return cursor.fetchone() is None
+
+
+def report_throughput(table, method, row_count, started):
+    elapsed = time.perf_counter() - started
+    rows_per_second = row_count / elapsed if elapsed > 0 else float(row_count)
+    logging.info(f"Wrote {row_count} rows to '{table}' via {method} in {elapsed:.2f}s ({rows_per_second:.0f} rows/sec)")
+    return {'rows': row_count, 'seconds': elapsed, 'rows_per_second': rows_per_second}
+
+
+# Pad/trim a chunk of sheet rows and, when the table has typed columns, convert
+# the values (widening any column a value doesn't fit)
+def prepare_chunk(cursor, headers, chunk, column_types=None):
+    chunk = [normalize_row(row, len(headers)) for row in chunk]
+    if column_types is not None:
+        chunk = column_types.convert_rows(cursor, headers, chunk)
+    return chunk
+
+
+# Parameterized multi-row upsert: one round-trip and one commit per chunk
+# instead of one INSERT per sheet row
+def bulk_upsert(connection, table, headers, rows, chunk_size=BULK_CHUNK_SIZE, column_types=None):
+    started = time.perf_counter()
+    written = 0
+    cursor = connection.cursor()
+
+    try:
+        for chunk in chunked(rows, chunk_size):
+            params = []
+            for row in prepare_chunk(cursor, headers, chunk, column_types):
+                params.extend(row)
+
+            try:
+                cursor.execute(build_upsert_sql(table, headers, len(chunk)), params)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            written += len(chunk)
+    finally:
+        cursor.close()
+
+    return report_throughput(table, f'bulk upsert (chunk size {chunk_size})', written, started)
+
+
+# Every field is enclosed in double quotes except None, which is written as a
+# bare NULL so LOAD DATA stores SQL NULL rather than the string 'NULL'
+def infile_line(row):
+    return ','.join('NULL' if value is None else '"' + str(value).replace('"', '""') + '"' for value in row) + '\n'
+
+
+# Fast path for large first-time loads: stream rows to a temporary CSV file and
+# let the server ingest it in a single statement. Requires allow_local_infile.
+def load_data_infile(connection, table, headers, rows, column_types=None):
+    started = time.perf_counter()
+    written = 0
+    cursor = connection.cursor()
+    csv_file = tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', encoding='utf-8', delete=False)
+
+    try:
+        with csv_file:
+            for chunk in chunked(rows, BULK_CHUNK_SIZE):
+                for row in prepare_chunk(cursor, headers, chunk, column_types):
+                    csv_file.write(infile_line(row))
+                written += len(chunk)
+
+        columns = ', '.join(quote_identifier(header) for header in headers)
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {quote_identifier(table)} "
+            f"CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY ',' ENCLOSED BY '\"' ESCAPED BY '' "
+            f"LINES TERMINATED BY '\\n' ({columns})",
+            (csv_file.name,)
+        )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        os.remove(csv_file.name)
+
+    return report_throughput(table, 'LOAD DATA LOCAL INFILE', written, started)
+
+
+# Pick the write path for sheet rows. `rows` may be any iterable, e.g. a
+# streaming sheet reader; pass `expected_rows` when it has no len().
+# `column_types` (a type_inference.ColumnTypes) converts sheet strings for
+# typed columns; without it values are written as-is.
+def write_rows(connection, table, headers, rows, first_load=False, expected_rows=None, column_types=None):
+    if expected_rows is None:
+        expected_rows = len(rows)
+    if first_load and USE_LOAD_DATA_INFILE and expected_rows >= LOAD_DATA_INFILE_THRESHOLD:
+        return load_data_infile(connection, table, headers, rows, column_types)
+    return bulk_upsert(connection, table, headers, rows, column_types=column_types)
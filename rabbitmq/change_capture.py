@@ -0,0 +1,149 @@
+from bulk_writer import quote_identifier
+
+# Bookkeeping columns added to every synced table. They are never written to
+# the sheet and never compared when fingerprinting rows.
+TRACKING_COLUMNS = ('row_version', 'updated_at')
+
+VERSIONS_TABLE = '_sync_versions'
+TOMBSTONES_TABLE = '_sync_tombstones'
+
+# A session that sets this user variable writes without bumping the version
+# counter (the backfill workers, see backfill.py), so parallel writers don't
+# all queue on the table's one counter row
+SKIP_VERSION_VARIABLE = '@sync_skip_version'
+
+# Watermark used for a table that has never been polled, so the first poll
+# picks up rows that existed before tracking was added (row_version = 0)
+INITIAL_WATERMARK = -1
+
+
+def is_internal_table(table_name):
+    return table_name.startswith('_sync_')
+
+
+def user_columns(columns):
+    return [column for column in columns if column not in TRACKING_COLUMNS]
+
+
+def sql_string(value):
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "''") + "'"
+
+
+def trigger_name(table_name, suffix):
+    return quote_identifier(f'{table_name[:50]}_sync_{suffix}')
+
+
+def create_tracking_tables(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+        table_name VARCHAR(64) PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TOMBSTONES_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        row_version BIGINT NOT NULL,
+        row_id INT NOT NULL,
+        PRIMARY KEY (table_name, row_version)
+    )
+    """)
+
+
+# Add row_version/updated_at and the triggers that maintain them. Every insert,
+# update and delete bumps the table's counter in _sync_versions; because that
+# counter row stays locked until the writer commits, versions become visible in
+# order and a reader can never skip past a version that commits late.
+# Returns True if it had to change the schema.
+def ensure_change_tracking(cursor, table_name, existing_columns):
+    if all(column in existing_columns for column in TRACKING_COLUMNS):
+        return False
+
+    create_tracking_tables(cursor)
+    cursor.execute(f"INSERT IGNORE INTO {VERSIONS_TABLE} (table_name) VALUES (%s)", (table_name,))
+    cursor.execute(f"""
+    ALTER TABLE {quote_identifier(table_name)}
+        ADD COLUMN row_version BIGINT NOT NULL DEFAULT 0,
+        ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+        ADD INDEX idx_row_version (row_version)
+    """)
+    create_change_triggers(cursor, table_name)
+    return True
+
+
+# (Re)create the triggers behind ensure_change_tracking(). Inserts and updates
+# from a session that set SKIP_VERSION_VARIABLE keep the row's old version.
+def create_change_triggers(cursor, table_name):
+    table = quote_identifier(table_name)
+    name = sql_string(table_name)
+    bump_statement = f"UPDATE {VERSIONS_TABLE} SET version = version + 1 WHERE table_name = {name};"
+
+    for suffix, timing in (('bi', 'BEFORE INSERT'), ('bu', 'BEFORE UPDATE')):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger_name(table_name, suffix)}")
+        cursor.execute(f"""
+        CREATE TRIGGER {trigger_name(table_name, suffix)} {timing} ON {table} FOR EACH ROW
+        BEGIN
+            IF {SKIP_VERSION_VARIABLE} IS NULL THEN
+                {bump_statement}
+                SET NEW.row_version = (SELECT version FROM {VERSIONS_TABLE} WHERE table_name = {name});
+            END IF;
+        END
+        """)
+
+    # Deletes leave no row behind, so they are recorded as tombstones
+    cursor.execute(f"DROP TRIGGER IF EXISTS {trigger_name(table_name, 'ad')}")
+    cursor.execute(f"""
+    CREATE TRIGGER {trigger_name(table_name, 'ad')} AFTER DELETE ON {table} FOR EACH ROW
+    BEGIN
+        {bump_statement}
+        INSERT INTO {TOMBSTONES_TABLE} (table_name, row_version, row_id)
+        SELECT table_name, version, OLD.id FROM {VERSIONS_TABLE} WHERE table_name = {name};
+    END
+    """)
+
+
+# One bump for writes made with the counter skipped, so pollers see the table moved
+def bump_version(cursor, table_name):
+    cursor.execute(f"UPDATE {VERSIONS_TABLE} SET version = version + 1 WHERE table_name = %s", (table_name,))
+
+
+# Single primary-key lookup; a quiet table costs nothing beyond this per poll
+def current_version(cursor, table_name):
+    cursor.execute(f"SELECT version FROM {VERSIONS_TABLE} WHERE table_name = %s", (table_name,))
+    row = cursor.fetchone()
+    return row[0] if row else INITIAL_WATERMARK
+
+
+# Rows and deletions above the watermark, using the row_version index. Returns
+# (headers, rows, times, deleted ids, new watermark); rows exclude the tracking
+# columns and times holds each row's updated_at as Unix time.
+# `version` is the counter read by current_version in the same transaction.
+def fetch_changes(cursor, table_name, columns, watermark, version):
+    headers = user_columns(columns)
+
+    columns = ', '.join(quote_identifier(header) for header in headers)
+    cursor.execute(
+        f"SELECT {columns}, UNIX_TIMESTAMP(updated_at) FROM {quote_identifier(table_name)} "
+        f"WHERE row_version > %s ORDER BY row_version",
+        (watermark,)
+    )
+    rows, times = [], []
+    for row in cursor:
+        rows.append(list(row[:-1]))
+        times.append(float(row[-1]) if row[-1] is not None else None)
+
+    cursor.execute(
+        f"SELECT row_id FROM {TOMBSTONES_TABLE} WHERE table_name = %s AND row_version > %s",
+        (table_name, watermark)
+    )
+    deleted_ids = [row[0] for row in cursor.fetchall()]
+
+    return headers, rows, times, deleted_ids, max(watermark, version)
+
+
+# Tombstones at or below the watermark have been published and can go
+def prune_tombstones(cursor, table_name, watermark):
+    cursor.execute(
+        f"DELETE FROM {TOMBSTONES_TABLE} WHERE table_name = %s AND row_version <= %s",
+        (table_name, watermark)
+    )
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+
+# How long a sync waits after the first message for the same table so that a
+# burst of changes collapses into one sync
+COALESCE_WINDOW_SECONDS = float(os.getenv('COALESCE_WINDOW_SECONDS', '0.5'))
+
+
+# Union of two change sets, keeping first-seen order and dropping duplicates.
+# A merged change counts as detected when the earlier of the two was.
+def merge_change_sets(base, extra):
+    merged = {}
+    for field in ('inserted', 'updated', 'deleted'):
+        keys = list(base[field])
+        seen = set(keys)
+        for key in extra[field]:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        merged[field] = keys
+    if base.get('detected_at') and extra.get('detected_at'):
+        merged['detected_at'] = min(base['detected_at'], extra['detected_at'])
+    return {**base, **merged}
+
+
+# Fold two deltas for the same table into one, later rows and deletes winning.
+# Only done when both came from the same side and the second picks up at the
+# version the first ended at; otherwise there is no merged delta (None) and the
+# consumer reads both sides in full.
+def merge_deltas(base, extra):
+    first, second = base.get('delta'), extra.get('delta')
+    if first is None or second is None or base['source'] != extra['source'] or first['headers'] != second['headers']:
+        return None
+    if base.get('version') is None or extra.get('base_version') != base['version']:
+        return None
+
+    with_times = 'times' in first and 'times' in second
+    rows, deleted = {}, {}
+    for delta in (first, second):
+        for position, (key, cells) in enumerate(delta['rows']):
+            rows[key] = (cells, delta['times'][position] if with_times else None)
+            deleted.pop(key, None)
+        for key in delta['deleted']:
+            rows.pop(key, None)
+            deleted[key] = True
+
+    merged = {'headers': first['headers'], 'rows': [[key, cells] for key, (cells, _) in rows.items()], 'deleted': list(deleted)}
+    if with_times:
+        merged['times'] = [updated for _, updated in rows.values()]
+    return merged
+
+
+# Fold one poll's [(table, source, change set), ...] into one (source, change
+# set) per table. A table that changed on both sides becomes a single 'both'
+# change, so the consumer merges the two in one pass instead of racing a sheet
+# sync against a db sync.
+def group_by_table(changes):
+    grouped = {}
+    for table, source, change_set in changes:
+        if table in grouped:
+            _, other_set = grouped[table]
+            grouped[table] = ('both', merge_change_sets(other_set, change_set))
+        else:
+            grouped[table] = (source, change_set)
+    return grouped
+
+
+class PendingSync:
+    def __init__(self, change):
+        self.change = change
+        self.first_seen = time.monotonic()
+        self.settle_callbacks = []
+        self.delta_refs = []  # claim-checked deltas of every message folded in
+
+
+# Collapses messages for the same table that arrive while a sync for it is
+# still pending into a single sync; a sheet and a db change merge into 'both'.
+# A message that arrives once the sync has started opens a new pending entry,
+# so nothing is lost. A table has at most one sync running: the entry opened
+# meanwhile is only handed out by done() once that sync has finished, so the
+# syncs of a table run in the order their messages arrived.
+class Coalescer:
+    def __init__(self, window=COALESCE_WINDOW_SECONDS):
+        self.window = window
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = {}
+        self.running = set()
+        self.closing = False
+
+    # Returns True if the caller has to schedule take() for the table: this
+    # change opened a pending sync and none is running for the table. Otherwise
+    # it was merged into one already queued, or waits for done().
+    def add(self, change, settle_callback):
+        key = change['table']
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = self.pending[key] = PendingSync(change)
+                is_new = key not in self.running
+            elif 'backfill' in (pending.change['source'], change['source']):
+                # A backfill ends with a full reconcile, which covers any other change
+                if change['source'] == 'backfill':
+                    pending.change = change
+                is_new = False
+            else:
+                source = pending.change['source'] if pending.change['source'] == change['source'] else 'both'
+                merged = {**merge_change_sets(pending.change, change), 'source': source}
+                delta = merge_deltas(pending.change, change)
+                merged.pop('delta', None)
+                if delta is not None:
+                    merged.update(delta=delta, version=change['version'])
+                if change.get('retried'):
+                    merged['retried'] = True
+                pending.change = merged
+                is_new = False
+            pending.settle_callbacks.append(settle_callback)
+            if change.get('delta_ref'):
+                pending.delta_refs.append(change['delta_ref'])
+        return is_new
+
+    # Wait out the rest of the window (cut short by close()), then claim the
+    # merged change and the callbacks of every message folded into it. The
+    # change's delta_refs lists the blobs of all those messages, including
+    # deltas dropped by the merge, so they can all be deleted once it is
+    # applied. The table counts as running until done() is called for it.
+    def take(self, key):
+        with self.wakeup:
+            while not self.closing:
+                remaining = self.window - (time.monotonic() - self.pending[key].first_seen)
+                if remaining <= 0:
+                    break
+                self.wakeup.wait(remaining)
+            pending = self.pending.pop(key)
+            self.running.add(key)
+        return {**pending.change, 'delta_refs': pending.delta_refs}, pending.settle_callbacks
+
+    # The table's sync has finished. Returns True if a change for it arrived
+    # meanwhile and the caller has to schedule take() for it; never once closing,
+    # as the deliveries behind it are requeued by the broker on disconnect.
+    def done(self, key):
+        with self.lock:
+            self.running.discard(key)
+            return key in self.pending and not self.closing
+
+    # Stop waiting out windows and handing out further syncs, for shutdown
+    def close(self):
+        with self.wakeup:
+            self.closing = True
+            self.wakeup.notify_all()
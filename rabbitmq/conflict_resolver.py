@@ -0,0 +1,629 @@
+import importlib
+import json
+import logging
+import os
+
+from bulk_writer import BULK_CHUNK_SIZE, bulk_upsert, chunked, normalize_row, quote_identifier
+from row_index import has_changes
+from row_identity import (
+    DB_ONLY_COLUMNS, ROW_ID_COLUMN, SheetRowKeys, assign_missing_row_ids, cell_is_blank, create_identity_tables,
+    delete_rows_by_key, is_row_id, key_columns, remember_sheet_keys, row_key, store_sheet_keys, uses_row_ids
+)
+from schema import create_or_update_table, table_column_types
+from sheet_reader import iter_sheet_rows
+from sheet_writer import row_block_updates, snapshot_cache
+from sheets_api import call_sheets
+from telemetry import rows_read, rows_written, stage
+from type_inference import TYPE_SAMPLE_ROWS, canonical_value, parse_table_columns
+
+# How a cell edited differently on both sides since the last sync is settled:
+#   lww           the side written last wins (MySQL's updated_at vs the time
+#                 a sheet delta's row was read changed); a conflict with no
+#                 row-level sheet time falls back to prefer_db
+#   prefer_sheet  the sheet always wins
+#   prefer_db     MySQL always wins
+#   callback      CONFLICT_CALLBACK ("package.module:function") decides
+# CONFLICT_POLICIES overrides the default per table, e.g. "orders:prefer_db".
+CONFLICT_POLICY = os.getenv('CONFLICT_POLICY', 'lww')
+CONFLICT_POLICIES = {
+    table: policies[0] for table, policies in parse_table_columns(os.getenv('CONFLICT_POLICIES', '')).items() if policies
+}
+CONFLICT_CALLBACK = os.getenv('CONFLICT_CALLBACK')
+POLICIES = ('lww', 'prefer_sheet', 'prefer_db', 'callback')
+
+# Last-synced value of every row, the common ancestor of each three-way merge
+BASE_TABLE = '_sync_base'
+# Version (MySQL watermark or Drive version) each side's changes to a table have
+# been applied up to, written in the same transaction as the base
+VERSIONS_TABLE = '_sync_versions_applied'
+
+
+def policy_for(table_name):
+    policy = CONFLICT_POLICIES.get(table_name, CONFLICT_POLICY)
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown conflict policy '{policy}' for '{table_name}'")
+    return policy
+
+
+callbacks = {}
+
+
+def load_callback(path=None):
+    path = path or CONFLICT_CALLBACK
+    if not path:
+        raise ValueError("The 'callback' conflict policy needs CONFLICT_CALLBACK=module:function")
+    if path not in callbacks:
+        module_name, _, function_name = path.partition(':')
+        callbacks[path] = getattr(importlib.import_module(module_name), function_name)
+    return callbacks[path]
+
+
+# Settle one conflict. `conflict` carries table, key, column, base, sheet, db,
+# sheet_time and db_time (either may be None). For a cell conflict the values
+# are cell texts and the chosen text is returned. When a row was deleted on one
+# side and edited on the other, column is None, the values are row dicts (None
+# for the deleted side) and returning None deletes the row.
+def resolve(conflict, policy, callback=None):
+    if policy == 'prefer_sheet':
+        return conflict['sheet']
+    if policy == 'prefer_db':
+        return conflict['db']
+    if policy == 'callback':
+        return (callback or load_callback())(conflict)
+
+    # Last write wins. Only sheet deltas carry row-level sheet times; without
+    # one there is nothing to compare, so MySQL wins. A MySQL row with no
+    # timestamp (a delete) loses to a timed sheet edit.
+    if conflict['sheet_time'] is None:
+        return conflict['db']
+    if conflict['db_time'] is None:
+        return conflict['sheet']
+    return conflict['sheet'] if conflict['sheet_time'] >= conflict['db_time'] else conflict['db']
+
+
+def rows_equal(left, right, columns):
+    return all(left.get(column, '') == right.get(column, '') for column in columns)
+
+
+# Three-way merge of one table, keyed by row key. Each side is {key: {column:
+# canonical text}}. Cells changed on one side only take that side's value, and
+# cells changed identically on both need nothing; everything else goes through
+# resolve(). Returns the deltas to write to each side plus the new base.
+def merge_tables(table_name, columns, base_rows, sheet_rows, db_rows, sheet_times, db_times, policy, callback=None):
+    plan = {
+        'sheet_upserts': {},  # key -> merged row, for rows the sheet lacks or differs on
+        'sheet_deletes': set(),
+        'db_upserts': {},
+        'db_deletes': set(),
+        'base': {},  # key -> merged row, for every row that still exists
+        'conflicts': 0,
+    }
+
+    def conflict(key, column, base, sheet, db):
+        plan['conflicts'] += 1
+        return resolve({
+            'table': table_name, 'key': key, 'column': column, 'base': base, 'sheet': sheet, 'db': db,
+            'sheet_time': sheet_times.get(key), 'db_time': db_times.get(key),
+        }, policy, callback)
+
+    for key in list(sheet_rows) + [key for key in db_rows if key not in sheet_rows]:
+        base, sheet, db = base_rows.get(key), sheet_rows.get(key), db_rows.get(key)
+
+        if sheet is not None and db is not None:
+            merged = {}
+            for column in columns:
+                base_value = base.get(column) if base is not None else None
+                sheet_value, db_value = sheet.get(column, ''), db.get(column, '')
+                if sheet_value == db_value or db_value == base_value:
+                    merged[column] = sheet_value
+                elif sheet_value == base_value:
+                    merged[column] = db_value
+                else:
+                    merged[column] = conflict(key, column, base_value, sheet_value, db_value)
+        else:
+            present = sheet if sheet is not None else db
+            if base is None:
+                merged = present  # new on one side
+            elif rows_equal(present, base, columns):
+                merged = None  # deleted on the other side, untouched here
+            else:
+                merged = conflict(key, None, base, sheet, db)
+
+        if merged is None:
+            if sheet is not None:
+                plan['sheet_deletes'].add(key)
+            if db is not None:
+                plan['db_deletes'].add(key)
+            continue
+
+        if sheet is None or not rows_equal(merged, sheet, columns):
+            plan['sheet_upserts'][key] = merged
+        if db is None or not rows_equal(merged, db, columns):
+            plan['db_upserts'][key] = merged
+        plan['base'][key] = merged
+
+    return plan
+
+
+def create_base_table(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {BASE_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        row_key CHAR(32) CHARACTER SET ascii NOT NULL,
+        cells MEDIUMTEXT NOT NULL,
+        PRIMARY KEY (table_name, row_key)
+    )
+    """)
+
+
+def has_base(cursor, table_name):
+    create_base_table(cursor)
+    cursor.execute(f"SELECT 1 FROM {BASE_TABLE} WHERE table_name = %s LIMIT 1", (table_name,))
+    return cursor.fetchone() is not None
+
+
+def create_versions_table(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        source VARCHAR(8) NOT NULL,
+        version VARCHAR(64) NOT NULL,
+        PRIMARY KEY (table_name, source)
+    )
+    """)
+
+
+def applied_version(cursor, table_name, source):
+    create_versions_table(cursor)
+    cursor.execute(f"SELECT version FROM {VERSIONS_TABLE} WHERE table_name = %s AND source = %s", (table_name, source))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Whether `version` comes before `other`. Watermarks and Drive versions are
+# numbers (stored as text); Drive's modifiedTime fallback is an ISO timestamp.
+def version_before(version, other):
+    try:
+        return int(version) < int(other)
+    except (TypeError, ValueError):
+        return str(version) < str(other)
+
+
+# Move a side's applied version forward, never back: a late retry of an older
+# change doesn't undo the record of newer ones
+def store_applied_version(cursor, table_name, source, version):
+    if version is None or source not in ('sheet', 'db'):
+        return
+    applied = applied_version(cursor, table_name, source)
+    if applied is None or version_before(applied, version):
+        cursor.execute(
+            f"INSERT INTO {VERSIONS_TABLE} (table_name, source, version) VALUES (%s, %s, %s) "
+            f"ON DUPLICATE KEY UPDATE version = VALUES(version)",
+            (table_name, source, str(version))
+        )
+
+
+# Whether a change's delta can be merged as it is. A redelivered or retried
+# message may already have been applied, in part, and a delta whose base_version
+# is behind the side's applied version predates changes merged since; applying
+# either would put older rows over newer ones, so they go to reconcile(), which
+# reads the rows as they are now.
+def delta_is_current(cursor, change):
+    if change.get('retried'):
+        return False
+    base_version = change.get('base_version')
+    if base_version is None:
+        return True
+    applied = applied_version(cursor, change['table'], change['source'])
+    return applied is None or not version_before(base_version, applied)
+
+
+# The whole table's base, or only the rows with the given keys
+def load_base(cursor, table_name, keys=None):
+    if keys is None:
+        cursor.execute(f"SELECT row_key, cells FROM {BASE_TABLE} WHERE table_name = %s", (table_name,))
+        return {key: json.loads(cells) for key, cells in cursor.fetchall()}
+
+    base = {}
+    for chunk in chunked(sorted(keys), BULK_CHUNK_SIZE):
+        cursor.execute(
+            f"SELECT row_key, cells FROM {BASE_TABLE} WHERE table_name = %s AND row_key IN ({', '.join(['%s'] * len(chunk))})",
+            [table_name] + chunk
+        )
+        base.update((key, json.loads(cells)) for key, cells in cursor.fetchall())
+    return base
+
+
+# Write only the base rows that changed and drop the ones that no longer exist.
+# A backfill stages its rows in a copy of the table (`base_table`) until it finishes.
+def store_base(cursor, table_name, old_base, new_base, base_table=BASE_TABLE):
+    changed = [(key, row) for key, row in new_base.items() if old_base.get(key) != row]
+    removed = sorted(key for key in old_base if key not in new_base)
+
+    for chunk in chunked(changed, BULK_CHUNK_SIZE):
+        cursor.execute(
+            f"INSERT INTO {base_table} (table_name, row_key, cells) VALUES {', '.join(['(%s, %s, %s)'] * len(chunk))} "
+            f"ON DUPLICATE KEY UPDATE cells = VALUES(cells)",
+            [value for key, row in chunk for value in (table_name, key, json.dumps(row))]
+        )
+    for chunk in chunked(removed, BULK_CHUNK_SIZE):
+        cursor.execute(
+            f"DELETE FROM {base_table} WHERE table_name = %s AND row_key IN ({', '.join(['%s'] * len(chunk))})",
+            [table_name] + chunk
+        )
+
+
+# Canonical rows and last-modified times of every row in the table, or only of
+# the rows with the given keys (looked up by _row_id; natural keys are digests,
+# so those tables are still scanned)
+def read_db_rows(cursor, table_name, columns, column_types, keys=None):
+    assign_missing_row_ids(cursor, table_name)
+    selected = list(dict.fromkeys(columns + key_columns(table_name)))
+    select = (
+        f"SELECT {', '.join(quote_identifier(column) for column in selected)}, UNIX_TIMESTAMP(updated_at) "
+        f"FROM {quote_identifier(table_name)}"
+    )
+    if keys is not None and uses_row_ids(table_name):
+        records = []
+        for chunk in chunked(sorted(keys), BULK_CHUNK_SIZE):
+            cursor.execute(
+                f"{select} WHERE {quote_identifier(ROW_ID_COLUMN)} IN ({', '.join(['%s'] * len(chunk))})", chunk
+            )
+            records.extend(cursor.fetchall())
+    else:
+        cursor.execute(select)
+        records = cursor.fetchall()
+
+    rows, times = {}, {}
+    for record in records:
+        values = dict(zip(selected, record))
+        key = row_key(table_name, [values[column] for column in key_columns(table_name)])
+        if keys is not None and key not in keys:
+            continue
+        rows[key] = {column: canonical_value(values[column], column_types.get(column)) for column in columns}
+        times[key] = float(record[-1]) if record[-1] is not None else None
+    return rows, times
+
+
+# Cells as they go to the sheet: integers as numbers, everything else as text
+def sheet_cell(value, inferred):
+    if value != '' and inferred is not None and inferred[0] in ('int', 'bigint'):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return value
+
+
+# Write the merged deltas to the sheet: changed rows in place, new rows after
+# the last one, and deleted rows removed bottom-up so row numbers stay valid
+def apply_sheet_changes(sheet, keys, upserts, deletes, column_types):
+    headers = keys.headers
+    table_name = sheet.title
+    next_row = keys.last_row_number + 1
+    rows = []
+    for key, merged in upserts.items():
+        values = dict(merged)
+        if uses_row_ids(table_name):
+            values[ROW_ID_COLUMN] = key
+        row_number = keys.row_numbers.get(key)
+        if row_number is None:
+            row_number, next_row = next_row, next_row + 1
+        rows.append((row_number, [sheet_cell(values.get(header, ''), column_types.get(header)) for header in headers]))
+
+    if rows:
+        if next_row - 1 > sheet.row_count:
+            call_sheets('write', sheet.add_rows, next_row - 1 - sheet.row_count)
+        call_sheets('write', sheet.batch_update, row_block_updates(rows))
+
+    if deletes:
+        requests = [
+            {'deleteDimension': {'range': {
+                'sheetId': sheet.id, 'dimension': 'ROWS', 'startIndex': row_number - 1, 'endIndex': row_number,
+            }}}
+            for row_number in sorted((keys.row_numbers[key] for key in deletes), reverse=True)
+        ]
+        call_sheets('write', sheet.spreadsheet.batch_update, {'requests': requests})
+
+    if rows or deletes:
+        snapshot_cache.invalidate(sheet)
+
+
+def apply_db_changes(connection, table_name, columns, upserts, deletes, column_types):
+    if upserts:
+        headers = columns + ([ROW_ID_COLUMN] if uses_row_ids(table_name) else [])
+        rows = [
+            [merged[column] for column in columns] + ([key] if uses_row_ids(table_name) else [])
+            for key, merged in upserts.items()
+        ]
+        bulk_upsert(connection, table_name, headers, rows, column_types=column_types)
+
+    if deletes:
+        cursor = connection.cursor()
+        try:
+            delete_rows_by_key(cursor, table_name, deletes)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+# Sync keys a change can have touched: the sync keys it names, the rows behind
+# the MySQL ids it names, and, when it deleted MySQL rows (tombstones only carry
+# the id), every key in the sheet that MySQL no longer has. Integer keys from
+# the sheet are positions of rows without a key yet, which get one (and are
+# added to the scope) while the sheet is read.
+def change_scope(cursor, table_name, change, sheet_keys):
+    scope = {key for key in change['inserted'] + change['updated'] + change['deleted'] if isinstance(key, str)}
+    if change['source'] == 'sheet':
+        return scope
+
+    assign_missing_row_ids(cursor, table_name)
+    table = quote_identifier(table_name)
+    selected = ', '.join(quote_identifier(column) for column in key_columns(table_name))
+    ids = sorted({key for key in change['inserted'] + change['updated'] if isinstance(key, int)})
+    for chunk in chunked(ids, BULK_CHUNK_SIZE):
+        cursor.execute(f"SELECT {selected} FROM {table} WHERE id IN ({', '.join(['%s'] * len(chunk))})", chunk)
+        scope.update(row_key(table_name, list(record)) for record in cursor.fetchall())
+    if any(isinstance(key, int) for key in change['deleted']):
+        cursor.execute(f"SELECT {selected} FROM {table}")
+        present = {row_key(table_name, list(record)) for record in cursor.fetchall()}
+        scope.update(key for key in sheet_keys if key not in present)
+    return scope
+
+
+# Bring a sheet and its table together with a three-way merge against the base
+# left by the previous sync, writing only the merged deltas to each side.
+# A full read has no row-level sheet times, so lww conflicts go to MySQL. With the
+# `change` that led here, MySQL and the base are only read for the keys it can
+# have touched (see change_scope()); the sheet is always read in full, as rows
+# can't be looked up in it by key. Without one (or with an empty change set,
+# as legacy messages have) the whole table is merged. Returns the merge plan,
+# or None if the sheet has no header row.
+def reconcile(sheet, connection, policy=None, callback=None, change=None):
+    rows = iter_sheet_rows(sheet)
+    headers = next(rows, None)
+    if not headers:
+        return None
+
+    table_name = sheet.title
+    policy = policy or policy_for(table_name)
+    with stage('consumer', 'read_sheet', table=table_name):
+        keys = SheetRowKeys(sheet, headers)
+        sheet_values = list(keys.rows(rows))
+        keys.write_back()
+    rows_read.inc(len(sheet_values), table=table_name, source='sheet')
+
+    cursor = connection.cursor()
+    try:
+        # New sheet columns are added (and typed) before anything is compared
+        create_or_update_table(cursor, table_name, keys.write_headers, sheet_values[:TYPE_SAMPLE_ROWS])
+        column_types = table_column_types(cursor, table_name)
+        types = column_types.types
+        columns = [column for column in keys.write_headers if column != ROW_ID_COLUMN and column in types]
+
+        with stage('consumer', 'read_db', table=table_name):
+            scope = None
+            if change is not None and has_changes(change) and not keys.added_id_column:
+                scope = change_scope(cursor, table_name, change, keys.row_numbers)
+                scope.update(row_id for _, row_id in keys.new_ids)
+            db_rows, db_times = read_db_rows(cursor, table_name, columns, types, scope)
+            base_rows = load_base(cursor, table_name, scope)
+        connection.commit()
+    finally:
+        cursor.close()
+    rows_read.inc(len(db_rows), table=table_name, source='db')
+
+    key_positions = [keys.write_headers.index(column) for column in key_columns(table_name)]
+    sheet_rows = {}
+    for row in sheet_values:
+        key = row_key(table_name, [row[position] for position in key_positions])
+        if scope is None or key in scope:
+            values = dict(zip(keys.write_headers, row))
+            sheet_rows[key] = {column: canonical_value(values[column], types.get(column)) for column in columns}
+
+    with stage('consumer', 'merge', table=table_name):
+        plan = merge_tables(table_name, columns, base_rows, sheet_rows, db_rows, {}, db_times, policy, callback)
+
+    with stage('consumer', 'write_db', table=table_name):
+        apply_db_changes(connection, table_name, columns, plan['db_upserts'], plan['db_deletes'], column_types)
+    rows_written.inc(len(plan['db_upserts']) + len(plan['db_deletes']), table=table_name, target='db')
+    with stage('consumer', 'write_sheet', table=table_name):
+        apply_sheet_changes(sheet, keys, plan['sheet_upserts'], plan['sheet_deletes'], types)
+    rows_written.inc(len(plan['sheet_upserts']) + len(plan['sheet_deletes']), table=table_name, target='sheet')
+
+    # Both sides were read as they are now, so the change is applied up to its version
+    source, version = (change['source'], change.get('version')) if change is not None else (None, None)
+    if scope is not None:
+        store_delta_base(connection, table_name, scope, base_rows, plan, source, version)
+    else:
+        cursor = connection.cursor()
+        try:
+            with stage('consumer', 'store_base', table=table_name):
+                store_base(cursor, table_name, base_rows, plan['base'])
+                remember_sheet_keys(cursor, table_name, plan['base'].keys())
+                store_applied_version(cursor, table_name, source, version)
+                connection.commit()
+        finally:
+            cursor.close()
+
+    logging.info(
+        f"Merged '{table_name}' ({policy}): {len(plan['db_upserts'])} upserts and {len(plan['db_deletes'])} deletes "
+        f"to MySQL, {len(plan['sheet_upserts'])} upserts and {len(plan['sheet_deletes'])} deletes to the sheet, "
+        f"{plan['conflicts']} conflicts"
+    )
+    return plan
+
+
+# Merge a change from the rows the producer put in its message instead of
+# reading the side it came from again. Only the rows the delta names are read
+# from the other side and from the base. Returns the plan, or None when the
+# delta can't be applied on its own and the caller should reconcile() the whole
+# table instead; nothing has been written by then.
+def apply_delta(sheet, connection, source, delta, policy=None, callback=None, version=None):
+    policy = policy or policy_for(sheet.title)
+    if source == 'sheet':
+        return apply_sheet_delta(sheet, connection, delta, policy, callback, version)
+    if source == 'db':
+        return apply_db_delta(sheet, connection, delta, policy, callback, version)
+    return None
+
+
+# Columns and canonical rows of a sheet-side delta, or None if any row is still
+# keyed by its position (new rows without a _row_id, or the header row), is
+# blank, or has a column MySQL doesn't have yet
+def delta_sheet_rows(table_name, delta, types):
+    headers = delta['headers']
+    if any(column not in headers for column in key_columns(table_name)):
+        return None
+    columns = [header for header in headers if header not in DB_ONLY_COLUMNS and header != ROW_ID_COLUMN]
+    if any(column not in types for column in columns):
+        return None
+
+    data_indexes = [headers.index(column) for column in columns]
+    rows = {}
+    for key, cells in delta['rows']:
+        if not isinstance(key, str) or (uses_row_ids(table_name) and not is_row_id(key)):
+            return None
+        cells = normalize_row(cells, len(headers))
+        if all(cell_is_blank(cells[index]) for index in data_indexes):
+            return None
+        rows[key] = {column: canonical_value(cells[index], types.get(column)) for column, index in zip(columns, data_indexes)}
+    return columns, rows
+
+
+# Sheet -> MySQL: the sheet isn't read at all. If the merge has to write back
+# to the sheet (a conflict MySQL won, a row deleted in the sheet but edited in
+# MySQL) that needs the sheet's row positions, so it is left to reconcile().
+def apply_sheet_delta(sheet, connection, delta, policy, callback, version=None):
+    table_name = sheet.title
+    if not all(isinstance(key, str) for key in delta['deleted']):
+        return None
+
+    cursor = connection.cursor()
+    try:
+        column_types = table_column_types(cursor, table_name)
+        types = column_types.types
+        parsed = delta_sheet_rows(table_name, delta, types)
+        if parsed is None:
+            return None
+        columns, sheet_rows = parsed
+        sheet_times = dict(zip((key for key, _ in delta['rows']), delta.get('times') or []))
+        keys = set(sheet_rows) | set(delta['deleted'])
+        with stage('consumer', 'read_db', table=table_name):
+            db_rows, db_times = read_db_rows(cursor, table_name, columns, types, keys)
+            base_rows = load_base(cursor, table_name, keys)
+        connection.commit()
+    finally:
+        cursor.close()
+    rows_read.inc(len(db_rows), table=table_name, source='db')
+
+    with stage('consumer', 'merge', table=table_name):
+        plan = merge_tables(table_name, columns, base_rows, sheet_rows, db_rows, sheet_times, db_times, policy, callback)
+    if plan['sheet_upserts'] or plan['sheet_deletes']:
+        return None
+
+    with stage('consumer', 'write_db', table=table_name):
+        apply_db_changes(connection, table_name, columns, plan['db_upserts'], plan['db_deletes'], column_types)
+    rows_written.inc(len(plan['db_upserts']) + len(plan['db_deletes']), table=table_name, target='db')
+    store_delta_base(connection, table_name, keys, base_rows, plan, 'sheet', version)
+    log_delta(table_name, 'sheet', policy, plan)
+    return plan
+
+
+# MySQL -> sheet: MySQL isn't read. The sheet still is, for the row positions
+# the writes go to. Deletes are left to reconcile() because tombstones only
+# carry the numeric id, as are MySQL rows without a _row_id yet and sheets with
+# rows that still need one.
+def apply_db_delta(sheet, connection, delta, policy, callback, version=None):
+    table_name = sheet.title
+    headers = delta['headers']
+    if delta['deleted'] or any(column not in headers for column in key_columns(table_name)):
+        return None
+
+    rows = iter_sheet_rows(sheet)
+    sheet_headers = next(rows, None)
+    if not sheet_headers:
+        return None
+
+    cursor = connection.cursor()
+    try:
+        column_types = table_column_types(cursor, table_name)
+    finally:
+        cursor.close()
+    types = column_types.types
+    keys = SheetRowKeys(sheet, sheet_headers)
+    columns = [column for column in keys.write_headers if column != ROW_ID_COLUMN]
+    if any(column not in types for column in columns):
+        return None
+
+    db_rows, db_times = {}, {}
+    times = delta.get('times') or [None] * len(delta['rows'])
+    for (_, cells), updated in zip(delta['rows'], times):
+        values = dict(zip(headers, cells))
+        key_values = [values[column] for column in key_columns(table_name)]
+        if any(cell_is_blank(value) for value in key_values):
+            return None
+        key = row_key(table_name, key_values)
+        db_rows[key] = {column: canonical_value(values.get(column), types.get(column)) for column in columns}
+        db_times[key] = updated
+
+    with stage('consumer', 'read_sheet', table=table_name):
+        sheet_values = list(keys.rows(rows))
+    rows_read.inc(len(sheet_values), table=table_name, source='sheet')
+    if keys.new_ids or keys.added_id_column:
+        return None
+
+    key_positions = [keys.write_headers.index(column) for column in key_columns(table_name)]
+    sheet_rows = {}
+    for row in sheet_values:
+        key = row_key(table_name, [row[position] for position in key_positions])
+        if key in db_rows:
+            values = dict(zip(keys.write_headers, row))
+            sheet_rows[key] = {column: canonical_value(values[column], types.get(column)) for column in columns}
+
+    cursor = connection.cursor()
+    try:
+        base_rows = load_base(cursor, table_name, set(db_rows))
+        connection.commit()
+    finally:
+        cursor.close()
+
+    with stage('consumer', 'merge', table=table_name):
+        plan = merge_tables(table_name, columns, base_rows, sheet_rows, db_rows, {}, db_times, policy, callback)
+
+    with stage('consumer', 'write_db', table=table_name):
+        apply_db_changes(connection, table_name, columns, plan['db_upserts'], plan['db_deletes'], column_types)
+    rows_written.inc(len(plan['db_upserts']) + len(plan['db_deletes']), table=table_name, target='db')
+    with stage('consumer', 'write_sheet', table=table_name):
+        apply_sheet_changes(sheet, keys, plan['sheet_upserts'], plan['sheet_deletes'], types)
+    rows_written.inc(len(plan['sheet_upserts']) + len(plan['sheet_deletes']), table=table_name, target='sheet')
+    store_delta_base(connection, table_name, set(db_rows), base_rows, plan, 'db', version)
+    log_delta(table_name, 'db', policy, plan)
+    return plan
+
+
+# Base rows and stored sheet keys for just the keys a delta touched, and the
+# version the delta's side is now applied up to
+def store_delta_base(connection, table_name, keys, base_rows, plan, source=None, version=None):
+    present = set(plan['base'])
+    cursor = connection.cursor()
+    try:
+        with stage('consumer', 'store_base', table=table_name):
+            store_base(cursor, table_name, base_rows, plan['base'])
+            create_identity_tables(cursor)
+            store_sheet_keys(cursor, table_name, keys - present, present)
+            store_applied_version(cursor, table_name, source, version)
+            connection.commit()
+    finally:
+        cursor.close()
+
+
+def log_delta(table_name, source, policy, plan):
+    logging.info(
+        f"Applied {source} delta to '{table_name}' ({policy}): {len(plan['db_upserts'])} upserts and "
+        f"{len(plan['db_deletes'])} deletes to MySQL, {len(plan['sheet_upserts'])} upserts and "
+        f"{len(plan['sheet_deletes'])} deletes to the sheet, {plan['conflicts']} conflicts"
+    )
@@ -0,0 +1,214 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import gspread
+import mysql.connector.pooling
+import pika  # RabbitMQ library
+from google.auth.transport.requests import Request
+
+from sharding import SHARD_COUNT, SYNC_EXCHANGE, declare_topology, routing_key_for, shard_queue
+from sheets_api import call_sheets
+
+MYSQL_POOL_SIZE = int(os.getenv('MYSQL_POOL_SIZE', '10'))
+
+# Log pool metrics every this many checkouts
+METRICS_LOG_EVERY = int(os.getenv('POOL_METRICS_LOG_EVERY', '100'))
+
+
+# Counters shared by the pooled clients so we can see whether pooling pays off
+class ConnectionMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            'mysql_checkouts': 0,
+            'mysql_connections_created': 0,
+            'mysql_wait_seconds_total': 0.0,
+            'mysql_wait_seconds_max': 0.0,
+            'sheets_client_reuses': 0,
+            'sheets_token_refreshes': 0,
+            'amqp_publishes': 0,
+            'amqp_reconnects': 0,
+        }
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.counters['mysql_checkouts'] += 1
+            self.counters['mysql_wait_seconds_total'] += seconds
+            self.counters['mysql_wait_seconds_max'] = max(self.counters['mysql_wait_seconds_max'], seconds)
+            checkouts = self.counters['mysql_checkouts']
+        if checkouts % METRICS_LOG_EVERY == 0:
+            logging.info(f"Connection metrics: {self.snapshot()}")
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.counters)
+        checkouts = snapshot['mysql_checkouts']
+        snapshot['mysql_reuse_ratio'] = 1 - snapshot['mysql_connections_created'] / checkouts if checkouts else 0.0
+        snapshot['mysql_wait_seconds_avg'] = snapshot['mysql_wait_seconds_total'] / checkouts if checkouts else 0.0
+        return snapshot
+
+
+metrics = ConnectionMetrics()
+
+
+# mysql-connector's pool raises as soon as it's empty; the semaphore in front of
+# it makes callers wait for a free connection instead, and times that wait
+class MySQLPool:
+    def __init__(self, mysql_config, pool_size=MYSQL_POOL_SIZE, pool_name='sync_pool'):
+        self.pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name=pool_name, pool_size=pool_size, pool_reset_session=True, **mysql_config
+        )
+        self.pool_size = pool_size
+        self.slots = threading.Semaphore(pool_size)
+        self.seen_connections = set()
+        self.lock = threading.Lock()
+        self.in_use = 0
+
+    @contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        self.slots.acquire()
+        metrics.record_wait(time.perf_counter() - started)
+
+        try:
+            connection = self.pool.get_connection()
+        except Exception:
+            self.slots.release()
+            raise
+
+        # The pool reconnects a slot if its socket died, which counts as a new connection
+        with self.lock:
+            physical_id = id(connection._cnx)
+            if physical_id not in self.seen_connections:
+                self.seen_connections.add(physical_id)
+                metrics.increment('mysql_connections_created')
+
+        with self.lock:
+            self.in_use += 1
+        try:
+            yield connection
+        finally:
+            connection.close()  # returns it to the pool
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+
+# One authorized gspread client and spreadsheet handle shared by all threads.
+# Credentials are refreshed under a lock so concurrent callers don't race.
+class SharedSheetsClient:
+    def __init__(self, credentials_loader, spreadsheet_name):
+        self.credentials_loader = credentials_loader
+        self.spreadsheet_name = spreadsheet_name
+        self.lock = threading.Lock()
+        self.credentials = None
+        self.client = None
+        self.handle = None
+
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                self.credentials = self.credentials_loader()
+                self.client = gspread.authorize(self.credentials)
+                logging.info("Successfully connected to Google Sheets")
+            elif not self.credentials.valid:
+                self.credentials.refresh(Request())
+                metrics.increment('sheets_token_refreshes')
+            else:
+                metrics.increment('sheets_client_reuses')
+            return self.client
+
+    def spreadsheet(self):
+        client = self.get_client()
+        with self.lock:
+            if self.handle is None:
+                self.handle = call_sheets('read', client.open, self.spreadsheet_name)
+            return self.handle
+
+
+# Long-lived publisher connection. pika channels aren't thread-safe, so
+# publishes are serialized; a dropped connection is reopened and the publish
+# retried once. Messages are routed to the shard queue for their table.
+class Publisher:
+    def __init__(self, host, queue_base):
+        self.host = host
+        self.queue_base = queue_base
+        self.lock = threading.Lock()
+        self.connection = None
+        self.channel = None
+
+    def connect(self):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        self.channel = self.connection.channel()
+        declare_topology(self.channel, self.queue_base)
+
+    def publish(self, message, table_name):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.connection is None or self.connection.is_closed:
+                        if attempt or self.connection is not None:
+                            metrics.increment('amqp_reconnects')
+                        self.connect()
+                    self.channel.basic_publish(
+                        exchange=SYNC_EXCHANGE,
+                        routing_key=routing_key_for(table_name),
+                        body=message,
+                        properties=pika.BasicProperties(
+                            delivery_mode=2  # Make message persistent
+                        )
+                    )
+                    metrics.increment('amqp_publishes')
+                    return
+                except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError):
+                    self.close_quietly()
+                    if attempt:
+                        raise
+                    logging.warning("RabbitMQ connection lost, reconnecting")
+
+    # Service heartbeats between publishes so an idle producer isn't dropped by the broker
+    def keepalive(self):
+        with self.lock:
+            if self.connection is None or self.connection.is_closed:
+                return
+            try:
+                self.connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError:
+                self.close_quietly()
+
+    # Ready messages per shard queue, read with passive declares on the
+    # publishing channel. None when not connected.
+    def queue_depths(self):
+        with self.lock:
+            if self.connection is None or self.connection.is_closed:
+                return None
+            try:
+                return {
+                    shard_queue(self.queue_base, shard): self.channel.queue_declare(
+                        queue=shard_queue(self.queue_base, shard), passive=True
+                    ).method.message_count
+                    for shard in range(SHARD_COUNT)
+                }
+            except pika.exceptions.AMQPError:
+                self.close_quietly()
+                return None
+
+    def close_quietly(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def close(self):
+        with self.lock:
+            self.close_quietly()
@@ -5,10 +5,35 @@ from google.auth.transport.requests import Request
 import mysql.connector
 import os
 import pickle
+import signal
 import pika  # RabbitMQ library
 import threading  # To handle concurrency
+import time
+import argparse
+import functools
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import logging  # For enhanced logging
 from dotenv import load_dotenv
+from backfill import BACKFILL_THRESHOLD_ROWS, backfill_status, estimated_rows, run_backfill, sheet_has_more_rows
+from blob_store import blob_store
+from bulk_writer import USE_LOAD_DATA_INFILE, table_is_empty, write_rows
+from coalescer import Coalescer
+from conflict_resolver import apply_delta, delta_is_current, has_base, reconcile
+from connections import MySQLPool, SharedSheetsClient, metrics as connection_metrics
+from messages import decode_change
+from row_identity import ROW_ID_COLUMN, SheetRowKeys, assign_missing_row_ids, db_row_keys, remember_sheet_keys, sheet_columns
+from schema import clear_cursor_results, create_or_update_table, get_table_columns, schema_catalog, table_column_types
+from sharding import ATTEMPTS_HEADER, SHARD_COUNT, declare_topology, retry_route, shard_queue, shards_for_process
+from sheet_reader import iter_sheet_rows
+from sheet_writer import write_table
+from sheets_api import call_sheets
+from telemetry import (
+    CONSUMER_METRICS_PORT, changes_applied, consumer_lag_seconds, propagation_seconds, registry, stage,
+    start_metrics_server
+)
+from type_inference import TYPE_SAMPLE_ROWS
 
 # Setup logging for better tracking
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,37 +51,60 @@ mysql_config = {
     'host': os.getenv('MYSQL_HOST'),
     'user': os.getenv('MYSQL_USER'),
     'password': os.getenv('MYSQL_PASSWORD'),
-    'database': 'superjoin'
+    'database': 'superjoin',
+    'allow_local_infile': USE_LOAD_DATA_INFILE
 }
 
 # RabbitMQ configuration
 rabbitmq_host = os.getenv('RABBITMQ_HOST', 'localhost')
 rabbitmq_queue = 'conflict_queue'
 
+# Worker threads processing messages, and how many unacked deliveries the broker
+# may hand us at once (a little more than the workers so none sit idle)
+CONSUMER_WORKERS = int(os.getenv('CONSUMER_WORKERS', '8'))
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', str(CONSUMER_WORKERS * 2)))
+
+# Load (and if needed refresh or obtain) the Google OAuth credentials
+def get_google_credentials():
+    creds = None
+    if os.path.exists(TOKEN_PICKLE):
+        with open(TOKEN_PICKLE, 'rb') as token:
+            creds = pickle.load(token)
+
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
+            creds = flow.run_local_server(port=0)
+        with open(TOKEN_PICKLE, 'wb') as token:
+            pickle.dump(creds, token)
+    return creds
+
 # Get Google Sheets Client with Authentication
 def get_google_sheets_client():
     try:
-        creds = None
-        if os.path.exists(TOKEN_PICKLE):
-            with open(TOKEN_PICKLE, 'rb') as token:
-                creds = pickle.load(token)
-
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-                creds = flow.run_local_server(port=0)
-            with open(TOKEN_PICKLE, 'wb') as token:
-                pickle.dump(creds, token)
-
-        client = gspread.authorize(creds)
+        client = gspread.authorize(get_google_credentials())
         logging.info("Successfully connected to Google Sheets")
         return client
     except Exception as e:
         logging.error(f"Failed to connect to Google Sheets: {e}")
         raise
 
+# Clients shared by every worker thread: one authorized gspread client with a
+# cached spreadsheet handle, and a MySQL pool created on first use
+sheets = SharedSheetsClient(get_google_credentials, "superjoin")
+mysql_pool = None
+mysql_pool_lock = threading.Lock()
+
+def get_mysql_pool():
+    global mysql_pool
+    with mysql_pool_lock:
+        if mysql_pool is None:
+            mysql_pool = MySQLPool(mysql_config)
+            logging.info("Created MySQL connection pool")
+        return mysql_pool
+
 # Establish connection to MySQL
 def get_mysql_connection():
     try:
@@ -68,154 +116,391 @@ def get_mysql_connection():
         raise
 
 # Function to handle synchronization from Google Sheets to MySQL for all sheets
-def sync_all_sheets_to_db(spreadsheet, cursor):
+def sync_all_sheets_to_db(spreadsheet, connection):
+    cursor = connection.cursor()
+
     # Get all worksheets in the Google Spreadsheet
-    sheets = spreadsheet.worksheets()
+    sheets = call_sheets('read', spreadsheet.worksheets)
 
     # Get existing MySQL tables
-    cursor.execute("SHOW TABLES")
-    existing_tables = [table[0] for table in cursor.fetchall()]
+    existing_tables = schema_catalog.table_names(cursor)
 
     # Loop through each sheet in the spreadsheet
     for sheet in sheets:
         sheet_title = sheet.title
 
-        # Check if the MySQL table exists, if not, create it
+        # New sheets get their table from sync_sheet_to_db, which samples the
+        # rows to pick column types
         if sheet_title not in existing_tables:
             logging.info(f"New sheet detected: {sheet_title}. Creating corresponding MySQL table.")
-            headers = sheet.row_values(1)  # Assume first row has headers
-            create_new_table_for_sheet(cursor, sheet_title, headers)
-            connection.commit()
 
         # Sync the sheet data to MySQL
-        sync_sheet_to_db(sheet, cursor)
+        sync_sheet_to_db(sheet, connection)
 
-# Create a new MySQL table based on the Google Sheet headers
-def create_new_table_for_sheet(cursor, sheet_title, headers):
-    clear_cursor_results(cursor)
-
-    create_sql = f"""
-    CREATE TABLE {sheet_title} (
-        id INT AUTO_INCREMENT PRIMARY KEY,
-        {', '.join(f'{header} VARCHAR(255)' for header in headers)}
-    )
-    """
-    cursor.execute(create_sql)
-    clear_cursor_results(cursor)
-    logging.info(f"Created new MySQL table for sheet: {sheet_title}")
+    cursor.close()
 
 # Function to handle synchronization from Google Sheets to MySQL for a specific sheet
-def sync_sheet_to_db(sheet, cursor):
-    data = sheet.get_all_values()
-    headers = data[0]
+def sync_sheet_to_db(sheet, connection):
+    # Rows are streamed page by page straight into the bulk writer
+    rows = iter_sheet_rows(sheet)
+    headers = next(rows, None)
+    if not headers:
+        logging.info(f"Google Sheet '{sheet.title}' is empty, nothing to sync")
+        return
+    cursor = connection.cursor()
 
     logging.info(f"Syncing Google Sheet '{sheet.title}' to MySQL")
 
-    # Check and create/update the MySQL table based on Google Sheet headers
-    create_or_update_table(cursor, sheet.title, headers)
+    # Rows are matched to MySQL rows by their _row_id (or natural key), so a
+    # re-sync updates them in place; rows with no data are left out
+    keys = SheetRowKeys(sheet, headers)
+    rows = keys.rows(rows)
+
+    # Check and create/update the MySQL table based on Google Sheet headers,
+    # typing new columns from the first TYPE_SAMPLE_ROWS rows
+    sample = list(itertools.islice(rows, TYPE_SAMPLE_ROWS))
+    create_or_update_table(cursor, sheet.title, keys.write_headers, sample)
+    column_types = table_column_types(cursor, sheet.title)
+    first_load = table_is_empty(cursor, sheet.title)
+    cursor.close()
+    connection.commit()
+
+    # Rows go out as chunked multi-row upserts rather than one INSERT per row
+    try:
+        write_rows(
+            connection, sheet.title, keys.write_headers, itertools.chain(sample, rows),
+            first_load=first_load, expected_rows=sheet.row_count - 1, column_types=column_types
+        )
+    except Exception:
+        keys.abandon(connection)
+        raise
 
-    for row in data[1:]:
-        values = [f"'{value}'" for value in row]
-        sql = f"""
-        INSERT INTO {sheet.title} ({', '.join(headers)})
-        VALUES ({', '.join(values)})
-        ON DUPLICATE KEY UPDATE {', '.join(f'{header}=VALUES({header})' for header in headers)}
-        """
-        cursor.execute(sql)
-        clear_cursor_results(cursor)
+    # Delete rows that were removed from the sheet, then write the ids of new
+    # rows back to the sheet
+    keys.finish(connection)
+    keys.write_back()
 
     logging.info(f"Successfully synced Google Sheet '{sheet.title}' to MySQL")
 
 # Function to handle synchronization from MySQL to Google Sheets
 def sync_db_to_sheet(cursor, sheet):
-    cursor.execute(f"SELECT * FROM {sheet.title}")
+    # Rows added on the MySQL side get their _row_id before going to the sheet
+    assign_missing_row_ids(cursor, sheet.title)
+
+    # The change-tracking columns and the auto-increment id stay in MySQL
+    columns = sheet_columns(get_table_columns(cursor, sheet.title))
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {sheet.title}")
     rows = cursor.fetchall()
     headers = [desc[0] for desc in cursor.description]
 
     logging.info(f"Syncing MySQL '{sheet.title}' table to Google Sheet")
 
-    # Update Google Sheet with MySQL data
-    sheet.clear()
-    sheet.update([headers] + [list(row) for row in rows])
+    # Update only the cell ranges that differ from what the sheet last held,
+    # instead of clearing it and rewriting every cell
+    write_table(sheet, [headers] + [list(row) for row in rows], hidden_columns=(ROW_ID_COLUMN,))
     clear_cursor_results(cursor)
 
-    logging.info(f"Successfully synced MySQL '{sheet.title}' to Google Sheet")
-
-# Clears pending results from MySQL cursor
-def clear_cursor_results(cursor):
-    while cursor.nextset():
-        pass
-
-# Create or update MySQL table based on Google Sheets headers
-def create_or_update_table(cursor, sheet_name, headers):
-    clear_cursor_results(cursor)
+    # The sheet now holds exactly these rows
+    remember_sheet_keys(cursor, sheet.title, db_row_keys(sheet.title, headers, rows))
 
-    cursor.execute(f"SHOW TABLES LIKE '{sheet_name}'")
-    if cursor.fetchone():
-        existing_columns = get_table_columns(cursor, sheet_name)
-        new_columns = [header for header in headers if header not in existing_columns]
+    logging.info(f"Successfully synced MySQL '{sheet.title}' to Google Sheet")
 
-        if new_columns:
-            alter_sql = f"ALTER TABLE {sheet_name} ADD COLUMN {', ADD COLUMN '.join(f'{col} VARCHAR(255)' for col in new_columns)}"
-            cursor.execute(alter_sql)
-            clear_cursor_results(cursor)
-    else:
-        create_sql = f"""
-        CREATE TABLE {sheet_name} (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            {', '.join(f'{header} VARCHAR(255)' for header in headers)}
+# Decode a delivery body into a change, or None if it can't be parsed
+def parse_message(body):
+    try:
+        return decode_change(body)
+    except ValueError as e:
+        logging.error(f"Discarding malformed message {body[:200]!r}: {e}")
+        return None
+
+# Backfills started by this process, by table. Each runs in its own process
+# (which runs a pool of its own), so a consumer thread isn't held for hours.
+# The process is spawned rather than forked: forking this multithreaded
+# consumer could copy a lock some other thread holds (logging, the MySQL pool).
+backfill_processes = {}
+backfill_processes_lock = threading.Lock()
+
+def start_backfill(table_name, direction):
+    with backfill_processes_lock:
+        process = backfill_processes.get(table_name)
+        if process is not None and process.is_alive():
+            return
+        process = multiprocessing.get_context('spawn').Process(
+            target=run_backfill,
+            args=(table_name, direction, mysql_config, get_google_credentials, "superjoin"),
+            kwargs={'rabbitmq_host': rabbitmq_host, 'queue_base': rabbitmq_queue},
+            name=f"backfill-{table_name}"
         )
-        """
-        cursor.execute(create_sql)
-        clear_cursor_results(cursor)
-
-# Get MySQL table columns
-def get_table_columns(cursor, table_name):
-    cursor.execute(f"DESCRIBE {table_name}")
-    columns = cursor.fetchall()
-    return [column[0] for column in columns]
-
-# Function to process incoming messages from RabbitMQ
-def process_message(ch, method, properties, body):
-    message = body.decode()
-    sheet_title, change_type = message.split(':')
-
-    logging.info(f"Processing message: {message}")
+        process.start()
+        backfill_processes[table_name] = process
+    logging.info(f"Started backfill of '{table_name}' ({direction}) in process {process.pid}")
+
+# Direction a first sync of the table should be backfilled in, or None when a
+# regular bootstrap will do: a large sheet is loaded into MySQL, a large table
+# into a sheet without even a header row
+def backfill_direction(cursor, sheet):
+    if schema_catalog.table_exists(cursor, sheet.title):
+        if has_base(cursor, sheet.title):
+            return None
+        if estimated_rows(cursor, sheet.title) > BACKFILL_THRESHOLD_ROWS and not call_sheets('read', sheet.row_values, 1):
+            return 'db'
+    return 'sheet' if sheet_has_more_rows(sheet, BACKFILL_THRESHOLD_ROWS) else None
+
+# Apply one (possibly coalesced) change. Returns True when it was applied so
+# the caller knows whether to ack the deliveries behind it.
+def apply_change(change):
+    sheet_title, change_type = change['table'], change['source']
+    # Legacy string messages carry no detection time
+    detected_at = change.get('detected_at')
+    if detected_at:
+        consumer_lag_seconds.observe(max(time.time() - detected_at, 0))
+
+    logging.info(
+        f"Processing message: {sheet_title}:{change_type} "
+        f"({len(change['inserted'])} inserted, {len(change['updated'])} updated, {len(change['deleted'])} deleted)"
+    )
 
     try:
-        client = get_google_sheets_client()
-        connection = get_mysql_connection()
-        cursor = connection.cursor()
-
-        spreadsheet = client.open("superjoin")
+        spreadsheet = sheets.spreadsheet()
+        sheet = call_sheets('read', spreadsheet.worksheet, sheet_title)
+
+        with get_mysql_pool().connection() as connection:
+            cursor = connection.cursor()
+
+            # A large first sync runs as a backfill. While one is running (or
+            # has just failed) the table is left alone: the backfill ends with
+            # a full reconcile that picks up these changes, and a failed one is
+            # resumed by the first message after BACKFILL_STALE_SECONDS.
+            state, direction = backfill_status(cursor, sheet_title)
+            if change_type == 'backfill':
+                direction = change.get('direction', 'sheet')
+            elif state is None:
+                direction = backfill_direction(cursor, sheet)
+            elif state != 'stale':
+                logging.info(f"Backfill of '{sheet_title}' is {state}; skipping {change_type} change")
+                direction = None
+            if direction or state in ('running', 'failed'):
+                cursor.close()
+                connection.commit()
+                if direction:
+                    start_backfill(sheet_title, direction)
+                changes_applied.inc(table=sheet_title, result='ok')
+                return True
+
+            # A table seen for the first time is loaded from the sheet in bulk.
+            # From then on both sides are three-way merged against the last
+            # synced base, whichever side the message came from: from the rows
+            # carried in the message when it has them, otherwise (or when they
+            # aren't enough) by reading both sides.
+            bootstrapped = False
+            if not schema_catalog.table_exists(cursor, sheet_title) or not has_base(cursor, sheet_title):
+                with stage('consumer', 'bootstrap', table=sheet_title):
+                    sync_sheet_to_db(sheet, connection)
+                bootstrapped = True
+            plan = None
+            if change.get('delta') is not None and not bootstrapped and delta_is_current(cursor, change):
+                with stage('consumer', 'apply_delta', table=sheet_title):
+                    plan = apply_delta(sheet, connection, change_type, change['delta'], version=change.get('version'))
+            # A reconcile after a bootstrap covers the whole table; otherwise
+            # only the rows the change names are merged
+            scope = None if bootstrapped else change
+            if plan is None and reconcile(sheet, connection, change=scope) is None:
+                # Not even a header row in the sheet yet: fill it from MySQL
+                if schema_catalog.table_exists(cursor, sheet_title):
+                    with stage('consumer', 'bootstrap', table=sheet_title):
+                        sync_db_to_sheet(cursor, sheet)
+
+            cursor.close()
+            connection.commit()
+        # A coalesced change lists the blobs of every message folded into it
+        for ref in change.get('delta_refs', [change.get('delta_ref')]):
+            if ref:
+                blob_store.delete(ref)
+        logging.info(f"Finished processing message: {sheet_title}:{change_type}")
+        changes_applied.inc(table=sheet_title, result='ok')
+        if detected_at:
+            propagation_seconds.observe(max(time.time() - detected_at, 0), source=change_type)
+        return True
 
-        # If a new sheet is created or updated
-        if change_type == 'sheet':
-            sync_all_sheets_to_db(spreadsheet, cursor)  # Check all sheets for new or updated ones
-        elif change_type == 'db':
-            # Sync specific sheet to MySQL if DB change
-            sheet = spreadsheet.worksheet(sheet_title)
-            sync_db_to_sheet(cursor, sheet)
+    except Exception as e:
+        logging.error(f"Error processing message '{sheet_title}:{change_type}': {e}")
+        # The error may come from a schema changed by another process; re-read it on the retry
+        schema_catalog.invalidate()
+        changes_applied.inc(table=sheet_title, result='error')
+        return False
 
-        connection.commit()
-        logging.info(f"Finished processing message: {message}")
+# Function to process a single incoming message from RabbitMQ
+def process_message(ch, method, properties, body):
+    with stage('consumer', 'process_message'):
+        change = parse_message(body)
+        return change is not None and apply_change(change)
+
+# Acks must go out on the connection's own thread. A failed change is never
+# dropped: it is republished to the retry exchange (which hands it back to its
+# shard queue after SYNC_RETRY_DELAY_MS) or, after SYNC_MAX_ATTEMPTS, parked,
+# and only acked once the broker has confirmed that publish.
+def settle_message(channel, method, properties, body, table_name, succeeded):
+    if not channel.is_open:
+        return  # the broker requeues unacked deliveries when the channel drops
+    if succeeded:
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    exchange, routing_key, headers = retry_route(rabbitmq_queue, table_name, properties.headers)
+    if exchange:
+        logging.warning(f"Retrying change for '{table_name}' later (attempt {headers[ATTEMPTS_HEADER]} failed)")
+    else:
+        logging.error(f"Parking change for '{table_name}' in {routing_key} after {headers[ATTEMPTS_HEADER]} attempts")
+    try:
+        channel.basic_publish(
+            exchange=exchange, routing_key=routing_key, body=body, mandatory=True,
+            properties=pika.BasicProperties(delivery_mode=2, headers=headers)
+        )
+    except pika.exceptions.AMQPError as e:
+        logging.error(f"Could not republish failed change for '{table_name}', requeueing it: {e!r}")
+        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        return
+    channel.basic_ack(delivery_tag=method.delivery_tag)
+
+# Scrape-time gauges for this process: worker and MySQL pool utilization,
+# thread count and the shared connection counters
+def register_consumer_gauges(worker_state):
+    def pool_gauges():
+        pool = mysql_pool
+        if pool is None:
+            return {}
+        return {('in_use',): pool.in_use, ('size',): pool.pool_size}
+
+    registry.callback_gauge(
+        'sync_consumer_workers', "Consumer worker threads, busy and total", ('state',),
+        lambda: {('busy',): worker_state['busy'], ('total',): CONSUMER_WORKERS}
+    )
+    registry.callback_gauge('sync_mysql_pool_connections', "Consumer MySQL pool connections", ('state',), pool_gauges)
+    registry.callback_gauge('sync_threads', "Live threads in the process", (), lambda: {(): threading.active_count()})
+    registry.callback_gauge(
+        'sync_connection_events', "Shared client counters (reuses, reconnects, pool waits)", ('event',),
+        lambda: {(name,): value for name, value in connection_metrics.snapshot().items()}
+    )
 
-    except Exception as e:
-        logging.error(f"Error processing message '{message}': {e}")
+# Function to start consuming messages from RabbitMQ with a fixed worker pool.
+# basic_qos caps unacked deliveries at CONSUMER_PREFETCH, so a backlog stays in
+# the broker instead of piling up as threads or memory here. `shards` picks the
+# shard queues this process serves (all of them by default); `handler` applies
+# one merged change and returns whether it succeeded.
+def start_consumer(shards=None, handler=None, metrics_port=CONSUMER_METRICS_PORT):
+    shards = list(range(SHARD_COUNT)) if shards is None else shards
+    handler = handler or apply_change
+    worker_state = {'busy': 0}
+    worker_state_lock = threading.Lock()
+    register_consumer_gauges(worker_state)
+    start_metrics_server(metrics_port)
 
-# Function to start consuming messages from RabbitMQ with concurrency
-def start_consumer():
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
     channel = connection.channel()
-    channel.queue_declare(queue=rabbitmq_queue, durable=True)
+    declare_topology(channel, rabbitmq_queue)
+    channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
+    # Failed changes are republished before they are acked; confirms make sure the broker has them
+    channel.confirm_delivery()
+    executor = ThreadPoolExecutor(max_workers=CONSUMER_WORKERS, thread_name_prefix='sync-worker')
+    coalescer = Coalescer()
+
+    # Runs on a worker: sync the merged change once. The coalescer hands a
+    # table to one worker at a time; a change that came in meanwhile is
+    # scheduled here once this one is done, so a table's changes apply in order.
+    def work(table):
+        change, settle_callbacks = coalescer.take(table)
+        succeeded = False
+        with worker_state_lock:
+            worker_state['busy'] += 1
+        try:
+            with stage('consumer', 'apply', table=table):
+                succeeded = handler(change)
+        finally:
+            with worker_state_lock:
+                worker_state['busy'] -= 1
+            for settle in settle_callbacks:
+                connection.add_callback_threadsafe(functools.partial(settle, succeeded))
+            if coalescer.done(table):
+                executor.submit(work, table)
 
     def callback(ch, method, properties, body):
-        # Use threading to handle multiple messages concurrently
-        threading.Thread(target=process_message, args=(ch, method, properties, body)).start()
+        change = parse_message(body)
+        table_name = change['table'] if change is not None else None
+        settle = functools.partial(settle_message, ch, method, properties, body, table_name)
+        if change is None:
+            settle(False)
+            return
+        # A redelivery, or a retry of a failed attempt, may have been applied in part
+        if method.redelivered or ATTEMPTS_HEADER in (properties.headers or {}):
+            change['retried'] = True
+
+        # Messages for a table that is already pending ride along with it
+        if coalescer.add(change, settle):
+            executor.submit(work, change['table'])
+
+    for shard in shards:
+        channel.basic_consume(queue=shard_queue(rabbitmq_queue, shard), on_message_callback=callback, auto_ack=False)
+
+    # Shard 0's owner also drains the pre-sharding queue so nothing left there is lost
+    if 0 in shards:
+        channel.queue_declare(queue=rabbitmq_queue, durable=True)
+        channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=False)
+
+    logging.info(
+        f'Waiting for messages on shards {shards} with {CONSUMER_WORKERS} workers '
+        f'(prefetch {CONSUMER_PREFETCH}). To exit press CTRL+C'
+    )
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        channel.stop_consuming()
+    finally:
+        # Let in-flight work finish (without waiting out coalescing windows)
+        # and flush its acks before closing
+        coalescer.close()
+        executor.shutdown(wait=True)
+        if connection.is_open:
+            connection.process_data_events(time_limit=0)
+            connection.close()
+
+# Run `process_count` consumer processes, each serving its own set of shards.
+# Every process gets its own connections; a table always maps to one process.
+def start_consumer_processes(process_count, handler=None):
+    if process_count > SHARD_COUNT:
+        logging.warning(f"Only {SHARD_COUNT} shards exist; starting {SHARD_COUNT} processes instead of {process_count}")
+        process_count = SHARD_COUNT
+
+    processes = []
+    for index in range(process_count):
+        shards = shards_for_process(index, process_count)
+        # Each process serves its own metrics on the next port up
+        metrics_port = CONSUMER_METRICS_PORT + index if CONSUMER_METRICS_PORT else 0
+        process = multiprocessing.Process(
+            target=start_consumer, args=(shards, handler, metrics_port), name=f'consumer-{index}'
+        )
+        process.start()
+        processes.append(process)
+
+    # Terminating this process terminates the consumers too, instead of leaving
+    # them running (and holding their shards) without a parent
+    def terminate_consumers(signum, frame):
+        for process in processes:
+            process.terminate()
+    signal.signal(signal.SIGTERM, terminate_consumers)
 
-    channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=True)
-    logging.info('Waiting for messages. To exit press CTRL+C')
-    channel.start_consuming()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
 
 if __name__ == "__main__":
-    start_consumer()
+    parser = argparse.ArgumentParser(description="Apply queued Sheet/DB changes")
+    parser.add_argument('--processes', type=int, default=1, help="number of consumer processes to spread shards across")
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        start_consumer_processes(args.processes)
+    else:
+        start_consumer()
@@ -0,0 +1,127 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sheets_api import call_sheets
+
+# Overridable so a local stand-in can play the role of Google in tests
+DRIVE_API_URL = os.getenv('DRIVE_API_URL', 'https://www.googleapis.com/drive/v3')
+
+# Optional push notifications: the receiver listens on DRIVE_WEBHOOK_PORT and
+# Google is told to call DRIVE_WEBHOOK_ADDRESS (a public HTTPS URL routed to it)
+DRIVE_WEBHOOK_PORT = int(os.getenv('DRIVE_WEBHOOK_PORT', '0'))
+DRIVE_WEBHOOK_ADDRESS = os.getenv('DRIVE_WEBHOOK_ADDRESS')
+DRIVE_WATCH_TTL_SECONDS = int(os.getenv('DRIVE_WATCH_TTL_SECONDS', '3600'))
+
+
+# gspread 6 keeps the authorized session on client.http_client, gspread 5 on the client
+def http_client_of(client):
+    return getattr(client, 'http_client', client)
+
+
+# One lightweight Drive call for the whole spreadsheet. Native Google Sheets
+# files don't populate headRevisionId, but `version` increases on every change.
+def fetch_file_version(client, file_id):
+    response = call_sheets(
+        'drive', http_client_of(client).request, 'get', f"{DRIVE_API_URL}/files/{file_id}",
+        params={'fields': 'version,modifiedTime'}
+    )
+    metadata = response.json()
+    return metadata.get('version') or metadata.get('modifiedTime')
+
+
+# Cheap "did anything change?" check to run before reading any worksheet.
+# mark_seen() is only called after a successful read, so a failed cycle is
+# retried; notify() (from a webhook) forces the next check to report a change.
+# The flag is taken (tested and cleared under the lock) before the version is
+# fetched, so a notify() that lands during a check forces the next one.
+class ChangeProbe:
+    def __init__(self, client, file_id):
+        self.client = client
+        self.file_id = file_id
+        self.last_seen = None
+        self.lock = threading.Lock()
+        self.forced = False
+
+    def take_forced(self):
+        with self.lock:
+            forced, self.forced = self.forced, False
+        return forced
+
+    def check(self):
+        forced = self.take_forced()
+        try:
+            version = fetch_file_version(self.client, self.file_id)
+        except Exception:
+            if forced:
+                self.notify()
+            raise
+        return forced or version != self.last_seen, version
+
+    def mark_seen(self, version):
+        self.last_seen = version
+
+    def notify(self):
+        with self.lock:
+            self.forced = True
+
+
+# Ask Drive to POST to `address` whenever the file changes. Channels expire,
+# so the returned expiration (ms since epoch) tells the caller when to renew.
+def watch_file(client, file_id, address, token, ttl_seconds=DRIVE_WATCH_TTL_SECONDS):
+    body = {
+        'id': str(uuid.uuid4()),
+        'type': 'web_hook',
+        'address': address,
+        'token': token,
+        'expiration': int((time.time() + ttl_seconds) * 1000),
+    }
+    response = call_sheets(
+        'drive', http_client_of(client).request, 'post', f"{DRIVE_API_URL}/files/{file_id}/watch", json=body
+    )
+    channel = response.json()
+    logging.info(f"Watching Drive file {file_id} via channel {channel.get('id')}")
+    return channel
+
+
+# Minimal receiver for Drive push notifications. Google sends the channel token
+# back in X-Goog-Channel-Token, which is checked before waking the producer.
+def start_webhook_server(port, token, on_notification):
+    class DriveNotificationHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.headers.get('X-Goog-Channel-Token') != token:
+                self.send_response(403)
+                self.end_headers()
+                return
+
+            # 'sync' is sent once when the channel is created; everything else is a change
+            if self.headers.get('X-Goog-Resource-State') != 'sync':
+                on_notification()
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logging.debug(f"Drive webhook: {format % args}")
+
+    server = ThreadingHTTPServer(('', port), DriveNotificationHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Listening for Drive notifications on port {server.server_address[1]}")
+    return server
+
+
+# Keep a watch channel alive, renewing it shortly before it expires
+def keep_watching(client, file_id, address, token):
+    def renew():
+        while True:
+            try:
+                channel = watch_file(client, file_id, address, token)
+                expires_in = int(channel.get('expiration', 0)) / 1000 - time.time()
+                time.sleep(max(60, expires_in - 300))
+            except Exception as e:
+                logging.error(f"Failed to register Drive watch channel: {e}")
+                time.sleep(60)
+
+    threading.Thread(target=renew, daemon=True).start()
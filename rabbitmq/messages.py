@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import time
+
+try:
+    import msgpack
+except ImportError:  # optional dependency; messages fall back to JSON without it
+    msgpack = None
+
+from blob_store import CLAIM_CHECK_BYTES, blob_store
+from row_index import empty_change_set
+
+# Version of the message envelope. Version 2 adds the row-level delta; older
+# JSON messages without a version are still accepted.
+MESSAGE_VERSION = 2
+
+# 'msgpack' (compact, binary) or 'json'. The consumer reads either, so the
+# producer can switch without draining the queues first.
+MESSAGE_FORMAT = os.getenv('MESSAGE_FORMAT', 'msgpack' if msgpack is not None else 'json')
+
+# Marks a msgpack payload. 0xc1 is the one byte msgpack never uses, and it
+# can't start JSON or UTF-8 text either, so it tells the formats apart however
+# many keys the map has.
+MSGPACK_PREFIX = b'\xc1'
+
+# A delta with more changed rows than this is left out of the message and the
+# consumer re-reads both sides instead, so e.g. a first sync of a large table
+# isn't held in the producer's memory a second time
+DELTA_MAX_ROWS = int(os.getenv('DELTA_MAX_ROWS', '50000'))
+
+
+def require_msgpack():
+    if msgpack is None:
+        raise RuntimeError("msgpack messages need the msgpack package: pip install msgpack")
+
+
+def pack(payload):
+    if MESSAGE_FORMAT == 'msgpack':
+        require_msgpack()
+        return MSGPACK_PREFIX + msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload).encode()
+
+
+# 'msgpack', 'json' or None (not a packed payload). Producers from before the
+# prefix sent bare msgpack maps; those had fewer than 16 keys, so they start
+# with a fixmap byte (0x80-0x8f), which JSON and UTF-8 text never do.
+def packed_format(data):
+    if data[:1] == MSGPACK_PREFIX:
+        return 'msgpack'
+    if data and 0x80 <= data[0] <= 0x8f:
+        return 'msgpack'
+    if data[:1] == b'{':
+        return 'json'
+    return None
+
+
+def unpack(data):
+    if packed_format(data) == 'msgpack':
+        require_msgpack()
+        if data[:1] == MSGPACK_PREFIX:
+            data = data[1:]
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return json.loads(data)
+
+
+# Cells go over the wire as text, numbers or None. Anything else MySQL returns
+# (Decimal, date, bytes, ...) is sent as str(), which is what the consumer's
+# canonical_value() compares anyway.
+def wire_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+# The cells of the inserted and updated rows a producer sees while diffing one
+# table (handed to RowIndex.diff/apply as on_change), turned into the delta a
+# message carries: {'headers', 'rows': [[key, cells], ...], 'deleted': [keys],
+# 'times': [Unix time, ...] parallel to rows}. For MySQL the times are each
+# row's updated_at; for a sheet, the time of the read that first saw the row
+# changed (see stamp()).
+class DeltaRows:
+    def __init__(self, headers=None, limit=DELTA_MAX_ROWS):
+        self.headers = list(headers) if headers is not None else None
+        self.limit = limit
+        self.rows = {}
+        self.times = None  # key -> Unix time the row was last written
+        self.dropped = False
+
+    # A repeated key (a row pasted with its _row_id) or too many rows drops the delta
+    def add(self, key, row):
+        if self.dropped:
+            return
+        if key in self.rows or len(self.rows) >= self.limit:
+            self.dropped = True
+            self.rows = {}
+            return
+        self.rows[key] = row
+
+    # Passes a worksheet's rows through, keeping the first one as the headers
+    def sheet_rows(self, rows):
+        for position, row in enumerate(rows):
+            if position == 0:
+                self.headers = list(row)
+            yield row
+
+    # Sheets has no per-row edit time, but each row in a sheet delta changed
+    # since the previous read, so the time of this read bounds when it was
+    # edited to within one poll interval: a row-level clock for lww, unlike
+    # the spreadsheet's modifiedTime, which any edit to the file moves
+    def stamp(self, read_at):
+        self.times = dict.fromkeys(self.rows, read_at)
+
+    def delta(self, deleted):
+        if self.dropped or self.headers is None:
+            return None
+        delta = {
+            'headers': self.headers,
+            'rows': [[key, [wire_value(value) for value in row]] for key, row in self.rows.items()],
+            'deleted': list(deleted),
+        }
+        if self.times is not None:
+            delta['times'] = [self.times.get(key) for key in self.rows]
+        return delta
+
+
+# Build the message published for a detected change. The change set carries the
+# exact row keys that were inserted, updated or deleted on the source side, and
+# detected_at (Unix time) lets the consumer measure how long the change took to
+# land. With a delta the consumer can apply the change without reading the
+# source side again; base_version/version are the watermarks (MySQL) or Drive
+# versions (sheet) the delta runs between. A delta too large to travel inline
+# is put in the blob store and the message carries delta_ref instead.
+def encode_change(table, source, change_set, detected_at=None, delta=None, base_version=None, version=None):
+    message = {
+        'v': MESSAGE_VERSION,
+        'table': table,
+        'source': source,
+        'inserted': change_set['inserted'],
+        'updated': change_set['updated'],
+        'deleted': change_set['deleted'],
+        'detected_at': detected_at if detected_at is not None else time.time(),
+        'base_version': base_version,
+        'version': version,
+    }
+    if delta is None:
+        return pack(message)
+
+    body = pack({**message, 'delta': delta})
+    if not CLAIM_CHECK_BYTES or len(body) <= CLAIM_CHECK_BYTES:
+        return body
+    message['delta_ref'] = blob_store.put(pack(delta))
+    return pack(message)
+
+
+# Ask a consumer to run the range-partitioned first sync of a table (see
+# backfill.py); `direction` is 'sheet' (sheet -> MySQL) or 'db' (MySQL -> sheet)
+def encode_backfill(table, direction):
+    return pack({
+        'v': MESSAGE_VERSION,
+        'table': table,
+        'source': 'backfill',
+        'direction': direction,
+        **empty_change_set(),
+        'detected_at': time.time(),
+    })
+
+
+# Parse a message from the queue: a msgpack or JSON envelope, or the bare string
+# "title:type" older producers sent, so anything already queued drains cleanly.
+# A claim-checked delta is loaded back into 'delta'; if its blob is gone the
+# change is returned without one and the consumer re-reads both sides.
+def decode_change(body):
+    data = body.encode() if isinstance(body, str) else body
+
+    if packed_format(data) is not None:
+        change = unpack(data)
+    else:
+        table, source = data.decode().rsplit(':', 1)
+        return {'table': table, 'source': source, **empty_change_set()}
+
+    if not isinstance(change, dict) or 'table' not in change:
+        raise ValueError("message is not a change envelope")
+    if change.get('v', 1) > MESSAGE_VERSION:
+        raise ValueError(f"unsupported message version {change['v']}")
+
+    if change.get('delta_ref'):
+        try:
+            change['delta'] = unpack(blob_store.get(change['delta_ref']))
+        except KeyError:
+            logging.warning(f"Delta {change['delta_ref']} for '{change['table']}' is missing; syncing the whole table")
+    return change
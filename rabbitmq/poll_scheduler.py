@@ -0,0 +1,221 @@
+import os
+import threading
+import time
+
+# Interval a table starts at, and the range it adapts within. A poll that finds
+# a change drops the table to POLL_MIN_INTERVAL_SECONDS; every quiet poll
+# multiplies the interval by POLL_BACKOFF, up to POLL_MAX_INTERVAL_SECONDS.
+POLL_INTERVAL_SECONDS = float(os.getenv('POLL_INTERVAL_SECONDS', '20'))
+POLL_MIN_INTERVAL_SECONDS = float(os.getenv('POLL_MIN_INTERVAL_SECONDS', '5'))
+POLL_MAX_INTERVAL_SECONDS = float(os.getenv('POLL_MAX_INTERVAL_SECONDS', '900'))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', '2'))
+
+# Table polls per minute across all tables. When the adapted intervals would
+# add up to more, every interval is stretched by the same factor.
+POLL_BUDGET_PER_MINUTE = float(os.getenv('POLL_BUDGET_PER_MINUTE', '60'))
+
+# How fast a table's change history fades. A table that changed often keeps a
+# lower ceiling on its interval than one that changed once.
+POLL_HEAT_HALF_LIFE_SECONDS = float(os.getenv('POLL_HEAT_HALF_LIFE_SECONDS', '3600'))
+
+# How often the producer prints its table of per-table intervals
+POLL_REPORT_SECONDS = float(os.getenv('POLL_REPORT_SECONDS', '600'))
+
+# Per-table intervals are written here for anyone to look at, and the app sets
+# poll_requested_at after an edit so the producer polls that table right away
+SCHEDULE_TABLE = '_sync_poll_schedule'
+
+
+class TableSchedule:
+    def __init__(self, interval, now):
+        self.interval = interval
+        self.next_due = now
+        self.heat = 0.0  # changes seen, decayed by POLL_HEAT_HALF_LIFE_SECONDS
+        self.heat_updated = now
+        self.polls = 0
+        self.changes = 0
+
+
+# Decides which tables to poll and when. record() is called after every poll
+# of a table with whether it changed; bump() asks for a table to be polled now.
+# bump() may be called from webhook threads, so every call takes the lock.
+class PollScheduler:
+    def __init__(self, initial=POLL_INTERVAL_SECONDS, minimum=POLL_MIN_INTERVAL_SECONDS,
+                 maximum=POLL_MAX_INTERVAL_SECONDS, backoff=POLL_BACKOFF,
+                 budget_per_minute=POLL_BUDGET_PER_MINUTE, half_life=POLL_HEAT_HALF_LIFE_SECONDS,
+                 clock=time.monotonic):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.budget_per_minute = budget_per_minute
+        self.half_life = half_life
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def schedule_for(self, table, now):
+        if table not in self.tables:
+            self.tables[table] = TableSchedule(self.initial, now)
+        return self.tables[table]
+
+    # Keep exactly these tables; new ones are due straight away
+    def track(self, tables):
+        now = self.clock()
+        with self.lock:
+            for table in tables:
+                self.schedule_for(table, now)
+            for table in set(self.tables) - set(tables):
+                del self.tables[table]
+
+    # How much the budget stretches every interval (1.0 when within budget)
+    def pressure(self):
+        demand = sum(60.0 / schedule.interval for schedule in self.tables.values())
+        return max(1.0, demand / self.budget_per_minute)
+
+    def effective_interval(self, table):
+        with self.lock:
+            return self.tables[table].interval * self.pressure()
+
+    # Tables whose turn has come, most overdue first
+    def due(self):
+        now = self.clock()
+        with self.lock:
+            due = [(schedule.next_due, table) for table, schedule in self.tables.items() if schedule.next_due <= now]
+        return [table for _, table in sorted(due)]
+
+    # `started` is when the poll began, so due times are a fixed cadence from
+    # poll start rather than from whenever the poll happened to finish
+    def record(self, table, changed, started=None):
+        now = self.clock()
+        started = now if started is None else started
+        with self.lock:
+            schedule = self.schedule_for(table, now)
+            schedule.heat *= 0.5 ** ((now - schedule.heat_updated) / self.half_life)
+            schedule.heat_updated = now
+            schedule.polls += 1
+            if changed:
+                schedule.heat += 1.0
+                schedule.changes += 1
+                schedule.interval = self.minimum
+            else:
+                ceiling = max(self.minimum, self.maximum / (1.0 + schedule.heat))
+                schedule.interval = min(ceiling, schedule.interval * self.backoff)
+            schedule.next_due = started + schedule.interval * self.pressure()
+
+    # Poll `table` at the next opportunity and treat it as hot again
+    def bump(self, table):
+        now = self.clock()
+        with self.lock:
+            schedule = self.schedule_for(table, now)
+            schedule.interval = self.minimum
+            schedule.next_due = now
+
+    def bump_all(self):
+        with self.lock:
+            tables = list(self.tables)
+        for table in tables:
+            self.bump(table)
+
+    def seconds_until_next(self):
+        now = self.clock()
+        with self.lock:
+            if not self.tables:
+                return self.initial
+            return max(0.0, min(schedule.next_due for schedule in self.tables.values()) - now)
+
+    # One row per table, slowest first:
+    # (table, interval, effective interval, heat, polls, changes, seconds until next poll)
+    def snapshot(self):
+        now = self.clock()
+        with self.lock:
+            pressure = self.pressure()
+            rows = [
+                (table, schedule.interval, schedule.interval * pressure, schedule.heat,
+                 schedule.polls, schedule.changes, max(0.0, schedule.next_due - now))
+                for table, schedule in self.tables.items()
+            ]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def describe(self):
+        lines = [f"{'table':<24} {'interval':>9} {'effective':>9} {'heat':>6} {'polls':>6} {'changes':>7} {'next in':>8}"]
+        for table, interval, effective, heat, polls, changes, next_in in self.snapshot():
+            lines.append(
+                f"{table[:24]:<24} {interval:>8.0f}s {effective:>8.0f}s {heat:>6.2f} {polls:>6} {changes:>7} {next_in:>7.0f}s"
+            )
+        return '\n'.join(lines)
+
+    # Intervals and heat survive restarts through the state store
+    def dump(self):
+        with self.lock:
+            return {table: [schedule.interval, schedule.heat] for table, schedule in self.tables.items()}
+
+    def restore(self, saved):
+        now = self.clock()
+        with self.lock:
+            for table, (interval, heat) in (saved or {}).items():
+                schedule = self.schedule_for(table, now)
+                schedule.interval = min(self.maximum, max(self.minimum, interval))
+                schedule.heat = heat
+
+
+def create_schedule_table(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {SCHEDULE_TABLE} (
+        table_name VARCHAR(64) PRIMARY KEY,
+        interval_seconds DOUBLE NOT NULL DEFAULT 0,
+        effective_seconds DOUBLE NOT NULL DEFAULT 0,
+        heat DOUBLE NOT NULL DEFAULT 0,
+        polls BIGINT NOT NULL DEFAULT 0,
+        changes BIGINT NOT NULL DEFAULT 0,
+        next_poll_in DOUBLE NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP(6) NULL,
+        poll_requested_at TIMESTAMP(6) NULL
+    )
+    """)
+
+
+# Called by anything that edits a table outside the sheet (e.g. the app), so
+# the producer picks the edit up without waiting out a long interval
+def request_poll(cursor, table_name):
+    cursor.execute(
+        f"INSERT INTO {SCHEDULE_TABLE} (table_name, poll_requested_at) VALUES (%s, CURRENT_TIMESTAMP(6)) "
+        f"ON DUPLICATE KEY UPDATE poll_requested_at = CURRENT_TIMESTAMP(6)",
+        (table_name,)
+    )
+
+
+# Tables with a pending poll request. Only requests up to the time read are
+# cleared, so one made in between is kept for the next call.
+def take_poll_requests(cursor):
+    cursor.execute(f"SELECT table_name, poll_requested_at FROM {SCHEDULE_TABLE} WHERE poll_requested_at IS NOT NULL")
+    requests = cursor.fetchall()
+    for table_name, requested_at in requests:
+        cursor.execute(
+            f"UPDATE {SCHEDULE_TABLE} SET poll_requested_at = NULL WHERE table_name = %s AND poll_requested_at <= %s",
+            (table_name, requested_at)
+        )
+    return [table_name for table_name, _ in requests]
+
+
+def store_schedule(cursor, scheduler):
+    cursor.executemany(
+        f"""
+        INSERT INTO {SCHEDULE_TABLE}
+            (table_name, interval_seconds, effective_seconds, heat, polls, changes, next_poll_in, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP(6))
+        ON DUPLICATE KEY UPDATE
+            interval_seconds = VALUES(interval_seconds), effective_seconds = VALUES(effective_seconds),
+            heat = VALUES(heat), polls = VALUES(polls), changes = VALUES(changes),
+            next_poll_in = VALUES(next_poll_in), updated_at = VALUES(updated_at)
+        """,
+        scheduler.snapshot()
+    )
+
+
+def load_schedule(cursor):
+    cursor.execute(f"""
+    SELECT table_name, interval_seconds, effective_seconds, heat, polls, changes, next_poll_in, updated_at
+    FROM {SCHEDULE_TABLE} ORDER BY effective_seconds DESC
+    """)
+    return cursor.fetchall()
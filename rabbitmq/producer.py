@@ -5,9 +5,38 @@ from google.auth.transport.requests import Request
 import mysql.connector
 import os
 import pickle
+import threading
 import time
+import uuid
+import argparse
+import asyncio
+import logging
 from dotenv import load_dotenv
 import pika  # RabbitMQ library
+from async_producer import run_async_producer
+from binlog_cdc import CDC_TABLES, BinlogChangeSource, advance_watermarks, streamed_tables
+from bulk_writer import USE_LOAD_DATA_INFILE
+from change_capture import (
+    INITIAL_WATERMARK, current_version, ensure_change_tracking, fetch_changes, prune_tombstones
+)
+from coalescer import group_by_table
+from connections import Publisher
+from drive_watch import DRIVE_WEBHOOK_ADDRESS, DRIVE_WEBHOOK_PORT, ChangeProbe, keep_watching, start_webhook_server
+from messages import DeltaRows, encode_change
+from poll_scheduler import (
+    POLL_MIN_INTERVAL_SECONDS, POLL_REPORT_SECONDS, PollScheduler, create_schedule_table, store_schedule,
+    take_poll_requests
+)
+from row_identity import sheet_identity_key
+from row_index import RowIndex, has_changes, db_row_key
+from schema import create_or_update_table, get_table_columns, schema_catalog
+from sheet_reader import SHEET_PAGE_SIZE, iter_sheet_rows
+from sheets_api import batch_get_sheets, call_sheets
+from sync_state import open_state_store
+from telemetry import (
+    PRODUCER_METRICS_PORT, changes_published, count_rows, queue_depth, rows_read, stage, stage_seconds, start_metrics_server
+)
+from type_inference import TYPE_SAMPLE_ROWS
 from dotenv import load_dotenv
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
@@ -22,7 +51,8 @@ mysql_config = {
     'host': os.getenv('MYSQL_HOST'),
     'user': os.getenv('MYSQL_USER'),
     'password': os.getenv('MYSQL_PASSWORD'),
-    'database': 'superjoin'
+    'database': 'superjoin',
+    'allow_local_infile': USE_LOAD_DATA_INFILE
 }
 
 # RabbitMQ configuration
@@ -50,144 +80,250 @@ def get_google_sheets_client():
 def get_mysql_connection():
     return mysql.connector.connect(**mysql_config)
 
-def clear_cursor_results(cursor):
-    while cursor.nextset():
-        pass
+# One long-lived publisher connection instead of a new connection per message
+publisher = Publisher(rabbitmq_host, rabbitmq_queue)
 
-def get_table_columns(cursor, table_name):
-    cursor.execute(f"DESCRIBE {table_name}")
-    columns = cursor.fetchall()
-    return [column[0] for column in columns]
+def send_message(message, table_name):
+    publisher.publish(message, table_name)
 
-def create_or_update_table(cursor, sheet_name, headers):
-    clear_cursor_results(cursor)
+# Binlog sources started by this process. Their tables are left out of the
+# MySQL poll only while the stream is up; if it fails they are polled until
+# it has been reopened.
+binlog_sources = []
 
-    cursor.execute(f"SHOW TABLES LIKE '{sheet_name}'")
-    if cursor.fetchone():
-        existing_columns = get_table_columns(cursor, sheet_name)
-        new_columns = [header for header in headers if header not in existing_columns]
+# Publish binlog row events as they arrive; runs on its own thread and is
+# restarted from the saved position whenever it fails
+def start_binlog_capture(tables):
+    def publish(table_name, change_set):
+        send_message(encode_change(table_name, 'db', change_set), table_name)
 
-        if new_columns:
-            alter_sql = f"ALTER TABLE {sheet_name} ADD COLUMN {', ADD COLUMN '.join(f'{col} VARCHAR(255)' for col in new_columns)}"
-            cursor.execute(alter_sql)
-            clear_cursor_results(cursor)
-    else:
-        create_sql = f"""
-        CREATE TABLE {sheet_name} (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            {', '.join(f'{header} VARCHAR(255)' for header in headers)}
-        )
-        """
-        cursor.execute(create_sql)
-        clear_cursor_results(cursor)
-
-def sync_sheet_to_db(sheet, cursor):
-    data = sheet.get_all_values()
-    headers = data[0]
-    
-    create_or_update_table(cursor, sheet.title, headers)
-    
-    for row in data[1:]:
-        values = [f"'{value}'" for value in row]
-        sql = f"""
-        INSERT INTO {sheet.title} ({', '.join(headers)})
-        VALUES ({', '.join(values)})
-        ON DUPLICATE KEY UPDATE {', '.join(f'{header}=VALUES({header})' for header in headers)}
-        """
-        cursor.execute(sql)
-        clear_cursor_results(cursor)
-    print(f"Changes detected in Google Sheet '{sheet.title}'. Updated MySQL database.")
-
-def sync_db_to_sheet(cursor, sheet):
-    cursor.execute(f"SELECT * FROM {sheet.title}")
-    rows = cursor.fetchall()
-    headers = [desc[0] for desc in cursor.description]
-
-    sheet.update([headers] + [list(row) for row in rows])
-    clear_cursor_results(cursor)
-    print(f"Changes detected in MySQL database. Updated Google Sheet '{sheet.title}'.")
-
-def send_message(message):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
-    channel = connection.channel()
-    channel.queue_declare(queue=rabbitmq_queue, durable=True)
-    channel.basic_publish(
-        exchange='',
-        routing_key=rabbitmq_queue,
-        body=message,
-        properties=pika.BasicProperties(
-            delivery_mode=2  # Make message persistent
-        )
-    )
-    connection.close()
+    source = BinlogChangeSource(mysql_config, tables, publish)
+    binlog_sources.append(source)
+    return source.start()
 
 def monitor_and_sync():
+    start_metrics_server(PRODUCER_METRICS_PORT)
     client = get_google_sheets_client()
     connection = get_mysql_connection()
     cursor = connection.cursor()
 
-    spreadsheet = client.open("superjoin")
-    last_sheet_data = {}
-    last_db_data = {}
-
+    # Tables in CDC_TABLES are streamed from the binlog and skipped by the poll below while the stream is up
+    if CDC_TABLES:
+        start_binlog_capture(CDC_TABLES)
+
+    spreadsheet = call_sheets('read', client.open, "superjoin")
+    # Fingerprints, watermarks and the Drive version survive restarts, so a
+    # warm start only publishes what changed while the producer was down
+    state = open_state_store()
+    sheet_index = RowIndex(state, 'sheet')
+    db_index = RowIndex(state, 'db')
+    watermarks = state.get('watermarks', {})  # table -> highest row_version already published
+
+    # Each table is polled on its own interval: hot tables often, quiet ones
+    # less and less. Worksheets the Drive probe reported as changed stay stale
+    # until their table's turn comes and they are read.
+    scheduler = PollScheduler()
+    scheduler.restore(state.get('poll_schedule'))
+    stale_sheets = set(state.get('stale_sheets', []))
+    create_schedule_table(cursor)
+    connection.commit()
+    last_report = time.monotonic()
+
+    # Drive change probe, plus an optional webhook that wakes the loop early.
+    # Notifications are per file, so they make every table due.
+    probe = ChangeProbe(client, spreadsheet.id)
+    probe.mark_seen(state.get('drive_version'))
+    wake = threading.Event()
+    if DRIVE_WEBHOOK_PORT and DRIVE_WEBHOOK_ADDRESS:
+        webhook_token = uuid.uuid4().hex
+
+        def on_drive_notification():
+            probe.notify()
+            scheduler.bump_all()
+            wake.set()
+
+        start_webhook_server(DRIVE_WEBHOOK_PORT, webhook_token, on_drive_notification)
+        keep_watching(client, spreadsheet.id, DRIVE_WEBHOOK_ADDRESS, webhook_token)
+
+    worksheets = None
     while True:
-        # Track changes for each sheet
-        changes_detected = {}
+        started = time.monotonic()
+        # Track changes for each sheet as (title, change type, change set)
+        changes_detected = []
+        detected_at = {}  # table -> when its first change this cycle was seen
+        # (table, source) -> (delta, base version, version) carried in the message
+        deltas = {}
+        sheet_values = {}
+
+        # Edits made through the app ask for their table to be polled now
+        with stage('producer', 'poll_requests'):
+            for table_name in take_poll_requests(cursor):
+                scheduler.bump(table_name)
+            connection.commit()
+
+        sheet_base_version = probe.last_seen
+        try:
+            if worksheets is None:
+                # One metadata request, shared by the sheet and DB checks
+                worksheets = call_sheets('read', spreadsheet.worksheets)
+                scheduler.track([sheet.title for sheet in worksheets])
+            due = set(scheduler.due())
+
+            # One Drive call tells us whether any worksheet changed at all;
+            # it is only made when some table is due
+            with stage('producer', 'drive_probe'):
+                sheets_changed, drive_version = probe.check() if due else (False, None)
+            if sheets_changed:
+                worksheets = call_sheets('read', spreadsheet.worksheets)
+                scheduler.track([sheet.title for sheet in worksheets])
+                stale_sheets.update(sheet.title for sheet in worksheets)
+                due = set(scheduler.due())  # new worksheets are due at once
+
+            # Small worksheets are all read with one batchGet; worksheets larger
+            # than a page are streamed page by page to keep memory bounded
+            read_sheets = [sheet for sheet in worksheets if sheet.title in due and sheet.title in stale_sheets]
+            small_titles = [sheet.title for sheet in read_sheets if sheet.row_count <= SHEET_PAGE_SIZE]
+            with stage('producer', 'sheet_batch_get'):
+                sheet_values = batch_get_sheets(spreadsheet, small_titles)
+        except gspread.exceptions.APIError as e:
+            # Retries are exhausted; try again next cycle rather than exiting
+            print(f"Error reading Google Sheets, skipping this cycle: {e}")
+            wake.wait(POLL_MIN_INTERVAL_SECONDS)
+            wake.clear()
+            continue
 
         # Check Google Sheets for changes
-        for sheet in spreadsheet.worksheets():
-            current_data = sheet.get_all_values()
-            current_data_str = str(current_data)
-            last_data_str = last_sheet_data.get(sheet.title)
-
-            if last_data_str is None:
-                last_data_str = ''
-
-            if last_data_str != current_data_str:
-                changes_detected[sheet.title] = 'sheet'
-                last_sheet_data[sheet.title] = current_data_str
-
-        # Check MySQL for changes
-        for sheet in spreadsheet.worksheets():
+        for sheet in read_sheets:
+            rows = sheet_values[sheet.title] if sheet.title in sheet_values else iter_sheet_rows(sheet)
+            delta_rows = DeltaRows()
+            # Streamed worksheets are fetched while they are diffed, so this stage covers both
+            with stage('producer', 'sheet_diff', table=sheet.title):
+                change_set = sheet_index.diff(
+                    sheet.title, count_rows(delta_rows.sheet_rows(rows), sheet.title, 'sheet'),
+                    sheet_identity_key(sheet.title), delta_rows.add
+                )
+            delta_rows.stamp(time.time())
+            stale_sheets.discard(sheet.title)
+
+            if has_changes(change_set):
+                changes_detected.append((sheet.title, 'sheet', change_set))
+                detected_at.setdefault(sheet.title, time.time())
+                deltas[(sheet.title, 'sheet')] = (
+                    delta_rows.delta(change_set['deleted']), sheet_base_version,
+                    drive_version if sheets_changed else sheet_base_version
+                )
+        if sheets_changed:
+            probe.mark_seen(drive_version)
+
+        # Check MySQL for changes. Each table is probed with one primary-key
+        # lookup of its version counter; rows are only read when it moved.
+        streamed = streamed_tables(binlog_sources)
+        advance_watermarks(watermarks, binlog_sources, INITIAL_WATERMARK)
+        for sheet in worksheets:
             table_name = sheet.title
+            if table_name in streamed or table_name not in due:
+                continue
 
-            # Check if the table exists in MySQL
-            cursor.execute(f"SHOW TABLES LIKE '{table_name}'")
-            table_exists = cursor.fetchone()
-
-            if not table_exists:
+            # Check if the table exists in MySQL (served from the schema catalog)
+            if not schema_catalog.table_exists(cursor, table_name):
                 # Create the table if it doesn't exist
-                headers = sheet.row_values(1)
-                create_or_update_table(cursor, table_name, headers)
+                sample = []
+                if sheet_values.get(table_name):
+                    headers = sheet_values[table_name][0]
+                    sample = sheet_values[table_name][1:TYPE_SAMPLE_ROWS + 1]
+                else:
+                    headers = call_sheets('read', sheet.row_values, 1)
+                create_or_update_table(cursor, table_name, headers, sample)
                 connection.commit()  # Commit the table creation
+            elif table_name not in watermarks:
+                # Tables created before change tracking existed get it on first sight
+                if ensure_change_tracking(cursor, table_name, get_table_columns(cursor, table_name)):
+                    schema_catalog.invalidate()
+                connection.commit()
 
-            # Now fetch the data from the newly created or existing table
             try:
-                cursor.execute(f"SELECT * FROM {table_name}")
-                rows = cursor.fetchall()
-                headers = [desc[0] for desc in cursor.description]
-                current_db_data = [list(row) for row in rows]
-                current_db_data_str = str(current_db_data)
-                last_data_str = last_db_data.get(table_name)
-
-                if last_data_str is None:
-                    last_data_str = ''
-
-                if last_data_str != current_db_data_str:
-                    changes_detected[table_name] = 'db'
-                    last_db_data[table_name] = current_db_data_str
+                base_watermark = watermark = watermarks.get(table_name, INITIAL_WATERMARK)
+                with stage('producer', 'db_probe'):
+                    version = current_version(cursor, table_name)
+                if version <= watermark:
+                    continue
+
+                with stage('producer', 'db_fetch', table=table_name):
+                    columns = get_table_columns(cursor, table_name)
+                    headers, rows, times, deleted_ids, watermark = fetch_changes(
+                        cursor, table_name, columns, watermark, version
+                    )
+                rows_read.inc(len(rows), table=table_name, source='db')
+                delta_rows = DeltaRows(headers)
+                delta_rows.times = {db_row_key(position, row): times[position] for position, row in enumerate(rows)}
+                with stage('producer', 'db_diff', table=table_name):
+                    change_set = db_index.apply(table_name, rows, deleted_ids, db_row_key, delta_rows.add)
+                watermarks[table_name] = watermark
+                prune_tombstones(cursor, table_name, watermark)
+
+                if has_changes(change_set):
+                    changes_detected.append((table_name, 'db', change_set))
+                    detected_at.setdefault(table_name, time.time())
+                    deltas[(table_name, 'db')] = (delta_rows.delta(change_set['deleted']), base_watermark, watermark)
             except mysql.connector.errors.ProgrammingError as e:
                 print(f"Error fetching data from table '{table_name}': {e}")
+                schema_catalog.invalidate()  # the table may have been changed behind our back
                 # Skip further processing for this sheet
 
-        # Enqueue detected changes
-        for sheet_title, change_type in changes_detected.items():
-            message = f"{sheet_title}:{change_type}"
-            send_message(message)
-
+        # Enqueue detected changes, one message per table. A table that changed
+        # on both sides goes out without a delta and the consumer reads both.
+        changes_by_table = group_by_table(changes_detected)
+        with stage('producer', 'publish'):
+            for sheet_title, (change_type, change_set) in changes_by_table.items():
+                delta, base_version, version = deltas.get((sheet_title, change_type), (None, None, None))
+                message = encode_change(
+                    sheet_title, change_type, change_set, detected_at[sheet_title], delta, base_version, version
+                )
+                send_message(message, sheet_title)
+                changes_published.inc(table=sheet_title, source=change_type)
+
+        for table_name in due:
+            scheduler.record(table_name, table_name in changes_by_table, started)
+
+        # Saved only once the messages are out, so a crash before publishing
+        # means the same changes are detected again on restart
+        with stage('producer', 'state_save'):
+            state.save(
+                sheet_index.take_dirty() + db_index.take_dirty(),
+                {
+                    'watermarks': watermarks, 'drive_version': probe.last_seen,
+                    'poll_schedule': scheduler.dump(), 'stale_sheets': sorted(stale_sheets)
+                }
+            )
+
+        store_schedule(cursor, scheduler)
         connection.commit()
-        time.sleep(20)
+        publisher.keepalive()
+        for queue, depth in (publisher.queue_depths() or {}).items():
+            queue_depth.set(depth, queue=queue)
+        stage_seconds.observe(time.monotonic() - started, component='producer', stage='cycle')
+
+        if time.monotonic() - last_report >= POLL_REPORT_SECONDS:
+            print(f"Polling schedule:\n{scheduler.describe()}")
+            last_report = time.monotonic()
+
+        # Sleep until the next table is due, or until a Drive notification
+        # arrives; wake at least every POLL_MIN_INTERVAL_SECONDS for poll requests
+        wake.wait(min(scheduler.seconds_until_next(), POLL_MIN_INTERVAL_SECONDS))
+        wake.clear()
 
 
 if __name__ == "__main__":
-    monitor_and_sync()
+    parser = argparse.ArgumentParser(description="Detect Sheet/DB changes and queue them")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="poll every worksheet and table concurrently with asyncio")
+    args = parser.parse_args()
+
+    if args.use_async:
+        logging.basicConfig(level=logging.INFO)
+        if CDC_TABLES:
+            start_binlog_capture(CDC_TABLES)
+        asyncio.run(run_async_producer(
+            get_google_sheets_client(), mysql_config, rabbitmq_host, rabbitmq_queue, binlog_sources
+        ))
+    else:
+        monitor_and_sync()
@@ -0,0 +1,385 @@
+import hashlib
+import logging
+import os
+import re
+import uuid
+
+from bulk_writer import BULK_CHUNK_SIZE, chunked, normalize_row, quote_identifier
+from change_capture import user_columns
+from row_index import CELL_SEPARATOR, fingerprint_row, sheet_row_key
+from sheet_writer import row_block_updates, set_hidden_columns, snapshot_cache
+from sheets_api import call_sheets
+from type_inference import parse_table_columns
+
+# Hidden sheet column holding each row's key. The DB keeps the same value in a
+# UNIQUE column, so re-syncing a row updates it in place instead of appending.
+ROW_ID_COLUMN = '_row_id'
+ROW_ID_LENGTH = 32
+ROW_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Tables keyed by their own columns instead, e.g. "orders:order_no;stock:sku,warehouse".
+# Natural keys are compared as text, so they should be text or integer columns.
+NATURAL_KEYS = parse_table_columns(os.getenv('NATURAL_KEYS', ''))
+
+# Keys each sheet held after its last sync. A DB row is only deleted when its
+# key was in the sheet before and isn't any more, so rows added on the DB side
+# survive until they've been written to the sheet.
+SHEET_KEYS_TABLE = '_sync_sheet_keys'
+# Tables that already had rows when they got their _row_id column. Their next
+# full sheet pass removes the copies the old sync left (delete_legacy_copies)
+# once, then the mark is cleared.
+LEGACY_COPIES_TABLE = '_sync_legacy_copies'
+KEY_INDEX = 'uq_sync_row_key'
+
+# The auto-increment id belongs to MySQL and is never written from the sheet
+DB_ONLY_COLUMNS = ('id',)
+
+# Tables whose key index has been verified by this process
+verified_tables = set()
+
+
+# Columns written to the sheet: no change-tracking columns and no auto-increment id
+def sheet_columns(columns):
+    return [column for column in user_columns(columns) if column not in DB_ONLY_COLUMNS]
+
+
+def key_columns(table_name):
+    return NATURAL_KEYS.get(table_name) or [ROW_ID_COLUMN]
+
+
+def uses_row_ids(table_name):
+    return key_columns(table_name) == [ROW_ID_COLUMN]
+
+
+def new_row_id():
+    return uuid.uuid4().hex
+
+
+# Anything else in the _row_id column (blank, or edited by hand) gets a new id
+def is_row_id(value):
+    return isinstance(value, str) and bool(ROW_ID_PATTERN.match(value))
+
+
+def cell_is_blank(value):
+    return value is None or str(value).strip() == ''
+
+
+# Row ids are used as-is; natural keys (possibly several columns) as a digest
+def row_key(table_name, values):
+    cells = ['' if value is None else str(value) for value in values]
+    if uses_row_ids(table_name):
+        return cells[0]
+    return hashlib.blake2b(CELL_SEPARATOR.join(cells).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def create_identity_tables(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {SHEET_KEYS_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        row_key CHAR({ROW_ID_LENGTH}) CHARACTER SET ascii NOT NULL,
+        PRIMARY KEY (table_name, row_key)
+    )
+    """)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {LEGACY_COPIES_TABLE} (
+        table_name VARCHAR(64) NOT NULL PRIMARY KEY
+    )
+    """)
+
+
+# Give the table a UNIQUE key for upserts to land on: a _row_id column, or an
+# index over the table's NATURAL_KEYS. Existing duplicates of a natural key
+# (left by the old append-on-every-sync behaviour) are removed first, keeping
+# the oldest row. Returns True if it had to change the schema.
+def ensure_row_identity(cursor, table_name, existing_columns):
+    if table_name in verified_tables:
+        return False
+
+    cursor.execute(
+        "SELECT 1 FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1",
+        (table_name, KEY_INDEX)
+    )
+    if cursor.fetchone():
+        verified_tables.add(table_name)
+        return False
+
+    create_identity_tables(cursor)
+    columns = key_columns(table_name)
+    table = quote_identifier(table_name)
+
+    if uses_row_ids(table_name):
+        add_column = '' if ROW_ID_COLUMN in existing_columns else (
+            f"ADD COLUMN {quote_identifier(ROW_ID_COLUMN)} CHAR({ROW_ID_LENGTH}) CHARACTER SET ascii NULL, "
+        )
+        if add_column:
+            cursor.execute(f"SELECT 1 FROM {table} LIMIT 1")
+            if cursor.fetchone():
+                cursor.execute(f"INSERT IGNORE INTO {LEGACY_COPIES_TABLE} (table_name) VALUES (%s)", (table_name,))
+        cursor.execute(f"ALTER TABLE {table} {add_column}ADD UNIQUE INDEX {KEY_INDEX} ({quote_identifier(ROW_ID_COLUMN)})")
+    else:
+        missing = [column for column in columns if column not in existing_columns]
+        if missing:
+            logging.warning(f"Natural key columns {missing} don't exist in '{table_name}' yet")
+            return False
+
+        matches = ' AND '.join(f'newer.{quote_identifier(column)} <=> older.{quote_identifier(column)}' for column in columns)
+        cursor.execute(f"DELETE newer FROM {table} newer JOIN {table} older ON {matches} AND newer.id > older.id")
+        if cursor.rowcount:
+            logging.info(f"Removed {cursor.rowcount} duplicate rows from '{table_name}'")
+        cursor.execute(
+            f"ALTER TABLE {table} ADD UNIQUE INDEX {KEY_INDEX} ({', '.join(quote_identifier(column) for column in columns)})"
+        )
+
+    verified_tables.add(table_name)
+    logging.info(f"Keyed '{table_name}' on {', '.join(columns)}")
+    return True
+
+
+# Rows inserted on the DB side (e.g. from app.py) get their _row_id before they
+# are written to the sheet
+def assign_missing_row_ids(cursor, table_name):
+    if not uses_row_ids(table_name):
+        return 0
+    cursor.execute(
+        f"UPDATE {quote_identifier(table_name)} SET {quote_identifier(ROW_ID_COLUMN)} = REPLACE(UUID(), '-', '') "
+        f"WHERE {quote_identifier(ROW_ID_COLUMN)} IS NULL"
+    )
+    return cursor.rowcount
+
+
+def load_sheet_keys(cursor, table_name):
+    cursor.execute(f"SELECT row_key FROM {SHEET_KEYS_TABLE} WHERE table_name = %s", (table_name,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+# Move the stored key set from `previous` to `current` touching only the difference
+def store_sheet_keys(cursor, table_name, previous, current):
+    for chunk in chunked(sorted(previous - current), BULK_CHUNK_SIZE):
+        cursor.execute(
+            f"DELETE FROM {SHEET_KEYS_TABLE} WHERE table_name = %s AND row_key IN ({', '.join(['%s'] * len(chunk))})",
+            [table_name] + chunk
+        )
+    for chunk in chunked(sorted(current - previous), BULK_CHUNK_SIZE):
+        cursor.execute(
+            f"INSERT IGNORE INTO {SHEET_KEYS_TABLE} (table_name, row_key) VALUES {', '.join(['(%s, %s)'] * len(chunk))}",
+            [value for key in chunk for value in (table_name, key)]
+        )
+
+
+# Record the keys now in the sheet, e.g. after the whole table was written to it
+def remember_sheet_keys(cursor, table_name, keys):
+    create_identity_tables(cursor)
+    store_sheet_keys(cursor, table_name, load_sheet_keys(cursor, table_name), set(keys))
+
+
+# Keys of rows read from the table; `headers` must include the key columns
+def db_row_keys(table_name, headers, rows):
+    indexes = [headers.index(column) for column in key_columns(table_name)]
+    return {row_key(table_name, [row[index] for index in indexes]) for row in rows}
+
+
+def delete_rows_by_key(cursor, table_name, keys):
+    if not keys:
+        return 0
+
+    table = quote_identifier(table_name)
+    if uses_row_ids(table_name):
+        ids = sorted(keys)
+        column = quote_identifier(ROW_ID_COLUMN)
+    else:
+        # Natural keys are stored as digests, so find the matching rows first
+        columns = key_columns(table_name)
+        cursor.execute(f"SELECT id, {', '.join(quote_identifier(column) for column in columns)} FROM {table}")
+        ids = [row[0] for row in cursor.fetchall() if row_key(table_name, row[1:]) in keys]
+        column = 'id'
+
+    deleted = 0
+    for chunk in chunked(ids, BULK_CHUNK_SIZE):
+        cursor.execute(f"DELETE FROM {table} WHERE {column} IN ({', '.join(['%s'] * len(chunk))})", chunk)
+        deleted += cursor.rowcount
+    return deleted
+
+
+# Rows from before tables had a _row_id have none, and the old sync appended a
+# copy of every sheet row on every run. Any such row whose values match a
+# current sheet row is one of those copies; rows matching nothing are DB-side
+# inserts and are left for the DB -> sheet sync to pick up. Only run once per
+# table, for tables marked in LEGACY_COPIES_TABLE: later on a row without a
+# _row_id is one just inserted on the DB side, which may well match a sheet row.
+def delete_legacy_copies(cursor, table_name, headers, fingerprints):
+    cursor.execute(f"SELECT 1 FROM {LEGACY_COPIES_TABLE} WHERE table_name = %s", (table_name,))
+    if not cursor.fetchone():
+        return 0
+    cursor.execute(f"DELETE FROM {LEGACY_COPIES_TABLE} WHERE table_name = %s", (table_name,))
+
+    table = quote_identifier(table_name)
+    cursor.execute(
+        f"SELECT id, {', '.join(quote_identifier(header) for header in headers)} FROM {table} "
+        f"WHERE {quote_identifier(ROW_ID_COLUMN)} IS NULL"
+    )
+    ids = [row[0] for row in cursor.fetchall() if fingerprint_row(row[1:]) in fingerprints]
+
+    for chunk in chunked(ids, BULK_CHUNK_SIZE):
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(chunk))})", chunk)
+    return len(ids)
+
+
+# Keys one sheet -> DB pass. rows() drops rows with no data, gives rows with no
+# _row_id (or a repeated one, e.g. after a copy-paste) a fresh id, and leaves
+# out DB-only columns. After the rows are written, finish() deletes DB rows
+# that left the sheet and write_back() stores the new ids in the sheet with a
+# single batch_update, adding and hiding the _row_id column the first time.
+class SheetRowKeys:
+    def __init__(self, sheet, headers):
+        self.sheet = sheet
+        self.table = sheet.title
+        self.headers = list(headers)
+        self.added_id_column = uses_row_ids(self.table) and ROW_ID_COLUMN not in self.headers
+        if self.added_id_column:
+            self.headers.append(ROW_ID_COLUMN)
+
+        missing = [column for column in key_columns(self.table) if column not in self.headers]
+        if missing:
+            raise ValueError(f"Sheet '{self.table}' is missing its key columns {missing}")
+
+        self.key_indexes = [self.headers.index(column) for column in key_columns(self.table)]
+        self.write_indexes = [index for index, header in enumerate(self.headers) if header not in DB_ONLY_COLUMNS]
+        self.write_headers = [self.headers[index] for index in self.write_indexes]
+        self.data_headers = [header for header in self.write_headers if header != ROW_ID_COLUMN]
+        self.data_indexes = [self.headers.index(header) for header in self.data_headers]
+
+        self.keys = set()
+        self.fingerprints = set()
+        self.new_ids = []  # (sheet row number, row id)
+        self.read_fingerprints = {}  # sheet row number -> fingerprint as read, for rows given a new id
+        self.row_numbers = {}  # key -> sheet row number
+        self.last_row_number = 1
+        self.skipped = 0
+
+    # `first_row_number` is the sheet row the first of `rows` came from, for
+    # passes over one range of the sheet (see backfill.py)
+    def rows(self, rows, first_row_number=2):
+        for row_number, row in enumerate(rows, start=first_row_number):
+            self.last_row_number = row_number
+            row = normalize_row(row, len(self.headers))
+            if all(cell_is_blank(row[index]) for index in self.data_indexes):
+                continue
+
+            key_values = [row[index] for index in self.key_indexes]
+            if uses_row_ids(self.table):
+                if not is_row_id(key_values[0]) or key_values[0] in self.keys:
+                    self.read_fingerprints[row_number] = fingerprint_row(row)
+                    key_values = [new_row_id()]
+                    row[self.key_indexes[0]] = key_values[0]
+                    self.new_ids.append((row_number, key_values[0]))
+                self.fingerprints.add(fingerprint_row([row[index] for index in self.data_indexes]))
+            elif all(cell_is_blank(value) for value in key_values):
+                self.skipped += 1
+                continue
+
+            key = row_key(self.table, key_values)
+            self.keys.add(key)
+            self.row_numbers[key] = row_number
+            yield [row[index] for index in self.write_indexes]
+
+    # Delete DB rows whose key was in the sheet last time but isn't now, then
+    # record the current keys. Returns the number of rows deleted.
+    def finish(self, connection):
+        cursor = connection.cursor()
+        try:
+            create_identity_tables(cursor)
+            previous = load_sheet_keys(cursor, self.table)
+            deleted = delete_rows_by_key(cursor, self.table, previous - self.keys)
+            if uses_row_ids(self.table) and self.fingerprints:
+                deleted += delete_legacy_copies(cursor, self.table, self.data_headers, self.fingerprints)
+            store_sheet_keys(cursor, self.table, previous, self.keys)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        if self.skipped:
+            logging.warning(f"Skipped {self.skipped} rows of '{self.table}' with an empty key")
+        if deleted:
+            logging.info(f"Deleted {deleted} rows from '{self.table}' that are no longer in the sheet")
+        return deleted
+
+    # When the write fails part way, remember the keys handed out so far. Rows
+    # that did reach the DB under ids the sheet never got are then deleted by
+    # the next pass instead of being left behind.
+    def abandon(self, connection):
+        cursor = connection.cursor()
+        try:
+            create_identity_tables(cursor)
+            previous = load_sheet_keys(cursor, self.table)
+            store_sheet_keys(cursor, self.table, previous, previous | self.keys)
+            connection.commit()
+        finally:
+            cursor.close()
+
+    # Sheet rows (of the new ids, and the header row when the id column is being
+    # added) that no longer hold what they did when read: rows inserted,
+    # deleted or sorted in the sheet since would otherwise get another row's id
+    def changed_rows(self):
+        expected = dict(self.read_fingerprints)
+        if self.added_id_column:
+            expected[1] = fingerprint_row(self.headers[:-1])
+        if not expected:
+            return set()
+
+        first = min(expected)
+        values = call_sheets('read', self.sheet.get_values, f"{first}:{max(expected)}")
+        changed = set()
+        for row_number, fingerprint in expected.items():
+            position = row_number - first
+            row = values[position] if position < len(values) else []
+            if fingerprint_row(normalize_row(row, len(self.headers))) != fingerprint:
+                changed.add(row_number)
+        return changed
+
+    # Store the new ids in the sheet. Rows that changed since they were read
+    # are left without one: the next pass gives them a fresh id, and deletes the
+    # DB row written under the unused one as a key that left the sheet.
+    def write_back(self):
+        changed = self.changed_rows()
+        if 1 in changed:
+            logging.warning(f"Header row of '{self.table}' changed while it was synced; not writing its row ids")
+            return 0
+        if changed:
+            logging.warning(f"{len(changed)} rows of '{self.table}' moved while they were synced; their ids are left for the next pass")
+
+        column = self.headers.index(ROW_ID_COLUMN) + 1 if ROW_ID_COLUMN in self.headers else None
+        cells = [(row_number, [row_id]) for row_number, row_id in self.new_ids if row_number not in changed]
+        if self.added_id_column:
+            if len(self.headers) > self.sheet.col_count:
+                call_sheets('write', self.sheet.add_cols, len(self.headers) - self.sheet.col_count)
+            cells.append((1, [ROW_ID_COLUMN]))
+
+        if cells:
+            call_sheets('write', self.sheet.batch_update, row_block_updates(cells, column))
+            snapshot_cache.invalidate(self.sheet)
+        if self.added_id_column:
+            set_hidden_columns(self.sheet, self.headers, {ROW_ID_COLUMN})
+        return len(self.new_ids) - len(changed)
+
+
+# RowIndex key function for raw sheet rows (header row first). Rows are keyed
+# by their _row_id or natural key; the header row, and rows that haven't been
+# given an id yet, fall back to their sheet row number.
+def sheet_identity_key(table_name):
+    key_indexes = []
+
+    def key(position, row):
+        if position == 0:
+            key_indexes[:] = [row.index(column) if column in row else None for column in key_columns(table_name)]
+            return sheet_row_key(position, row)
+
+        values = [row[index] if index is not None and index < len(row) else '' for index in key_indexes]
+        if all(cell_is_blank(value) for value in values):
+            return sheet_row_key(position, row)
+        return row_key(table_name, values)
+
+    return key
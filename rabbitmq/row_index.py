@@ -0,0 +1,133 @@
+import hashlib
+
+# Cells are joined with the ASCII unit separator so ['a', 'bc'] and ['ab', 'c']
+# don't produce the same fingerprint. None (from MySQL) and '' (from Sheets)
+# intentionally hash the same.
+CELL_SEPARATOR = '\x1f'
+
+
+# Stable 8-byte fingerprint for a single row. Trailing empty cells are ignored
+# because batchGet returns ragged rows while get_values() pads them.
+def fingerprint_row(row):
+    cells = ['' if value is None else str(value) for value in row]
+    while cells and cells[-1] == '':
+        cells.pop()
+    encoded = CELL_SEPARATOR.join(cells)
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=8).digest()
+
+
+# Keys rows by their 1-based position in the sheet (row 1 is the header row)
+def sheet_row_key(position, row):
+    return position + 1
+
+
+# Keys rows by the table's primary key, which is always the first column
+def db_row_key(position, row):
+    return row[0]
+
+
+def empty_change_set():
+    return {'inserted': [], 'updated': [], 'deleted': []}
+
+
+def has_changes(change_set):
+    return bool(change_set['inserted'] or change_set['updated'] or change_set['deleted'])
+
+
+# Per-table index of row fingerprints. Instead of holding str() copies of whole
+# tables, only an 8-byte digest per row key is kept, and each diff reports the
+# exact keys that were inserted, updated or deleted since the previous call.
+# With a state store (see sync_state.py) a table's fingerprints are loaded from
+# it on first use, and take_dirty() hands back what changed since for saving.
+class RowIndex:
+    def __init__(self, store=None, name='rows'):
+        self.tables = {}
+        self.store = store
+        self.name = name
+        self.dirty = {}  # table -> keys whose fingerprint changed or was removed
+
+    def fingerprints_for(self, table):
+        if table not in self.tables:
+            self.tables[table] = self.store.load_fingerprints(self.name, table) if self.store else {}
+        return self.tables[table]
+
+    def mark_dirty(self, table, keys):
+        if self.store is not None and keys:
+            self.dirty.setdefault(table, set()).update(keys)
+
+    # Fingerprint changes since the last call, as state store save() expects them
+    def take_dirty(self):
+        changes = []
+        for table, keys in self.dirty.items():
+            fingerprints = self.tables.get(table, {})
+            changed = {key: fingerprints[key] for key in keys if key in fingerprints}
+            deleted = [key for key in keys if key not in fingerprints]
+            changes.append((self.name, table, changed, deleted))
+        self.dirty = {}
+        return changes
+
+    # `on_change(key, row)` is called for every inserted or updated row, e.g.
+    # to carry their cells in the change message (see messages.DeltaRows)
+    def diff(self, table, rows, key_func, on_change=None):
+        fingerprints = self.fingerprints_for(table)
+        change_set = empty_change_set()
+        seen = set()
+
+        for position, row in enumerate(rows):
+            key = key_func(position, row)
+            seen.add(key)
+            digest = fingerprint_row(row)
+            previous = fingerprints.get(key)
+
+            if previous is None:
+                change_set['inserted'].append(key)
+            elif previous != digest:
+                change_set['updated'].append(key)
+            else:
+                continue
+            fingerprints[key] = digest
+            if on_change is not None:
+                on_change(key, row)
+
+        # Only keys that disappeared need touching here; unchanged rows were
+        # skipped above so the index is updated in place rather than rebuilt
+        if len(seen) != len(fingerprints):
+            change_set['deleted'] = [key for key in fingerprints if key not in seen]
+            for key in change_set['deleted']:
+                del fingerprints[key]
+
+        self.mark_dirty(table, change_set['inserted'] + change_set['updated'] + change_set['deleted'])
+        return change_set
+
+    # Fold in only the rows known to have been touched (e.g. rows above a
+    # version watermark) plus deleted keys, without seeing the whole table.
+    # Rows rewritten with identical values are not reported.
+    def apply(self, table, rows, deleted_keys, key_func, on_change=None):
+        fingerprints = self.fingerprints_for(table)
+        change_set = empty_change_set()
+
+        for position, row in enumerate(rows):
+            key = key_func(position, row)
+            digest = fingerprint_row(row)
+            previous = fingerprints.get(key)
+
+            if previous is None:
+                change_set['inserted'].append(key)
+            elif previous != digest:
+                change_set['updated'].append(key)
+            else:
+                continue
+            fingerprints[key] = digest
+            if on_change is not None:
+                on_change(key, row)
+
+        for key in deleted_keys:
+            if fingerprints.pop(key, None) is not None:
+                change_set['deleted'].append(key)
+
+        self.mark_dirty(table, change_set['inserted'] + change_set['updated'] + change_set['deleted'])
+        return change_set
+
+    def forget(self, table):
+        self.mark_dirty(table, self.fingerprints_for(table).keys())
+        self.tables[table] = {}
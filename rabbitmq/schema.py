@@ -0,0 +1,146 @@
+import logging
+import os
+import threading
+import time
+
+import mysql.connector
+
+from bulk_writer import quote_identifier
+from change_capture import ensure_change_tracking, is_internal_table
+from row_identity import ROW_ID_COLUMN, ensure_row_identity, verified_tables
+from type_inference import ColumnTypes, ensure_lookup_indexes, infer_column_types, parse_sql_type, sql_type
+
+# How long cached table/column metadata is trusted before it is re-read. DDL
+# run by this code invalidates the cache immediately; the TTL only matters for
+# schema changes made by someone else.
+SCHEMA_CACHE_TTL_SECONDS = float(os.getenv('SCHEMA_CACHE_TTL_SECONDS', '300'))
+
+# DDL errors meaning another process (usually the producer) changed the table
+# first: table exists, duplicate column, duplicate index name
+SCHEMA_RACE_ERRORS = (1050, 1060, 1061)
+
+
+# In-process catalog of tables, column names and column types. Instead of a
+# SHOW TABLES / DESCRIBE round-trip per table per sync, the whole schema is
+# loaded from information_schema in one query and served from memory.
+class SchemaCatalog:
+    def __init__(self, ttl=SCHEMA_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.tables = None  # table -> [(column, column type), ...] in ordinal order
+        self.loaded_at = 0.0
+
+    def refresh(self, cursor):
+        cursor.execute("""
+        SELECT table_name, column_name, column_type
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE()
+        ORDER BY table_name, ordinal_position
+        """)
+        tables = {}
+        for table_name, column_name, column_type in cursor.fetchall():
+            tables.setdefault(table_name, []).append((column_name, column_type))
+        self.tables = tables
+        self.loaded_at = time.monotonic()
+
+    def snapshot(self, cursor):
+        with self.lock:
+            if self.tables is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.refresh(cursor)
+            return self.tables
+
+    def invalidate(self):
+        with self.lock:
+            self.tables = None
+
+    def table_exists(self, cursor, table_name):
+        return table_name in self.snapshot(cursor)
+
+    def table_names(self, cursor):
+        return [table for table in self.snapshot(cursor) if not is_internal_table(table)]
+
+    def columns(self, cursor, table_name):
+        return [column for column, _ in self.snapshot(cursor).get(table_name, [])]
+
+    def column_types(self, cursor, table_name):
+        return dict(self.snapshot(cursor).get(table_name, []))
+
+
+schema_catalog = SchemaCatalog()
+
+
+# Clears pending results from MySQL cursor
+def clear_cursor_results(cursor):
+    while cursor.nextset():
+        pass
+
+
+# Get MySQL table columns
+def get_table_columns(cursor, table_name):
+    return schema_catalog.columns(cursor, table_name)
+
+
+# Typed columns of an existing table, for converting sheet values on write
+def table_column_types(cursor, table_name):
+    types = {column: parse_sql_type(column_type) for column, column_type in schema_catalog.column_types(cursor, table_name).items()}
+    return ColumnTypes(table_name, types, schema_catalog.invalidate)
+
+
+# Create or update MySQL table based on Google Sheets headers. Column types are
+# inferred from `sample_rows` (data rows, without the header); columns with no
+# sample values get VARCHAR(255) and are widened later if needed. The _row_id
+# key column is added by ensure_row_identity rather than typed from the sheet.
+#
+# The catalog may be behind a table or column another process just created;
+# such a DDL error reloads it and the change is worked out again once.
+def create_or_update_table(cursor, sheet_name, headers, sample_rows=()):
+    clear_cursor_results(cursor)
+    types = infer_column_types(headers, sample_rows)
+    try:
+        update_table_schema(cursor, sheet_name, headers, types)
+    except mysql.connector.Error as e:
+        if e.errno not in SCHEMA_RACE_ERRORS:
+            raise
+        logging.info(f"Schema of '{sheet_name}' changed under us ({e.msg}); reloading it")
+        clear_cursor_results(cursor)
+        schema_catalog.invalidate()
+        update_table_schema(cursor, sheet_name, headers, types)
+
+
+def update_table_schema(cursor, sheet_name, headers, types):
+    if schema_catalog.table_exists(cursor, sheet_name):
+        existing_columns = get_table_columns(cursor, sheet_name)
+        new_columns = [header for header in headers if header not in existing_columns and header != ROW_ID_COLUMN]
+
+        if new_columns:
+            added = ', '.join(f"ADD COLUMN {quote_identifier(col)} {sql_type(types[col])}" for col in new_columns)
+            alter_sql = f"ALTER TABLE {quote_identifier(sheet_name)} {added}"
+            cursor.execute(alter_sql)
+            clear_cursor_results(cursor)
+            schema_catalog.invalidate()
+        if ensure_change_tracking(cursor, sheet_name, existing_columns):
+            schema_catalog.invalidate()
+        if ensure_row_identity(cursor, sheet_name, get_table_columns(cursor, sheet_name)):
+            schema_catalog.invalidate()
+        if new_columns and ensure_lookup_indexes(cursor, sheet_name, headers):
+            schema_catalog.invalidate()
+    else:
+        create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {quote_identifier(sheet_name)} (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            {', '.join(f'{quote_identifier(header)} {sql_type(types[header])}' for header in headers if header != ROW_ID_COLUMN)}
+        )
+        """
+        cursor.execute(create_sql)
+        clear_cursor_results(cursor)
+        if cursor.warning_count:
+            # Possibly note 1050: created by someone else since the catalog was loaded
+            schema_catalog.invalidate()
+            if schema_catalog.table_exists(cursor, sheet_name):
+                return update_table_schema(cursor, sheet_name, headers, types)
+        ensure_change_tracking(cursor, sheet_name, [])
+        verified_tables.discard(sheet_name)  # in case a table of this name was dropped
+        ensure_row_identity(cursor, sheet_name, [header for header in headers if header != ROW_ID_COLUMN])
+        ensure_lookup_indexes(cursor, sheet_name, headers)
+        schema_catalog.invalidate()
+        logging.info(f"Created MySQL table for sheet: {sheet_name}")
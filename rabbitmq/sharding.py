@@ -0,0 +1,72 @@
+import os
+import zlib
+
+# Changes are routed through a direct exchange to one of SHARD_COUNT queues by
+# a stable hash of the table name. Every change for a table lands on the same
+# shard, and each shard queue has a single active consumer, so a table's
+# changes are applied in order while different tables spread across processes.
+SYNC_EXCHANGE = os.getenv('SYNC_EXCHANGE', 'sync_exchange')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '8'))
+
+# A change that fails is not requeued at once or dropped: it is published to
+# the retry exchange, whose per-shard queue holds it for SYNC_RETRY_DELAY_MS
+# and then dead-letters it back to its shard queue. After SYNC_MAX_ATTEMPTS
+# failures it is parked in "<queue>.parked" for someone to look at.
+SYNC_RETRY_EXCHANGE = os.getenv('SYNC_RETRY_EXCHANGE', 'sync_retry_exchange')
+SYNC_RETRY_DELAY_MS = int(os.getenv('SYNC_RETRY_DELAY_MS', '30000'))
+SYNC_MAX_ATTEMPTS = int(os.getenv('SYNC_MAX_ATTEMPTS', '10'))
+ATTEMPTS_HEADER = 'x-sync-attempts'
+
+
+def shard_for(table_name, shard_count=SHARD_COUNT):
+    return zlib.crc32(table_name.encode('utf-8')) % shard_count
+
+
+def routing_key_for(table_name, shard_count=SHARD_COUNT):
+    return str(shard_for(table_name, shard_count))
+
+
+def shard_queue(queue_base, shard):
+    return f"{queue_base}.{shard}"
+
+
+def retry_queue(queue_base, shard):
+    return f"{shard_queue(queue_base, shard)}.retry"
+
+
+def parked_queue(queue_base):
+    return f"{queue_base}.parked"
+
+
+# Where a change that just failed goes next: (exchange, routing key, headers).
+# `table_name` is None for a message that couldn't be parsed, which is parked
+# straight away.
+def retry_route(queue_base, table_name, headers, max_attempts=SYNC_MAX_ATTEMPTS):
+    attempts = int((headers or {}).get(ATTEMPTS_HEADER, 0)) + 1
+    headers = {**(headers or {}), ATTEMPTS_HEADER: attempts}
+    if table_name is None or attempts >= max_attempts:
+        return '', parked_queue(queue_base), headers
+    return SYNC_RETRY_EXCHANGE, routing_key_for(table_name), headers
+
+
+# Shards handled by worker process `index` out of `process_count`
+def shards_for_process(index, process_count, shard_count=SHARD_COUNT):
+    return [shard for shard in range(shard_count) if shard % process_count == index]
+
+
+def declare_topology(channel, queue_base, shard_count=SHARD_COUNT):
+    channel.exchange_declare(exchange=SYNC_EXCHANGE, exchange_type='direct', durable=True)
+    for shard in range(shard_count):
+        queue = shard_queue(queue_base, shard)
+        channel.queue_declare(queue=queue, durable=True, arguments={'x-single-active-consumer': True})
+        channel.queue_bind(queue=queue, exchange=SYNC_EXCHANGE, routing_key=str(shard))
+
+    channel.exchange_declare(exchange=SYNC_RETRY_EXCHANGE, exchange_type='direct', durable=True)
+    for shard in range(shard_count):
+        queue = retry_queue(queue_base, shard)
+        channel.queue_declare(queue=queue, durable=True, arguments={
+            'x-message-ttl': SYNC_RETRY_DELAY_MS,
+            'x-dead-letter-exchange': SYNC_EXCHANGE,  # keeps the routing key, i.e. the shard
+        })
+        channel.queue_bind(queue=queue, exchange=SYNC_RETRY_EXCHANGE, routing_key=str(shard))
+    channel.queue_declare(queue=parked_queue(queue_base), durable=True)
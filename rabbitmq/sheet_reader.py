@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from sheets_api import call_sheets
+
+# Rows fetched per Sheets API request when streaming a worksheet
+SHEET_PAGE_SIZE = int(os.getenv('SHEET_PAGE_SIZE', '5000'))
+
+
+# Whole-row A1 range ("5001:10000") so every column comes back without knowing the width
+def fetch_page(sheet, start_row, end_row):
+    return call_sheets('read', sheet.get_values, f"{start_row}:{end_row}")
+
+
+# Yield a worksheet's rows (header row first) one page at a time instead of
+# loading it with get_all_values(). The next page is fetched on a background
+# thread while the caller works through the current one, so at most two pages
+# are held in memory.
+#
+# The API trims trailing blank rows from each page. Those gaps are only
+# emitted once a later page turns out to have data, so row positions match
+# get_all_values() and trailing blank rows at the end of the sheet are dropped.
+def iter_sheet_rows(sheet, page_size=SHEET_PAGE_SIZE):
+    total_rows = sheet.row_count
+    pending_blank_rows = 0
+    if total_rows < 1:
+        return
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheet-prefetch') as prefetcher:
+        start_row = 1
+        next_page = prefetcher.submit(fetch_page, sheet, start_row, min(start_row + page_size - 1, total_rows))
+
+        while next_page is not None:
+            page = next_page.result()
+            requested = min(page_size, total_rows - start_row + 1)
+
+            start_row += page_size
+            next_page = None
+            if start_row <= total_rows:
+                next_page = prefetcher.submit(fetch_page, sheet, start_row, min(start_row + page_size - 1, total_rows))
+
+            if page:
+                for _ in range(pending_blank_rows):
+                    yield []
+                pending_blank_rows = 0
+                yield from page
+            pending_blank_rows += requested - len(page)
@@ -0,0 +1,148 @@
+import logging
+import threading
+
+from gspread.utils import rowcol_to_a1
+
+from sheets_api import call_sheets
+
+
+# What a cell looks like once it's in the sheet; used for comparisons
+def cell_text(value):
+    return '' if value is None else str(value)
+
+
+# Numbers go to the sheet as numbers, everything else (dates, decimals) as text
+def cell_value(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return cell_text(value)
+
+
+def rows_differ(old_row, new_row):
+    width = max(len(old_row), len(new_row))
+    old_cells = [cell_text(value) for value in old_row] + [''] * (width - len(old_row))
+    new_cells = [cell_text(value) for value in new_row] + [''] * (width - len(new_row))
+    return old_cells != new_cells
+
+
+# Minimal set of A1 ranges that turn `old_rows` into `new_rows`. Consecutive
+# changed rows are grouped into one range; rows past the end of the old data
+# are appended, and rows past the end of the new data are blanked, so neither
+# case rewrites the unchanged body of the sheet.
+def compute_range_updates(old_rows, new_rows):
+    width = max([len(row) for row in old_rows] + [len(row) for row in new_rows] + [1])
+    updates = []
+    block_start = None
+    block_values = []
+
+    def close_block(end_index):
+        start_a1 = rowcol_to_a1(block_start + 1, 1)
+        end_a1 = rowcol_to_a1(end_index + 1, width)
+        updates.append({'range': f'{start_a1}:{end_a1}', 'values': block_values})
+
+    for index in range(max(len(old_rows), len(new_rows))):
+        old_row = old_rows[index] if index < len(old_rows) else []
+        new_row = new_rows[index] if index < len(new_rows) else []
+
+        if rows_differ(old_row, new_row):
+            if block_start is None:
+                block_start = index
+                block_values = []
+            block_values.append([cell_value(value) for value in new_row] + [''] * (width - len(new_row)))
+        elif block_start is not None:
+            close_block(index - 1)
+            block_start = None
+
+    if block_start is not None:
+        close_block(block_start + len(block_values) - 1)
+
+    return updates
+
+
+# batch_update ranges for whole rows written at known sheet row numbers.
+# `rows` is [(row number, values)] in any order; runs of consecutive rows share
+# one range starting at `first_column`.
+def row_block_updates(rows, first_column=1):
+    runs = []  # [first row number, [values, ...]]
+    for row_number, values in sorted(rows, key=lambda item: item[0]):
+        if runs and runs[-1][0] + len(runs[-1][1]) == row_number:
+            runs[-1][1].append(values)
+        else:
+            runs.append([row_number, [values]])
+
+    updates = []
+    for first_row, block in runs:
+        width = max(len(values) for values in block)
+        start_a1 = rowcol_to_a1(first_row, first_column)
+        end_a1 = rowcol_to_a1(first_row + len(block) - 1, first_column + max(width, 1) - 1)
+        updates.append({
+            'range': f'{start_a1}:{end_a1}',
+            'values': [[cell_value(value) for value in values] + [''] * (width - len(values)) for values in block],
+        })
+    return updates
+
+
+# Last values written to (or read from) each worksheet, so the next write can be
+# diffed locally instead of clearing and rewriting the whole sheet
+class SheetSnapshotCache:
+    def __init__(self):
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def get(self, sheet):
+        with self.lock:
+            snapshot = self.snapshots.get(sheet.id)
+        if snapshot is None:
+            # One read to seed the cache beats a clear + full rewrite
+            snapshot = call_sheets('read', sheet.get_all_values)
+        return snapshot
+
+    def put(self, sheet, rows):
+        with self.lock:
+            self.snapshots[sheet.id] = [[cell_text(value) for value in row] for row in rows]
+
+    def invalidate(self, sheet):
+        with self.lock:
+            self.snapshots.pop(sheet.id, None)
+
+
+snapshot_cache = SheetSnapshotCache()
+
+
+# Hide the columns whose header is in `hidden` and show the rest. Only needed
+# when the header row changes, since hidden columns don't move with their data.
+def set_hidden_columns(sheet, headers, hidden):
+    call_sheets('write', sheet.unhide_columns, 0, len(headers))
+    for index, header in enumerate(headers):
+        if header in hidden:
+            call_sheets('write', sheet.hide_columns, index, index + 1)
+
+
+# Write `rows` (header row included) to the sheet as a single batch_update of
+# only the ranges that changed. Returns the number of ranges written.
+# Columns named in `hidden_columns` are kept hidden if the header row moves.
+def write_table(sheet, rows, cache=snapshot_cache, hidden_columns=()):
+    old_rows = cache.get(sheet)
+    updates = compute_range_updates(old_rows, rows)
+
+    if updates:
+        # Grow the grid first when appending past its current size
+        width = max(len(row) for row in rows) if rows else 0
+        if len(rows) > sheet.row_count:
+            call_sheets('write', sheet.add_rows, len(rows) - sheet.row_count)
+        if width > sheet.col_count:
+            call_sheets('write', sheet.add_cols, width - sheet.col_count)
+
+        try:
+            call_sheets('write', sheet.batch_update, updates)
+        except Exception:
+            # The sheet may now be partly written; re-read it next time
+            cache.invalidate(sheet)
+            raise
+
+    if hidden_columns and rows and rows_differ(old_rows[0] if old_rows else [], rows[0]):
+        set_hidden_columns(sheet, rows[0], hidden_columns)
+
+    cache.put(sheet, rows)
+    logging.info(f"Wrote {sum(len(update['values']) for update in updates)} rows in {len(updates)} ranges to '{sheet.title}'")
+    return len(updates)
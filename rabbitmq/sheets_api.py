@@ -0,0 +1,105 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from gspread.exceptions import APIError
+
+from telemetry import sheets_api_calls, sheets_api_errors, sheets_api_seconds, sheets_api_throttled
+
+# Sheets API per-user quotas are 60 read and 60 write requests per minute by
+# default. Each process gets its own buckets, so lower these when running
+# several producer/consumer processes against the same project.
+SHEETS_READS_PER_MINUTE = float(os.getenv('SHEETS_READS_PER_MINUTE', '60'))
+SHEETS_WRITES_PER_MINUTE = float(os.getenv('SHEETS_WRITES_PER_MINUTE', '60'))
+
+# Drive metadata calls (change probes, watch channels) have a separate, larger quota
+DRIVE_REQUESTS_PER_MINUTE = float(os.getenv('DRIVE_REQUESTS_PER_MINUTE', '600'))
+
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '6'))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 64.0
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Classic token bucket: `rate_per_minute` tokens drip in continuously up to
+# `capacity`, and every API call takes one, blocking until one is available
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity or max(1.0, rate_per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate_per_second
+            time.sleep(wait)
+
+
+limiters = {
+    'read': TokenBucket(SHEETS_READS_PER_MINUTE),
+    'write': TokenBucket(SHEETS_WRITES_PER_MINUTE),
+    'drive': TokenBucket(DRIVE_REQUESTS_PER_MINUTE),
+}
+
+
+def status_of(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+# "Full jitter" exponential backoff: a random wait up to base * 2^attempt
+def backoff_seconds(attempt):
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+# Every Sheets API call goes through here: it takes a token from the read,
+# write or drive bucket and retries 429s and 5xx responses with jittered backoff.
+# Each attempt is counted and timed in the sheets_api_* metrics.
+def call_sheets(kind, func, *args, **kwargs):
+    method = getattr(func, '__name__', 'call')
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        limiters[kind].acquire()
+        sheets_api_calls.inc(kind=kind, method=method)
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except APIError as e:
+            sheets_api_seconds.observe(time.perf_counter() - started, kind=kind)
+            status = status_of(e)
+            sheets_api_errors.inc(kind=kind, status=status)
+            if status == 429:
+                sheets_api_throttled.inc(kind=kind)
+            if status not in RETRYABLE_STATUSES or attempt == SHEETS_MAX_RETRIES:
+                raise
+            wait = backoff_seconds(attempt)
+            logging.warning(f"Sheets API returned {status}, retrying in {wait:.1f}s (attempt {attempt + 1})")
+            time.sleep(wait)
+        else:
+            sheets_api_seconds.observe(time.perf_counter() - started, kind=kind)
+            return result
+
+
+def quote_sheet_title(title):
+    return "'" + title.replace("'", "''") + "'"
+
+
+# Read several whole worksheets with a single values:batchGet request.
+# Returns {title: rows}; like get_all_values(), trailing blank rows are dropped.
+def batch_get_sheets(spreadsheet, titles):
+    if not titles:
+        return {}
+    response = call_sheets('read', spreadsheet.values_batch_get, [quote_sheet_title(title) for title in titles])
+    value_ranges = response.get('valueRanges', [])
+    return {title: value_range.get('values', []) for title, value_range in zip(titles, value_ranges)}
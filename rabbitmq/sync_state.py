@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+try:
+    import redis
+except ImportError:  # optional dependency, only needed when SYNC_STATE_BACKEND=redis
+    redis = None
+
+# Where the producer keeps row fingerprints, watermarks and the last seen Drive
+# version between runs: 'sqlite' (a local file), 'redis' or 'memory' (nothing
+# survives a restart, as before)
+SYNC_STATE_BACKEND = os.getenv('SYNC_STATE_BACKEND', 'sqlite')
+SYNC_STATE_PATH = os.getenv('SYNC_STATE_PATH', 'sync_state.db')
+SYNC_STATE_REDIS_URL = os.getenv('SYNC_STATE_REDIS_URL', 'redis://localhost:6379/0')
+SYNC_STATE_REDIS_PREFIX = os.getenv('SYNC_STATE_REDIS_PREFIX', 'sync_state')
+
+
+# Row keys are ints (MySQL ids, sheet row numbers) or strings (row ids), so they
+# are stored JSON-encoded to come back with the same type
+def encode_key(key):
+    return json.dumps(key)
+
+
+def decode_key(key):
+    return json.loads(key)
+
+
+# Every backend offers the same three calls:
+#   load_fingerprints(index_name, table) -> {row key: digest}
+#   get(name, default) -> a JSON value saved by save()
+#   save(fingerprint_changes, values) writes [(index_name, table, {key: digest},
+#     [deleted keys]), ...] and {name: value} together
+
+
+class MemoryStateStore:
+    def load_fingerprints(self, index_name, table):
+        return {}
+
+    def get(self, name, default=None):
+        return default
+
+    def save(self, fingerprint_changes, values):
+        pass
+
+    def close(self):
+        pass
+
+
+# One SQLite file in WAL mode. Each save() is a single transaction, so a crash
+# leaves either the previous cycle's state or the new one, never a mix.
+class SQLiteStateStore:
+    def __init__(self, path=SYNC_STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                index_name TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                digest BLOB NOT NULL,
+                PRIMARY KEY (index_name, table_name, row_key)
+            ) WITHOUT ROWID
+            """)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def load_fingerprints(self, index_name, table):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT row_key, digest FROM fingerprints WHERE index_name = ? AND table_name = ?", (index_name, table)
+            ).fetchall()
+        return {decode_key(key): bytes(digest) for key, digest in rows}
+
+    def get(self, name, default=None):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def save(self, fingerprint_changes, values):
+        with self.lock, self.connection:
+            for index_name, table, changed, deleted in fingerprint_changes:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO fingerprints (index_name, table_name, row_key, digest) VALUES (?, ?, ?, ?)",
+                    [(index_name, table, encode_key(key), digest) for key, digest in changed.items()]
+                )
+                self.connection.executemany(
+                    "DELETE FROM fingerprints WHERE index_name = ? AND table_name = ? AND row_key = ?",
+                    [(index_name, table, encode_key(key)) for key in deleted]
+                )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)",
+                [(name, json.dumps(value)) for name, value in values.items()]
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Redis backend, for producers without a persistent disk. Fingerprints live in
+# one hash per (index, table) and the other values in a single hash; each
+# save() is sent as one MULTI/EXEC pipeline.
+class RedisStateStore:
+    def __init__(self, url=SYNC_STATE_REDIS_URL, prefix=SYNC_STATE_REDIS_PREFIX):
+        if redis is None:
+            raise RuntimeError("SYNC_STATE_BACKEND=redis but the redis package is not installed (pip install redis)")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def fingerprints_key(self, index_name, table):
+        return f"{self.prefix}:fingerprints:{index_name}:{table}"
+
+    def load_fingerprints(self, index_name, table):
+        stored = self.client.hgetall(self.fingerprints_key(index_name, table))
+        return {decode_key(key.decode()): digest for key, digest in stored.items()}
+
+    def get(self, name, default=None):
+        value = self.client.hget(f"{self.prefix}:state", name)
+        return json.loads(value) if value is not None else default
+
+    def save(self, fingerprint_changes, values):
+        pipeline = self.client.pipeline(transaction=True)
+        for index_name, table, changed, deleted in fingerprint_changes:
+            key = self.fingerprints_key(index_name, table)
+            if changed:
+                pipeline.hset(key, mapping={encode_key(row_key): digest for row_key, digest in changed.items()})
+            if deleted:
+                pipeline.hdel(key, *[encode_key(row_key) for row_key in deleted])
+        if values:
+            pipeline.hset(f"{self.prefix}:state", mapping={name: json.dumps(value) for name, value in values.items()})
+        pipeline.execute()
+
+    def close(self):
+        self.client.close()
+
+
+def open_state_store(backend=SYNC_STATE_BACKEND):
+    if backend == 'sqlite':
+        store = SQLiteStateStore()
+    elif backend == 'redis':
+        store = RedisStateStore()
+    elif backend == 'memory':
+        store = MemoryStateStore()
+    else:
+        raise ValueError(f"Unknown SYNC_STATE_BACKEND '{backend}'")
+    logging.info(f"Keeping sync state in {backend}")
+    return store
@@ -0,0 +1,148 @@
+import time
+
+from bulk_writer import BULK_CHUNK_SIZE, chunked, quote_identifier
+from change_capture import user_columns
+from messages import DeltaRows, encode_change
+from row_identity import ROW_ID_COLUMN, key_columns, new_row_id, row_key, uses_row_ids
+from schema import get_table_columns, table_column_types
+from type_inference import convert_value
+
+# Writes from the app (app.py). A batch of inserted, updated and deleted rows
+# goes to MySQL in one transaction, and the rows exactly as it left them are
+# returned as one 'db' change message with a delta, for the app to publish so
+# the edit reaches the sheet without waiting for the producer's next scan. The
+# producer still picks the same rows up by their row_version later; the
+# consumer finds them already synced.
+
+
+# Rows of the table with the given primary key values, as (headers, rows, times)
+# in the shape change_capture.fetch_changes() returns them
+def read_rows(cursor, table_name, columns, key, key_values):
+    headers = user_columns(columns)
+    tracked = 'updated_at' in columns
+    select = ', '.join(quote_identifier(header) for header in headers)
+    if tracked:
+        select += ", UNIX_TIMESTAMP(updated_at)"
+    rows, times = [], []
+    for chunk in chunked(list(key_values), BULK_CHUNK_SIZE):
+        cursor.execute(
+            f"SELECT {select} FROM {quote_identifier(table_name)} "
+            f"WHERE {quote_identifier(key)} IN ({', '.join(['%s'] * len(chunk))})",
+            chunk
+        )
+        for record in cursor.fetchall():
+            rows.append(list(record[:len(headers)]))
+            times.append(float(record[-1]) if tracked and record[-1] is not None else None)
+    return headers, rows, times
+
+
+# Values from the app's forms and grid are text, with '' for an empty field.
+# They are converted for their column's type the way sheet values are, so an
+# empty field in an INT, DECIMAL or DATE column is NULL rather than a value
+# strict-mode MySQL rejects.
+def typed_values(values, types):
+    return {column: convert_value(value, types.get(column)) for column, value in values.items()}
+
+
+# Sync keys of rows, or None when the table doesn't have its key columns yet
+# (never synced); the change then goes out without a delta
+def sync_keys(table_name, headers, rows):
+    if any(column not in headers for column in key_columns(table_name)):
+        return None
+    indexes = [headers.index(column) for column in key_columns(table_name)]
+    return [row_key(table_name, [row[index] for index in indexes]) for row in rows]
+
+
+# Apply one batch of edits in a single transaction and return the change
+# message for it, or None if the batch was empty.
+#   inserts: [{column: value}, ...]
+#   updates: [(key value, {column: value}), ...]
+#   deletes: [key value, ...]
+# `key` is the primary key column the app addresses rows by. Inserted rows get
+# their _row_id here, so the message can key them the way the sheet will.
+def apply_edits(connection, table_name, key, inserts=(), updates=(), deletes=()):
+    inserts, updates, deletes = list(inserts), list(updates), list(deletes)
+    if not (inserts or updates or deletes):
+        return None
+
+    table = quote_identifier(table_name)
+    cursor = connection.cursor()
+    try:
+        columns = get_table_columns(cursor, table_name)
+        types = table_column_types(cursor, table_name).types
+        inserts = [typed_values(values, types) for values in inserts]
+        updates = [(key_value, typed_values(values, types)) for key_value, values in updates]
+        assign_ids = uses_row_ids(table_name) and ROW_ID_COLUMN in columns
+
+        # Keys of deleted rows are read before they go
+        headers, deleted_rows, _ = read_rows(cursor, table_name, columns, key, deletes)
+        deleted_keys = sync_keys(table_name, headers, deleted_rows) or []
+        for chunk in chunked(deletes, BULK_CHUNK_SIZE):
+            cursor.execute(
+                f"DELETE FROM {table} WHERE {quote_identifier(key)} IN ({', '.join(['%s'] * len(chunk))})", chunk
+            )
+
+        # Updates touching the same columns share one executemany
+        by_columns = {}
+        for key_value, values in updates:
+            if values:
+                by_columns.setdefault(tuple(values), []).append(list(values.values()) + [key_value])
+        for changed, params in by_columns.items():
+            assignments = ', '.join(f"{quote_identifier(column)} = %s" for column in changed)
+            cursor.executemany(f"UPDATE {table} SET {assignments} WHERE {quote_identifier(key)} = %s", params)
+
+        # Inserts one by one, for the auto-increment id of each
+        inserted = []
+        for values in inserts:
+            values = {column: value for column, value in values.items() if value is not None}
+            if assign_ids:
+                values[ROW_ID_COLUMN] = new_row_id()
+            if values:
+                cursor.execute(
+                    f"INSERT INTO {table} ({', '.join(quote_identifier(column) for column in values)}) "
+                    f"VALUES ({', '.join(['%s'] * len(values))})",
+                    list(values.values())
+                )
+            else:
+                cursor.execute(f"INSERT INTO {table} () VALUES ()")
+            inserted.append(values[key] if key in values else cursor.lastrowid)
+
+        # The written rows as MySQL stored them (types converted, triggers run)
+        headers, rows, times = read_rows(cursor, table_name, columns, key, inserted + [key_value for key_value, _ in updates])
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    keys = sync_keys(table_name, headers, rows)
+    inserted = set(inserted)
+    key_index = headers.index(key) if key in headers else None
+    change_set = {'inserted': [], 'updated': [], 'deleted': deleted_keys}
+    delta = None
+    if keys is not None:
+        delta_rows = DeltaRows(headers)
+        delta_rows.times = {}
+        for sync_key, row, updated in zip(keys, rows, times):
+            is_insert = key_index is not None and row[key_index] in inserted
+            change_set['inserted' if is_insert else 'updated'].append(sync_key)
+            delta_rows.add(sync_key, row)
+            delta_rows.times[sync_key] = updated
+        delta = delta_rows.delta(deleted_keys)
+    return encode_change(table_name, 'db', change_set, time.time(), delta)
+
+
+# Turn the edit state of an st.data_editor over one page of rows into the
+# arguments of apply_edits(). `key_values` are the page's primary key values in
+# display order; the editor addresses edited and deleted rows by position.
+def grid_edits(key_values, editor_state, key):
+    deletes = [key_values[int(position)] for position in editor_state.get('deleted_rows', [])]
+    updates = []
+    for position, values in editor_state.get('edited_rows', {}).items():
+        key_value = key_values[int(position)]
+        values = {column: value for column, value in values.items() if column != key}
+        if values and key_value not in deletes:
+            updates.append((key_value, values))
+    inserts = [dict(values) for values in editor_state.get('added_rows', []) if values]
+    return inserts, updates, deletes
@@ -0,0 +1,81 @@
+import os
+
+from bulk_writer import quote_identifier
+
+# Rows shown per page in the app
+APP_PAGE_SIZE = int(os.getenv('APP_PAGE_SIZE', '100'))
+
+# Filter operators offered in the app, as SQL templates for one column
+FILTER_OPERATORS = {
+    'equals': '{} = %s',
+    'not equals': '{} <> %s',
+    'contains': "{} LIKE %s ESCAPE '\\\\'",
+    'starts with': "{} LIKE %s ESCAPE '\\\\'",
+    'greater than': '{} > %s',
+    'less than': '{} < %s',
+    'is empty': "({} IS NULL OR {} = '')",
+}
+
+
+def like_escape(value):
+    return str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# WHERE conditions for [(column, operator, value), ...], ANDed together
+def filter_conditions(filters):
+    conditions = []
+    params = []
+    for column, operator, value in filters:
+        column = quote_identifier(column)
+        conditions.append(FILTER_OPERATORS[operator].format(column, column))
+        if operator == 'contains':
+            params.append(f"%{like_escape(value)}%")
+        elif operator == 'starts with':
+            params.append(f"{like_escape(value)}%")
+        elif operator != 'is empty':
+            params.append(value)
+    return conditions, params
+
+
+# One page of a table with keyset pagination: rows are ordered by the sort
+# column and then the key, and a page starts right after `after`, the
+# (sort value, key) of the previous page's last row, so MySQL never has to
+# skip over the rows before it the way OFFSET does. NULL sort values come last
+# in either direction. Selects one row more than the page so the caller can
+# tell whether there is a next page.
+def page_query(table, columns, key, sort_column, descending, filters, after, page_size=APP_PAGE_SIZE):
+    conditions, params = filter_conditions(filters)
+    sort = quote_identifier(sort_column)
+    key_sql = quote_identifier(key)
+    direction = 'DESC' if descending else 'ASC'
+    beyond = '<' if descending else '>'
+
+    if sort_column == key:
+        order = f"{key_sql} {direction}"
+        if after is not None:
+            conditions.append(f"{key_sql} {beyond} %s")
+            params.append(after[1])
+    else:
+        order = f"{sort} IS NULL, {sort} {direction}, {key_sql} {direction}"
+        if after is not None:
+            sort_value, key_value = after
+            if sort_value is None:
+                conditions.append(f"({sort} IS NULL AND {key_sql} {beyond} %s)")
+                params.append(key_value)
+            else:
+                conditions.append(
+                    f"({sort} {beyond} %s OR ({sort} = %s AND {key_sql} {beyond} %s) OR {sort} IS NULL)"
+                )
+                params.extend([sort_value, sort_value, key_value])
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    sql = (
+        f"SELECT {', '.join(quote_identifier(column) for column in columns)} FROM {quote_identifier(table)}"
+        f"{where} ORDER BY {order} LIMIT %s"
+    )
+    return sql, params + [page_size + 1]
+
+
+# Where the page after `row` starts
+def page_cursor(row, columns, key, sort_column):
+    return (row[columns.index(sort_column)], row[columns.index(key)])
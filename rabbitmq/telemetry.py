@@ -0,0 +1,238 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from opentelemetry import trace
+except ImportError:  # optional dependency, only needed when SYNC_TRACING is on
+    trace = None
+
+# Prometheus text endpoint on /metrics. The producer and consumer each serve
+# their own; 0 turns it off. Consumer processes started with --processes use
+# consecutive ports from CONSUMER_METRICS_PORT.
+PRODUCER_METRICS_PORT = int(os.getenv('PRODUCER_METRICS_PORT', '9101'))
+CONSUMER_METRICS_PORT = int(os.getenv('CONSUMER_METRICS_PORT', '9102'))
+
+# OpenTelemetry spans around the same stages the metrics time. Spans go to
+# whatever tracer provider/exporter the process is configured with (e.g. via
+# opentelemetry-instrument); without one they cost next to nothing.
+SYNC_TRACING = os.getenv('SYNC_TRACING', 'false').lower() in ('1', 'true', 'yes')
+
+# Seconds; suits both sub-millisecond stages and minute-long syncs
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def label_text(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+# Metrics keep one value per label combination behind a single lock; an update
+# is a dict lookup and an add, cheap enough for every API call and batch.
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+
+# Gauge read at scrape time from `func`, which returns {label values tuple: value}
+class CallbackGauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames, func):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.func = func
+
+    def samples(self):
+        try:
+            return [(self.name, key, value) for key, value in self.func().items()]
+        except Exception as e:
+            logging.debug(f"Metric {self.name} unavailable: {e}")
+            return []
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((f"{self.name}_bucket", key + (le,), cumulative))
+            samples.append((f"{self.name}_sum", key, counts[-1]))
+            samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            # Re-registering (e.g. a module imported twice) keeps the first one
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def callback_gauge(self, name, help_text, labelnames, func):
+        with self.lock:
+            self.metrics[name] = CallbackGauge(name, help_text, labelnames, func)
+            return self.metrics[name]
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            labelnames = metric.labelnames + (('le',) if metric.kind == 'histogram' else ())
+            for name, key, value in metric.samples():
+                names = labelnames if name.endswith('_bucket') else metric.labelnames
+                lines.append(f"{name}{label_text(names, key)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'sync_stage_seconds', "Time spent in each stage of a producer cycle or consumer sync", ('component', 'stage')
+)
+sheets_api_calls = registry.counter('sheets_api_calls_total', "Google Sheets/Drive API requests", ('kind', 'method'))
+sheets_api_seconds = registry.histogram('sheets_api_seconds', "Google Sheets/Drive API request time", ('kind',))
+sheets_api_errors = registry.counter('sheets_api_errors_total', "Failed Sheets/Drive API requests", ('kind', 'status'))
+sheets_api_throttled = registry.counter('sheets_api_throttled_total', "Sheets/Drive requests answered with 429", ('kind',))
+rows_read = registry.counter('sync_rows_read_total', "Rows read per table and side", ('table', 'source'))
+rows_written = registry.counter('sync_rows_written_total', "Rows written (upserted or deleted) per table and side", ('table', 'target'))
+changes_published = registry.counter('sync_changes_published_total', "Change messages published", ('table', 'source'))
+changes_applied = registry.counter('sync_changes_applied_total', "Change messages applied by the consumer", ('table', 'result'))
+queue_depth = registry.gauge('sync_queue_depth', "Messages waiting in each shard queue", ('queue',))
+binlog_streaming = registry.gauge('sync_binlog_streaming', "1 while the binlog stream for CDC_TABLES is up")
+binlog_failures = registry.counter('sync_binlog_failures_total', "Binlog streams that failed and were restarted")
+consumer_lag_seconds = registry.histogram(
+    'sync_consumer_lag_seconds', "Time from a change being detected to the consumer starting on it"
+)
+propagation_seconds = registry.histogram(
+    'sync_propagation_seconds', "Time from a change being detected to it being applied on the other side", ('source',)
+)
+
+tracer = trace.get_tracer('sheets-mysql-sync') if trace is not None and SYNC_TRACING else None
+
+
+# Times a block into sync_stage_seconds and, with tracing on, wraps it in a span
+@contextmanager
+def stage(component, name, **attributes):
+    started = time.perf_counter()
+    try:
+        if tracer is None:
+            yield
+        else:
+            with tracer.start_as_current_span(f"{component}.{name}", attributes=attributes):
+                yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, component=component, stage=name)
+
+
+# Passes rows through while counting them into sync_rows_read_total once exhausted
+def count_rows(rows, table, source):
+    count = 0
+    for row in rows:
+        count += 1
+        yield row
+    rows_read.inc(count, table=table, source=source)
+
+
+def start_metrics_server(port):
+    if not port:
+        return None
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    except OSError as e:
+        logging.warning(f"Metrics endpoint not started on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on :{port}/metrics")
+    return server
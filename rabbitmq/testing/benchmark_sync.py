@@ -0,0 +1,337 @@
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+import mysql.connector
+import pika
+
+# Shared sync modules live one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_sheets import FakeBackend, FakeClient, FakeSharedClient
+
+# End-to-end benchmark of monitor_and_sync and start_consumer. Google Sheets is
+# replaced by the in-process fake in fake_sheets.py, with configurable latency
+# and quotas; MySQL and RabbitMQ are real local servers (MYSQL_HOST/USER/PASSWORD
+# and RABBITMQ_HOST, e.g. from Docker). A synthetic workbook is loaded, then
+# edits are made on both sides at a fixed rate and timed until they show up on
+# the other side. Results are printed (and optionally written) as JSON.
+#
+# The producer and consumer run as threads of this process so they can share
+# the fake workbook, so peak RSS covers both together. Use a dedicated database
+# (BENCH_DATABASE, dropped and recreated) and broker: the shard queues are purged.
+BENCH_DATABASE = os.getenv('BENCH_DATABASE', 'superjoin_bench')
+STAMP_COLUMN = 'stamp'
+WATCH_INTERVAL_SECONDS = 0.05
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def latency_summary(latencies):
+    return {
+        'p50': percentile(latencies, 0.50),
+        'p90': percentile(latencies, 0.90),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies) if latencies else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+    }
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+# rows x columns of mixed numbers and text; the last column holds edit stamps
+def synthetic_rows(row_count, column_count, rng):
+    headers = ['name'] + [f"c{index}" for index in range(1, column_count - 1)] + [STAMP_COLUMN]
+    rows = [headers]
+    for index in range(row_count):
+        values = [f"row {index}"]
+        for column in range(1, column_count - 1):
+            values.append(rng.randint(0, 10 ** 6) if column % 2 else f"text {rng.randint(0, 10 ** 6)}")
+        rows.append(values + ['init'])
+    return rows
+
+
+def reset_database(mysql_config):
+    server = {key: value for key, value in mysql_config.items() if key not in ('database', 'allow_local_infile')}
+    connection = mysql.connector.connect(**server)
+    cursor = connection.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{BENCH_DATABASE}`")
+    cursor.execute(f"CREATE DATABASE `{BENCH_DATABASE}`")
+    cursor.close()
+    connection.close()
+
+
+def purge_queues(rabbitmq_host, queue_base):
+    from sharding import SHARD_COUNT, declare_topology, shard_queue
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
+    channel = connection.channel()
+    declare_topology(channel, queue_base)
+    for shard in range(SHARD_COUNT):
+        channel.queue_purge(queue=shard_queue(queue_base, shard))
+    connection.close()
+
+
+def table_row_count(cursor, table):
+    try:
+        cursor.execute(f"SELECT COUNT(*) FROM `{table}`")
+        return cursor.fetchone()[0]
+    except mysql.connector.Error:
+        return 0
+
+
+# Tracks every edit from the moment it is made until its stamp is seen on the
+# other side. An edit overwritten by a later one on the same row before it
+# arrived is counted as superseded rather than as a latency.
+class EditLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}  # stamp -> (direction, table, target, time)
+        self.seen = {}  # stamp -> time
+        self.latest = {}  # (direction, table, target) -> newest stamp
+        self.superseded = set()
+
+    def record(self, stamp, direction, table, target):
+        with self.lock:
+            previous = self.latest.get((direction, table, target))
+            if previous is not None and previous not in self.seen:
+                self.superseded.add(previous)
+            self.latest[(direction, table, target)] = stamp
+            self.sent[stamp] = (direction, table, target, time.monotonic())
+
+    def pending(self, direction):
+        with self.lock:
+            return {
+                stamp: table for stamp, (edit_direction, table, _, _) in self.sent.items()
+                if edit_direction == direction and stamp not in self.seen and stamp not in self.superseded
+            }
+
+    def mark_seen(self, stamps):
+        now = time.monotonic()
+        with self.lock:
+            for stamp in stamps:
+                self.seen.setdefault(stamp, now)
+
+    def summary(self, direction):
+        with self.lock:
+            sent = {stamp: edit for stamp, edit in self.sent.items() if edit[0] == direction}
+            latencies = [self.seen[stamp] - edit[3] for stamp, edit in sent.items() if stamp in self.seen]
+            superseded = len([stamp for stamp in sent if stamp in self.superseded and stamp not in self.seen])
+            first_sent = min((edit[3] for edit in sent.values()), default=None)
+            last_seen = max((self.seen[stamp] for stamp in sent if stamp in self.seen), default=None)
+        span = (last_seen - first_sent) if first_sent is not None and last_seen is not None else None
+        return {
+            'edits': len(sent),
+            'propagated': len(latencies),
+            'superseded': superseded,
+            'lost': len(sent) - len(latencies) - superseded,
+            'throughput_per_second': len(latencies) / span if span else None,
+            'latency_seconds': latency_summary(latencies),
+        }
+
+
+# Polls both sides for stamps that have not arrived yet
+def watch(backend, mysql_config, tables, log, stop):
+    connection = mysql.connector.connect(**mysql_config)
+    while not stop.is_set():
+        by_table = {}
+        for stamp, table in log.pending('sheet').items():
+            by_table.setdefault(table, []).append(stamp)
+        cursor = connection.cursor()
+        for table, stamps in by_table.items():
+            cursor.execute(
+                f"SELECT `{STAMP_COLUMN}` FROM `{table}` WHERE `{STAMP_COLUMN}` IN ({', '.join(['%s'] * len(stamps))})",
+                stamps
+            )
+            log.mark_seen(row[0] for row in cursor.fetchall())
+        cursor.close()
+        connection.commit()  # start a fresh snapshot next time
+
+        pending = log.pending('db')
+        if pending:
+            for table in tables:
+                rows = backend.snapshot(table)
+                column = rows[0].index(STAMP_COLUMN)
+                log.mark_seen(row[column] for row in rows[1:] if len(row) > column and row[column] in pending)
+        time.sleep(WATCH_INTERVAL_SECONDS)
+    connection.close()
+
+
+# Edits on both sides at `rate` per second each for `duration` seconds. Sheet
+# edits go to the first half of each table's rows and MySQL edits to the second,
+# so the two sides never edit the same row and conflict resolution stays out of it.
+def make_edits(backend, mysql_config, tables, row_count, direction, rate, duration, log, rng):
+    connection = mysql.connector.connect(**mysql_config)
+    cursor = connection.cursor()
+    db_ids = {}
+    for table in tables:
+        cursor.execute(f"SELECT id FROM `{table}` ORDER BY id")
+        ids = [row[0] for row in cursor.fetchall()]
+        db_ids[table] = ids[len(ids) // 2:]
+
+    sheet_targets = [(table, row) for row in range(2, row_count // 2 + 2) for table in tables]
+    db_targets = [(table, row_id) for table in tables for row_id in db_ids[table]]
+    rng.shuffle(sheet_targets)
+    rng.shuffle(db_targets)
+    stamp_column = backend.snapshot(tables[0])[0].index(STAMP_COLUMN) + 1
+
+    started = time.monotonic()
+    count = 0
+    while time.monotonic() - started < duration:
+        if direction in ('sheet', 'both'):
+            table, row = sheet_targets[count % len(sheet_targets)]
+            stamp = f"s{count:08d}"
+            backend.edit_cell(table, row, stamp_column, stamp)
+            log.record(stamp, 'sheet', table, row)
+        if direction in ('db', 'both'):
+            table, row_id = db_targets[count % len(db_targets)]
+            stamp = f"d{count:08d}"
+            cursor.execute(f"UPDATE `{table}` SET `{STAMP_COLUMN}` = %s WHERE id = %s", (stamp, row_id))
+            connection.commit()
+            log.record(stamp, 'db', table, row_id)
+        count += 1
+        # Hold the rate without drifting: sleep until the next edit's slot
+        time.sleep(max(0.0, started + count / rate - time.monotonic()))
+
+    cursor.close()
+    connection.close()
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    backend = FakeBackend(
+        latency=args.latency_ms / 1000, reads_per_minute=args.reads_per_minute,
+        writes_per_minute=args.writes_per_minute, drive_per_minute=args.drive_per_minute
+    )
+    tables = [f"bench_{index}" for index in range(args.worksheets)]
+    for table in tables:
+        backend.add_sheet(table, synthetic_rows(args.rows, args.columns, rng))
+
+    # Imported only now so the environment set in main() is in place first
+    import consumer
+    import producer
+
+    for config in (producer.mysql_config, consumer.mysql_config):
+        config['database'] = BENCH_DATABASE
+    mysql_config = dict(producer.mysql_config)
+    reset_database(mysql_config)
+    purge_queues(producer.rabbitmq_host, producer.rabbitmq_queue)
+
+    producer.get_google_sheets_client = lambda: FakeClient(backend, 'producer')
+    consumer.sheets = FakeSharedClient(backend, 'consumer')
+
+    # take_poll_requests runs exactly once per producer loop
+    cycles = [0]
+    take_poll_requests = producer.take_poll_requests
+
+    def counting_take_poll_requests(cursor):
+        cycles[0] += 1
+        return take_poll_requests(cursor)
+
+    producer.take_poll_requests = counting_take_poll_requests
+
+    baseline_rss = peak_rss_mb()
+    started = time.monotonic()
+    threading.Thread(target=consumer.start_consumer, name='bench-consumer', daemon=True).start()
+    threading.Thread(target=producer.monitor_and_sync, name='bench-producer', daemon=True).start()
+
+    # Initial load: every worksheet lands in MySQL
+    check = mysql.connector.connect(**mysql_config)
+    loaded = False
+    while time.monotonic() - started < args.settle_timeout:
+        cursor = check.cursor()
+        loaded = all(table_row_count(cursor, table) >= args.rows for table in tables)
+        cursor.close()
+        check.commit()
+        if loaded:
+            break
+        time.sleep(0.2)
+    check.close()
+    load_seconds = time.monotonic() - started
+    if not loaded:
+        raise RuntimeError(f"Initial load did not finish within {args.settle_timeout}s")
+    calls_after_load = backend.call_counts()
+    cycles_after_load = cycles[0]
+
+    log = EditLog()
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch, args=(backend, mysql_config, tables, log, stop), daemon=True)
+    watcher.start()
+    make_edits(backend, mysql_config, tables, args.rows, args.direction, args.edit_rate, args.duration, log, rng)
+
+    # Give the last edits time to arrive
+    deadline = time.monotonic() + args.settle_timeout
+    while (log.pending('sheet') or log.pending('db')) and time.monotonic() < deadline:
+        time.sleep(0.2)
+    stop.set()
+    watcher.join()
+
+    calls = backend.call_counts()
+    steady_cycles = cycles[0] - cycles_after_load
+    producer_calls = sum(calls.get('producer', {}).values()) - sum(calls_after_load.get('producer', {}).values())
+    return {
+        'config': vars(args),
+        'initial_load': {
+            'rows': args.rows * args.worksheets,
+            'seconds': load_seconds,
+            'rows_per_second': args.rows * args.worksheets / load_seconds,
+        },
+        'sheet_to_db': log.summary('sheet'),
+        'db_to_sheet': log.summary('db'),
+        'api_calls': calls,
+        'api_calls_throttled': dict(backend.throttled),
+        'producer_cycles': cycles[0],
+        'producer_api_calls_per_cycle': producer_calls / steady_cycles if steady_cycles else None,
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end sync benchmark against a fake Google Sheets")
+    parser.add_argument('--worksheets', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--columns', type=int, default=8, help="including the stamp column")
+    parser.add_argument('--edit-rate', type=float, default=2.0, help="edits per second on each side")
+    parser.add_argument('--direction', choices=['sheet', 'db', 'both'], default='both')
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of edits")
+    parser.add_argument('--settle-timeout', type=float, default=120.0)
+    parser.add_argument('--latency-ms', type=float, default=100.0, help="added to every fake Sheets call")
+    parser.add_argument('--reads-per-minute', type=int, default=300)
+    parser.add_argument('--writes-per-minute', type=int, default=300)
+    parser.add_argument('--drive-per-minute', type=int, default=1200)
+    parser.add_argument('--poll-interval', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    # The sync reads these at import time. Nothing persists between runs, and
+    # the client-side rate limits match the fake quotas unless set explicitly.
+    os.environ.setdefault('SYNC_STATE_BACKEND', 'memory')
+    os.environ.setdefault('POLL_INTERVAL_SECONDS', str(args.poll_interval))
+    os.environ.setdefault('POLL_MIN_INTERVAL_SECONDS', str(args.poll_interval / 2))
+    os.environ.setdefault('POLL_MAX_INTERVAL_SECONDS', str(args.poll_interval * 4))
+    os.environ.setdefault('SHEETS_READS_PER_MINUTE', str(args.reads_per_minute))
+    os.environ.setdefault('SHEETS_WRITES_PER_MINUTE', str(args.writes_per_minute))
+    os.environ.setdefault('DRIVE_REQUESTS_PER_MINUTE', str(args.drive_per_minute))
+
+    results = run(args)
+    print(json.dumps(results, indent=2, default=str))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from gspread.exceptions import APIError, WorksheetNotFound
+
+# In-process stand-in for the parts of gspread (and the Drive metadata call)
+# the sync uses, for benchmarks that must not touch Google. One FakeBackend
+# holds the workbook; every client gets its own view of it so API calls can be
+# counted per caller. Each call can be slowed down by a fixed latency and is
+# checked against per-minute quotas shared by all clients, like a real
+# project's quota; going over raises the same 429 APIError Google would.
+
+READ_METHODS = {'open', 'worksheets', 'worksheet', 'values_batch_get', 'get_values', 'row_values', 'get_all_values'}
+WRITE_METHODS = {'batch_update', 'add_rows', 'add_cols', 'hide_columns', 'unhide_columns', 'spreadsheet_batch_update'}
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+
+def column_number(letters):
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - 64
+    return number
+
+
+# "B3" -> (3, 2); "7" (a whole-row reference) -> (7, None)
+def parse_cell(reference):
+    match = re.fullmatch(r"([A-Za-z]*)(\d+)", reference)
+    letters, row = match.groups()
+    return int(row), column_number(letters) if letters else None
+
+
+def trim_row(row):
+    end = len(row)
+    while end and row[end - 1] == '':
+        end -= 1
+    return row[:end]
+
+
+def trim_rows(rows):
+    rows = [trim_row(row) for row in rows]
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+# Sheets shows every value as text; numbers written as numbers read back as text
+def stored_value(value):
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    return '' if value is None else str(value)
+
+
+class FakeBackend:
+    def __init__(self, latency=0.0, reads_per_minute=None, writes_per_minute=None, drive_per_minute=None):
+        self.latency = latency
+        self.quotas = {'read': reads_per_minute, 'write': writes_per_minute, 'drive': drive_per_minute}
+        self.lock = threading.RLock()
+        self.sheets = {}  # title -> {'id', 'rows', 'row_count', 'col_count', 'hidden'}
+        self.version = 1
+        self.modified = time.time()
+        self.recent = {kind: deque() for kind in self.quotas}
+        self.calls = {}  # role -> Counter of methods
+        self.throttled = Counter()
+
+    def add_sheet(self, title, rows):
+        with self.lock:
+            width = max([len(row) for row in rows] + [1])
+            self.sheets[title] = {
+                'id': len(self.sheets) + 1,
+                'rows': [[stored_value(value) for value in row] for row in rows],
+                'row_count': max(len(rows), 1),
+                'col_count': width,
+                'hidden': set(),
+            }
+            self.touch()
+
+    def touch(self):
+        self.version += 1
+        self.modified = time.time()
+
+    # Every API call passes through here: count it, apply the quota, then wait out the latency
+    def call(self, role, method):
+        kind = 'drive' if method == 'drive' else 'write' if method in WRITE_METHODS else 'read'
+        now = time.monotonic()
+        with self.lock:
+            self.calls.setdefault(role, Counter())[method] += 1
+            limit = self.quotas[kind]
+            if limit:
+                recent = self.recent[kind]
+                while recent and now - recent[0] >= 60:
+                    recent.popleft()
+                if len(recent) >= limit:
+                    self.throttled[kind] += 1
+                    raise APIError(FakeResponse(429, {'error': {
+                        'code': 429, 'message': f"Quota exceeded for {kind} requests", 'status': 'RESOURCE_EXHAUSTED',
+                    }}))
+                recent.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+
+    # What a person typing into the sheet does; not counted as an API call
+    def edit_cell(self, title, row, column, value):
+        with self.lock:
+            sheet = self.sheets[title]
+            rows = sheet['rows']
+            while len(rows) < row:
+                rows.append([])
+            cells = rows[row - 1]
+            if len(cells) < column:
+                cells.extend([''] * (column - len(cells)))
+            cells[column - 1] = stored_value(value)
+            self.touch()
+
+    def snapshot(self, title):
+        with self.lock:
+            return [list(row) for row in self.sheets[title]['rows']]
+
+    def call_counts(self):
+        with self.lock:
+            return {role: dict(counter) for role, counter in self.calls.items()}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title):
+        self.spreadsheet = spreadsheet
+        self.backend = spreadsheet.backend
+        self.role = spreadsheet.role
+        self.title = title
+
+    @property
+    def data(self):
+        return self.backend.sheets[self.title]
+
+    @property
+    def id(self):
+        return self.data['id']
+
+    @property
+    def row_count(self):
+        return self.data['row_count']
+
+    @property
+    def col_count(self):
+        return self.data['col_count']
+
+    # gspread pads the rows it returns to the widest one; the API drops trailing blank rows
+    def get_values(self, range_name=None):
+        self.backend.call(self.role, 'get_values')
+        with self.backend.lock:
+            rows = self.data['rows']
+            if range_name:
+                start, end = range_name.split(':')
+                rows = rows[parse_cell(start)[0] - 1:parse_cell(end)[0]]
+            rows = trim_rows(rows)
+            width = max([len(row) for row in rows] + [0])
+            return [row + [''] * (width - len(row)) for row in rows]
+
+    def get_all_values(self):
+        self.backend.call(self.role, 'get_all_values')
+        with self.backend.lock:
+            rows = trim_rows(self.data['rows'])
+            width = max([len(row) for row in rows] + [0])
+            return [row + [''] * (width - len(row)) for row in rows]
+
+    def row_values(self, row):
+        self.backend.call(self.role, 'row_values')
+        with self.backend.lock:
+            rows = self.data['rows']
+            return trim_row(list(rows[row - 1])) if row <= len(rows) else []
+
+    def batch_update(self, data):
+        self.backend.call(self.role, 'batch_update')
+        with self.backend.lock:
+            rows = self.data['rows']
+            for update in data:
+                first_row, first_column = parse_cell(update['range'].split(':')[0])
+                first_column = first_column or 1
+                for offset, values in enumerate(update['values']):
+                    row_number = first_row + offset
+                    while len(rows) < row_number:
+                        rows.append([])
+                    cells = rows[row_number - 1]
+                    end = first_column - 1 + len(values)
+                    if len(cells) < end:
+                        cells.extend([''] * (end - len(cells)))
+                    cells[first_column - 1:end] = [stored_value(value) for value in values]
+                self.data['row_count'] = max(self.data['row_count'], first_row + len(update['values']) - 1)
+                self.data['col_count'] = max(self.data['col_count'], max([len(cells) for cells in rows] + [1]))
+            self.backend.touch()
+
+    def add_rows(self, count):
+        self.backend.call(self.role, 'add_rows')
+        with self.backend.lock:
+            self.data['row_count'] += count
+
+    def add_cols(self, count):
+        self.backend.call(self.role, 'add_cols')
+        with self.backend.lock:
+            self.data['col_count'] += count
+
+    def hide_columns(self, start, end):
+        self.backend.call(self.role, 'hide_columns')
+        with self.backend.lock:
+            self.data['hidden'].update(range(start, end))
+
+    def unhide_columns(self, start, end):
+        self.backend.call(self.role, 'unhide_columns')
+        with self.backend.lock:
+            self.data['hidden'].difference_update(range(start, end))
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, name):
+        self.client = client
+        self.backend = client.backend
+        self.role = client.role
+        self.id = f"fake-{name}"
+
+    def worksheets(self):
+        self.backend.call(self.role, 'worksheets')
+        with self.backend.lock:
+            return [FakeWorksheet(self, title) for title in self.backend.sheets]
+
+    def worksheet(self, title):
+        self.backend.call(self.role, 'worksheet')
+        if title not in self.backend.sheets:
+            raise WorksheetNotFound(title)
+        return FakeWorksheet(self, title)
+
+    # Ranges are the quoted worksheet titles batch_get_sheets asks for; like the
+    # raw values API, rows are not padded
+    def values_batch_get(self, ranges):
+        self.backend.call(self.role, 'values_batch_get')
+        value_ranges = []
+        with self.backend.lock:
+            for range_name in ranges:
+                title = range_name[1:-1].replace("''", "'")
+                rows = trim_rows(self.backend.sheets[title]['rows'])
+                value_ranges.append({'range': range_name, 'values': rows} if rows else {'range': range_name})
+        return {'valueRanges': value_ranges}
+
+    # Only the deleteDimension requests the sync sends, applied in order
+    def batch_update(self, body):
+        self.backend.call(self.role, 'spreadsheet_batch_update')
+        with self.backend.lock:
+            by_id = {sheet['id']: sheet for sheet in self.backend.sheets.values()}
+            for request in body['requests']:
+                span = request['deleteDimension']['range']
+                sheet = by_id[span['sheetId']]
+                del sheet['rows'][span['startIndex']:span['endIndex']]
+                sheet['row_count'] -= span['endIndex'] - span['startIndex']
+            self.backend.touch()
+        return {}
+
+
+# Plays gspread's authorized session for the Drive metadata requests
+class FakeHttpClient:
+    def __init__(self, backend, role):
+        self.backend = backend
+        self.role = role
+
+    def request(self, method, url, params=None, json=None):
+        self.backend.call(self.role, 'drive')
+        with self.backend.lock:
+            modified = datetime.fromtimestamp(self.backend.modified, timezone.utc).isoformat().replace('+00:00', 'Z')
+            return FakeResponse(200, {'version': str(self.backend.version), 'modifiedTime': modified})
+
+
+class FakeClient:
+    def __init__(self, backend, role):
+        self.backend = backend
+        self.role = role
+        self.http_client = FakeHttpClient(backend, role)
+
+    def open(self, name):
+        self.backend.call(self.role, 'open')
+        return FakeSpreadsheet(self, name)
+
+
+# Drop-in for consumer.sheets (a SharedSheetsClient)
+class FakeSharedClient:
+    def __init__(self, backend, role):
+        self.client = FakeClient(backend, role)
+        self.handle = None
+
+    def get_client(self):
+        return self.client
+
+    def spreadsheet(self):
+        if self.handle is None:
+            self.handle = self.client.open("superjoin")
+        return self.handle
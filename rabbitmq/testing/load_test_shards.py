@@ -0,0 +1,90 @@
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import pika
+
+# Every message should cost one simulated sync, so coalescing is switched off
+os.environ.setdefault('COALESCE_WINDOW_SECONDS', '0')
+
+# Shared sync modules live one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from connections import Publisher
+from consumer import rabbitmq_host, rabbitmq_queue, start_consumer
+from messages import encode_change
+from sharding import SHARD_COUNT, declare_topology, retry_queue, shard_queue, shards_for_process
+
+# Load test for sharded consumers against a local RabbitMQ. Publishes a burst of
+# changes across many tables, then times how long N consumer processes take to
+# drain it. Each sync is simulated with a fixed sleep so the numbers show how
+# throughput scales with processes rather than with Sheets/MySQL speed.
+SIMULATED_SYNC_SECONDS = float(os.getenv('SIMULATED_SYNC_SECONDS', '0.05'))
+
+
+# Counts applied messages in `applied`, shared by every consumer process. Each
+# message updates its own row, so a change that several messages were merged
+# into counts once per message.
+def simulated_sync(applied, change):
+    time.sleep(SIMULATED_SYNC_SECONDS)
+    with applied.get_lock():
+        applied.value += len(change['updated'])
+    return True
+
+
+def run(process_count, message_count, table_count):
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
+    channel = connection.channel()
+    declare_topology(channel, rabbitmq_queue)
+    # Leftovers from an earlier run would be counted as applied
+    for shard in range(SHARD_COUNT):
+        channel.queue_purge(queue=shard_queue(rabbitmq_queue, shard))
+        channel.queue_purge(queue=retry_queue(rabbitmq_queue, shard))
+    process_count = min(process_count, SHARD_COUNT)
+
+    # Each message names a different row so coalescing can't hide the work
+    publisher = Publisher(rabbitmq_host, rabbitmq_queue)
+    for index in range(message_count):
+        table = f"load_table_{index % table_count}"
+        change_set = {'inserted': [], 'updated': [index], 'deleted': []}
+        publisher.publish(encode_change(table, 'db', change_set), table)
+    publisher.close()
+
+    # The consumer processes are started here rather than through
+    # start_consumer_processes(), so each one can be stopped after the run and
+    # none is left holding its shards as the active consumer in the next
+    applied = multiprocessing.Value('i', 0)
+    handler = functools.partial(simulated_sync, applied)
+    started = time.perf_counter()
+    consumers = [
+        multiprocessing.Process(target=start_consumer, args=(shards_for_process(index, process_count), handler, 0))
+        for index in range(process_count)
+    ]
+    for consumer in consumers:
+        consumer.start()
+    # Done when every message has been applied, not when the queues look empty:
+    # up to prefetch x processes messages are still in flight at that point
+    while applied.value < message_count:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    for consumer in consumers:
+        consumer.terminate()
+    for consumer in consumers:
+        consumer.join()
+    connection.close()
+    return {'processes': process_count, 'messages': message_count, 'seconds': elapsed, 'messages_per_second': message_count / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure consumer throughput as processes are added")
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--tables', type=int, default=64)
+    args = parser.parse_args()
+
+    results = [run(process_count, args.messages, args.tables) for process_count in args.processes]
+    print(json.dumps(results, indent=2))
@@ -5,9 +5,14 @@ from google.auth.transport.requests import Request
 import mysql.connector
 import os
 import pickle
+import sys
 import time
 from dotenv import load_dotenv
 
+# Shared sync modules live one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_writer import USE_LOAD_DATA_INFILE, table_is_empty, write_rows
+
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
 TOKEN_PICKLE = 'token.pickle'
@@ -19,7 +24,8 @@ mysql_config = {
     'host': os.getenv('MYSQL_HOST'),
     'user': os.getenv('MYSQL_USER'),
     'password': os.getenv('MYSQL_PASSWORD'),
-    'database': os.getenv('MYSQL_DATABASE')
+    'database': os.getenv('MYSQL_DATABASE'),
+    'allow_local_infile': USE_LOAD_DATA_INFILE
 }
 
 def get_google_sheets_client():
@@ -74,21 +80,17 @@ def create_or_update_table(cursor, sheet_name, headers):
         cursor.execute(create_sql)
         clear_cursor_results(cursor)
 
-def sync_sheet_to_db(sheet, cursor):
+def sync_sheet_to_db(sheet, connection):
     data = sheet.get_all_values()
     headers = data[0]
-    
+    cursor = connection.cursor()
+
     create_or_update_table(cursor, sheet.title, headers)
-    
-    for row in data[1:]:
-        values = [f"'{value}'" for value in row]
-        sql = f"""
-        INSERT INTO {sheet.title} ({', '.join(headers)})
-        VALUES ({', '.join(values)})
-        ON DUPLICATE KEY UPDATE {', '.join(f'{header}=VALUES({header})' for header in headers)}
-        """
-        cursor.execute(sql)
-        clear_cursor_results(cursor)
+    first_load = table_is_empty(cursor, sheet.title)
+    cursor.close()
+    connection.commit()
+
+    write_rows(connection, sheet.title, headers, data[1:], first_load=first_load)
     print(f"Changes detected in Google Sheet '{sheet.title}'. Updated MySQL database.")
 
 def sync_db_to_sheet(cursor, sheet):
@@ -116,7 +118,7 @@ def monitor_and_sync():
             last_data_str = last_sheet_data.get(sheet.title)
 
             if last_data_str != current_data_str:
-                sync_sheet_to_db(sheet, cursor)
+                sync_sheet_to_db(sheet, connection)
                 last_sheet_data[sheet.title] = current_data_str
 
         for sheet in spreadsheet.worksheets():
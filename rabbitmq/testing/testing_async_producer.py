@@ -0,0 +1,182 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import async_producer
+from async_producer import AsyncProducer
+from change_capture import TOMBSTONES_TABLE
+from row_index import RowIndex
+
+
+# Stand-ins for the optional aiomysql and aio_pika modules
+class FakeMySQLError(Exception):
+    pass
+
+
+async_producer.aiomysql = SimpleNamespace(Error=FakeMySQLError, ProgrammingError=FakeMySQLError)
+async_producer.aio_pika = SimpleNamespace(
+    Message=lambda body, delivery_mode: body, DeliveryMode=SimpleNamespace(PERSISTENT=2)
+)
+
+
+# One table in MySQL: its version counter, rows above the watermark and tombstones
+class FakeAsyncCursor:
+    def __init__(self, db):
+        self.db = db
+        self.description = None
+        self.result = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=()):
+        self.db.statements.append(sql)
+        if sql.startswith('SELECT table_name, version'):
+            self.result = [('people', self.db.version)]
+        elif sql.startswith('SELECT version'):
+            self.result = [(self.db.version,)]
+        elif sql.startswith('SELECT *'):
+            self.description = [('id',), ('name',), ('row_version',), ('updated_at',), ('unix',)]
+            self.result = [(row_id, name, version, None, 100.0) for row_id, name, version in self.db.rows]
+        elif sql.startswith('SELECT row_id'):
+            self.result = [(row_id,) for row_id in self.db.tombstones]
+
+    async def fetchone(self):
+        return self.result[0] if self.result else None
+
+    async def fetchall(self):
+        return self.result
+
+
+class FakeAsyncConnection:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return FakeAsyncCursor(self.db)
+
+    async def begin(self):
+        pass
+
+    async def commit(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, db):
+        self.db = db
+
+    def acquire(self):
+        return FakeAsyncConnection(self.db)
+
+
+# The blocking setup connection: poll requests, tombstone pruning, the schedule
+class FakeSetupConnection:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def cursor(self):
+        statements = self.statements
+
+        class Cursor:
+            def execute(self, sql, params=()):
+                statements.append(sql)
+
+            def executemany(self, sql, rows):
+                statements.append(sql)
+
+            def fetchall(self):
+                return []
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+    def commit(self):
+        pass
+
+
+class RecordingState:
+    def __init__(self):
+        self.saved = []
+
+    def load_fingerprints(self, index_name, table):
+        return {}
+
+    def save(self, fingerprint_changes, values):
+        self.saved.append(values)
+
+
+class FakeExchange:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        if self.fail:
+            raise ConnectionError("broker went away")
+        self.published.append(message)
+
+
+def make_producer(db, exchange):
+    producer = AsyncProducer(None, {}, 'localhost', 'sync')
+    producer.pool = FakePool(db)
+    producer.exchange = exchange
+    producer.state = RecordingState()
+    producer.db_index = RowIndex(producer.state, 'db')
+    producer.sheet_index = RowIndex(producer.state, 'sheet')
+    producer.watermarks = {'people': 3}
+    producer.worksheets = [SimpleNamespace(title='people')]
+    producer.scheduler.track(['people'])
+    producer.probe = SimpleNamespace(last_seen=None)
+    producer.setup_connection = FakeSetupConnection(db.statements)
+
+    async def no_sheet_changes(due, deltas):
+        return []
+
+    producer.poll_sheets = no_sheet_changes
+    return producer
+
+
+def test_tombstones_pruned_after_state_save():
+    db = SimpleNamespace(version=5, rows=[(1, 'Ann', 5)], tombstones=[2], statements=[])
+    producer = make_producer(db, FakeExchange())
+    assert asyncio.run(producer.poll_once()) == 1
+
+    assert producer.state.saved[-1]['watermarks'] == {'people': 5}
+    assert producer.watermarks == {'people': 5}
+    prunes = [sql for sql in db.statements if sql.startswith(f"DELETE FROM {TOMBSTONES_TABLE}")]
+    assert len(prunes) == 1, "tombstones go once the poll is saved"
+    print("Tombstones pruned after state save: ok")
+
+
+def test_failed_publish_keeps_tombstones_and_watermark():
+    db = SimpleNamespace(version=5, rows=[(1, 'Ann', 5)], tombstones=[2], statements=[])
+    producer = make_producer(db, FakeExchange(fail=True))
+    try:
+        asyncio.run(producer.poll_once())
+        raise AssertionError("the publish failure should surface")
+    except ConnectionError:
+        pass
+
+    assert not producer.state.saved
+    assert producer.watermarks == {'people': 3}, "the watermark only moves once the change is out"
+    assert not any(sql.startswith('DELETE') for sql in db.statements), "tombstones stay for the next poll"
+    print("Failed publish keeps tombstones and watermark: ok")
+
+
+if __name__ == "__main__":
+    test_tombstones_pruned_after_state_save()
+    test_failed_publish_keeps_tombstones_and_watermark()
@@ -0,0 +1,127 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backfill import duplicate_row_ids, finish_backfill, plan_db_ranges, plan_sheet_ranges, sheet_has_more_rows
+from change_capture import create_change_triggers
+from coalescer import Coalescer
+from messages import decode_change, encode_backfill, encode_change
+
+
+def test_sheet_ranges_cover_every_row():
+    ranges = plan_sheet_ranges(250001, 100000)
+    assert [(start, end) for start, end, _, _ in ranges] == [(2, 100001), (100002, 200001), (200002, 250001)]
+    assert plan_sheet_ranges(1, 100000) == [], "a sheet with only a header row has nothing to backfill"
+    print("Sheet ranges cover every row: ok")
+
+
+class GridSheet:
+    def __init__(self, row_count, data_rows):
+        self.row_count = row_count
+        self.data_rows = data_rows
+        self.read = []
+
+    def row_values(self, row):
+        self.read.append(row)
+        return ['x'] if row <= self.data_rows + 1 else []
+
+
+def test_sheet_size_counts_data_not_grid():
+    sheet = GridSheet(row_count=500000, data_rows=40)
+    assert not sheet_has_more_rows(sheet, 100), "an empty grid isn't a large sheet"
+    assert sheet.read == [102]
+    assert sheet_has_more_rows(GridSheet(row_count=500000, data_rows=101), 100)
+    small = GridSheet(row_count=50, data_rows=49)
+    assert not sheet_has_more_rows(small, 100) and not small.read
+    print("Sheet size counts data, not the grid: ok")
+
+
+def test_db_ranges_reserve_sheet_rows():
+    # Ids 1000.. in buckets of 100; bucket 1 is empty (a gap in the ids)
+    ranges = plan_db_ranges([(2, 40), (0, 100), (3, 5)], 1000, 100)
+    assert ranges == [(1000, 1099, 2, 100), (1200, 1299, 102, 40), (1300, 1399, 142, 5)]
+    print("DB ranges reserve sheet rows: ok")
+
+
+def test_backfill_message_wins_coalescing():
+    coalescer = Coalescer(window=0)
+    change_set = {'inserted': [1], 'updated': [], 'deleted': []}
+    assert coalescer.add(decode_change(encode_change('people', 'sheet', change_set)), None)
+    coalescer.add(decode_change(encode_backfill('people', 'db')), None)
+    coalescer.add(decode_change(encode_change('people', 'db', change_set)), None)
+    change, callbacks = coalescer.take('people')
+    assert change['source'] == 'backfill' and change['direction'] == 'db'
+    assert len(callbacks) == 3
+    print("Backfill message wins coalescing: ok")
+
+
+# Answers fetchone() from a queue and records every statement
+class ScriptedConnection:
+    def __init__(self, results=()):
+        self.results = list(results)
+        self.statements = []
+        self.committed = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, list(params)))
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+    def close(self):
+        pass
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+class IdColumnSheet:
+    def __init__(self, ids):
+        self.ids = ids
+
+    def col_values(self, column):
+        assert column == 3
+        return ['_row_id'] + self.ids
+
+
+def test_ids_repeated_across_ranges_are_resynced():
+    headers = ['name', 'qty', '_row_id']
+    repeated = 'c' * 32
+    sheet = IdColumnSheet(['a' * 32, repeated, 'b' * 32, repeated, ''])
+    assert duplicate_row_ids(ScriptedConnection([(4,), (4,)]), sheet, 'people', headers) == set(), \
+        "nothing collapsed, so the sheet isn't read"
+    assert duplicate_row_ids(ScriptedConnection([(4,), (3,)]), sheet, 'people', headers) == {repeated}
+
+    connection = ScriptedConnection()
+    finish_backfill(connection, 'people', {repeated})
+    statements = [sql for sql, _ in connection.statements]
+    assert statements[0].startswith('DELETE FROM _sync_backfill_base') and connection.statements[0][1] == ['people', repeated]
+    assert statements[1] == "DELETE FROM `people` WHERE `_row_id` IN (%s)", "dropped before the base swap"
+    assert any(sql.startswith('INSERT INTO _sync_base') for sql in statements[2:])
+    assert any(sql.startswith('UPDATE _sync_versions SET version = version + 1') for sql in statements)
+    assert connection.committed
+    print("Ids repeated across ranges are resynced: ok")
+
+
+def test_backfill_sessions_skip_the_version_counter():
+    connection = ScriptedConnection()
+    create_change_triggers(connection, 'people')
+    triggers = [sql for sql, _ in connection.statements if 'CREATE TRIGGER' in sql]
+    assert all('IF @sync_skip_version IS NULL' in sql for sql in triggers if 'BEFORE' in sql)
+    assert 'IF @sync_skip_version' not in triggers[-1], "deletes always leave a tombstone"
+    print("Backfill sessions skip the version counter: ok")
+
+
+if __name__ == "__main__":
+    test_sheet_ranges_cover_every_row()
+    test_sheet_size_counts_data_not_grid()
+    test_db_ranges_reserve_sheet_rows()
+    test_backfill_message_wins_coalescing()
+    test_ids_repeated_across_ranges_are_resynced()
+    test_backfill_sessions_skip_the_version_counter()
@@ -0,0 +1,85 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from binlog_cdc import replay_fixture
+
+# Replays a recorded binlog fixture through the CDC event handling, no MySQL needed
+fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'binlog_events.jsonl')
+changes = []
+replay_fixture(fixture, lambda table, change_set: changes.append((table, change_set)))
+
+expected = [
+    ('orders', {'inserted': [1, 2], 'updated': [], 'deleted': []}),
+    ('orders', {'inserted': [], 'updated': [1], 'deleted': []}),
+    ('orders', {'inserted': [], 'updated': [], 'deleted': [2]}),
+]
+if changes == expected:
+    print("Binlog fixture replayed correctly!")
+else:
+    print(f"Unexpected change sets from binlog fixture: {changes}")
+
+# A failing stream is reopened with backoff, and its tables count as streamed
+# (skipped by the poll) only once the server has sent something and until it
+# fails. The row versions it published move the poll watermark.
+import tempfile
+import threading
+
+import binlog_cdc
+from binlog_cdc import BinlogChangeSource, advance_watermarks, streamed_tables
+
+stop = threading.Event()
+opened, streamed_at_open, streamed_on_change, delays = [], [], [], []
+
+
+class Rotate:
+    pass
+
+
+class Write:
+    table = 'orders'
+    rows = [{'values': {'id': 5, 'row_version': 12}}]
+
+
+class FlakyStream:
+    log_file, log_pos = 'binlog.000001', 4
+
+    def __init__(self, **settings):
+        opened.append(settings.get('resume_stream'))
+        streamed_at_open.append(streamed_tables([source]))
+        if len(opened) == 3:
+            stop.set()
+
+    def __iter__(self):
+        if len(opened) == 2:
+            yield Rotate()
+            yield Write()
+        raise ConnectionError("Lost connection to MySQL server")
+
+    def close(self):
+        pass
+
+
+binlog_cdc.BinLogStreamReader = FlakyStream
+binlog_cdc.WriteRowsEvent = Write
+binlog_cdc.RotateEvent = Rotate
+binlog_cdc.UpdateRowsEvent = binlog_cdc.DeleteRowsEvent = binlog_cdc.HeartbeatLogEvent = type('Other', (), {})
+position_file = os.path.join(tempfile.mkdtemp(), 'binlog_position.json')
+source = BinlogChangeSource(
+    {'host': 'db', 'user': 'sync', 'password': '', 'database': 'superjoin'}, ['orders'],
+    lambda table, change_set: streamed_on_change.append(streamed_tables([source])), position_file
+)
+source.run_forever(stop, sleep=delays.append)
+watermarks = {'orders': 3}
+advance_watermarks(watermarks, [source], 0)
+
+if (
+    len(opened) == 3 and delays == [1, 2, 4] and streamed_at_open == [set()] * 3
+    and streamed_on_change == [{'orders'}] and not streamed_tables([source]) and watermarks == {'orders': 12}
+):
+    print("Failed binlog stream is restarted and its tables polled meanwhile!")
+else:
+    print(
+        f"Unexpected binlog restarts: opened={opened} delays={delays} streamed={streamed_at_open} "
+        f"{streamed_on_change} watermarks={watermarks}"
+    )
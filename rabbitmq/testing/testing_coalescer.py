@@ -0,0 +1,72 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from coalescer import Coalescer, group_by_table
+
+
+def test_changes_grouped_per_table():
+    grouped = group_by_table([
+        ('people', 'sheet', {'inserted': [1], 'updated': [], 'deleted': []}),
+        ('orders', 'db', {'inserted': [], 'updated': [7], 'deleted': []}),
+        ('people', 'db', {'inserted': [1, 2], 'updated': [], 'deleted': [3]}),
+    ])
+    assert grouped['orders'] == ('db', {'inserted': [], 'updated': [7], 'deleted': []})
+    assert grouped['people'] == ('both', {'inserted': [1, 2], 'updated': [], 'deleted': [3]})
+    print("Changes grouped per table: ok")
+
+
+def test_retried_message_marks_the_merged_change():
+    coalescer = Coalescer(window=0)
+    change_set = {'inserted': [], 'updated': ['a' * 32], 'deleted': []}
+    coalescer.add({'table': 'people', 'source': 'sheet', 'version': '5', **change_set}, None)
+    coalescer.add({'table': 'people', 'source': 'sheet', 'base_version': '5', 'retried': True, **change_set}, None)
+    change, _ = coalescer.take('people')
+    assert change['retried'], "a change folding in a redelivery doesn't apply its delta as is"
+    print("Retried message marks the merged change: ok")
+
+
+def test_table_syncs_run_in_arrival_order():
+    coalescer = Coalescer(window=0)
+    change_set = {'inserted': [], 'updated': [1], 'deleted': []}
+    assert coalescer.add({'table': 'people', 'source': 'db', 'n': 1, **change_set}, None)
+    first, _ = coalescer.take('people')
+    assert not coalescer.add({'table': 'people', 'source': 'db', 'n': 2, **change_set}, None), \
+        "no second worker while the table's sync is running"
+    assert coalescer.done('people'), "the change that came in meanwhile is handed out afterwards"
+    second, _ = coalescer.take('people')
+    assert (first['n'], second['n']) == (1, 2)
+    assert not coalescer.done('people')
+    print("Table syncs run in arrival order: ok")
+
+
+def test_close_cuts_the_window_short():
+    coalescer = Coalescer(window=60)
+    coalescer.add({'table': 'people', 'source': 'db', 'inserted': [1], 'updated': [], 'deleted': []}, None)
+    threading.Timer(0.05, coalescer.close).start()
+    started = time.monotonic()
+    change, _ = coalescer.take('people')
+    assert change['inserted'] == [1] and time.monotonic() - started < 5
+    print("Close cuts the window short: ok")
+
+
+def test_folded_delta_refs_are_kept():
+    coalescer = Coalescer(window=0)
+    change_set = {'inserted': [], 'updated': ['a' * 32], 'deleted': []}
+    coalescer.add({'table': 'people', 'source': 'sheet', 'delta_ref': 'blob-1', **change_set}, None)
+    coalescer.add({'table': 'people', 'source': 'db', 'delta_ref': 'blob-2', **change_set}, None)
+    coalescer.add({'table': 'people', 'source': 'backfill', **change_set}, None)
+    change, _ = coalescer.take('people')
+    assert change['source'] == 'backfill'
+    assert change['delta_refs'] == ['blob-1', 'blob-2'], "blobs of replaced and unmerged deltas are still deleted"
+    print("Folded delta refs are kept: ok")
+
+
+if __name__ == "__main__":
+    test_changes_grouped_per_table()
+    test_retried_message_marks_the_merged_change()
+    test_table_syncs_run_in_arrival_order()
+    test_close_cuts_the_window_short()
+    test_folded_delta_refs_are_kept()
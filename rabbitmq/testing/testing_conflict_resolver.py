@@ -0,0 +1,146 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conflict_resolver import change_scope, delta_is_current, merge_tables, store_applied_version
+
+COLUMNS = ['name', 'qty']
+BASE = {
+    'r1': {'name': 'Ann', 'qty': '1'},
+    'r2': {'name': 'Bob', 'qty': '2'},
+    'r3': {'name': 'Cid', 'qty': '3'},
+    'r4': {'name': 'Dee', 'qty': '4'},
+}
+
+
+def merge(sheet_rows, db_rows, policy, sheet_times=None, db_times=None, callback=None):
+    return merge_tables('stock', COLUMNS, BASE, sheet_rows, db_rows, sheet_times or {}, db_times or {}, policy, callback)
+
+
+def test_edits_to_different_cells_merge():
+    sheet = {**BASE, 'r1': {'name': 'Ann B', 'qty': '1'}}
+    db = {**BASE, 'r1': {'name': 'Ann', 'qty': '9'}}
+    plan = merge(sheet, db, 'prefer_db')
+
+    assert plan['conflicts'] == 0
+    assert plan['base']['r1'] == {'name': 'Ann B', 'qty': '9'}
+    assert set(plan['sheet_upserts']) == {'r1'} and set(plan['db_upserts']) == {'r1'}
+    assert not plan['sheet_deletes'] and not plan['db_deletes']
+    print("Edits to different cells merge: ok")
+
+
+def test_same_cell_uses_policy():
+    sheet = {**BASE, 'r2': {'name': 'Bob', 'qty': '20'}}
+    db = {**BASE, 'r2': {'name': 'Bob', 'qty': '21'}}
+
+    assert merge(sheet, db, 'prefer_sheet')['base']['r2']['qty'] == '20'
+    assert merge(sheet, db, 'prefer_db')['base']['r2']['qty'] == '21'
+    assert merge(sheet, db, 'lww', sheet_times={'r2': 100.0}, db_times={'r2': 200.0})['base']['r2']['qty'] == '21'
+    assert merge(sheet, db, 'lww', sheet_times={'r2': 300.0}, db_times={'r2': 200.0})['base']['r2']['qty'] == '20'
+
+    seen = []
+
+    def pick_larger(conflict):
+        seen.append(conflict['column'])
+        return max(conflict['sheet'], conflict['db'])
+
+    assert merge(sheet, db, 'callback', callback=pick_larger)['base']['r2']['qty'] == '21'
+    assert seen == ['qty']
+    print("Conflicting cell settled by policy: ok")
+
+
+def test_inserts_and_deletes():
+    sheet = {key: row for key, row in BASE.items() if key != 'r3'}
+    sheet['r5'] = {'name': 'Eve', 'qty': '5'}
+    db = {key: row for key, row in BASE.items() if key != 'r4'}
+    db['r6'] = {'name': 'Fay', 'qty': '6'}
+    plan = merge(sheet, db, 'lww')
+
+    assert plan['db_deletes'] == {'r3'} and plan['sheet_deletes'] == {'r4'}
+    assert set(plan['db_upserts']) == {'r5'} and set(plan['sheet_upserts']) == {'r6'}
+    assert set(plan['base']) == {'r1', 'r2', 'r5', 'r6'}
+    print("Inserts and deletes go to the other side only: ok")
+
+
+def test_delete_against_edit():
+    # Deleted in the sheet, edited in MySQL after the sheet was last modified
+    sheet = {key: row for key, row in BASE.items() if key != 'r1'}
+    db = {**BASE, 'r1': {'name': 'Ann', 'qty': '7'}}
+    plan = merge(sheet, db, 'lww', sheet_times={'r1': 100.0}, db_times={'r1': 200.0})
+    assert plan['sheet_upserts'] == {'r1': {'name': 'Ann', 'qty': '7'}} and not plan['db_deletes']
+
+    plan = merge(sheet, db, 'prefer_sheet')
+    assert plan['db_deletes'] == {'r1'} and 'r1' not in plan['base']
+    print("Delete against edit: ok")
+
+
+def test_lww_uses_row_level_sheet_times():
+    # Each sheet row is weighed by its own time; a row with none (a full
+    # reconcile, or a row outside the delta) falls back to MySQL
+    sheet = {**BASE, 'r1': {'name': 'Ann', 'qty': '10'}, 'r2': {'name': 'Bob', 'qty': '20'}}
+    db = {**BASE, 'r1': {'name': 'Ann', 'qty': '11'}, 'r2': {'name': 'Bob', 'qty': '21'}}
+    plan = merge(sheet, db, 'lww', sheet_times={'r1': 150.0}, db_times={'r1': 100.0, 'r2': 50.0})
+    assert plan['base']['r1']['qty'] == '10', "sheet row edited after the MySQL one wins"
+    assert plan['base']['r2']['qty'] == '21', "no row-level sheet time, MySQL wins"
+
+    plan = merge(sheet, db, 'lww', db_times={'r1': 100.0, 'r2': 50.0})
+    assert plan['base']['r1']['qty'] == '11' and plan['base']['r2']['qty'] == '21'
+    print("LWW uses row-level sheet times: ok")
+
+
+class KeyCursor:
+    def __init__(self, results):
+        self.results = list(results)
+        self.statements = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, list(params)))
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+    def fetchone(self):
+        rows = self.results.pop(0)
+        return rows[0] if rows else None
+
+
+def test_change_scope():
+    change = {'source': 'sheet', 'inserted': [7], 'updated': ['a' * 32], 'deleted': ['b' * 32]}
+    cursor = KeyCursor([])
+    assert change_scope(cursor, 'stock', change, {}) == {'a' * 32, 'b' * 32}
+    assert not cursor.statements, "sheet keys are used as they are"
+
+    # MySQL ids are looked up; a deleted id makes every sheet key MySQL lacks part of it
+    change = {'source': 'db', 'inserted': [], 'updated': [3], 'deleted': [4]}
+    cursor = KeyCursor([[('c' * 32,)], [('c' * 32,), ('d' * 32,)]])
+    assert change_scope(cursor, 'stock', change, {'d' * 32: 2, 'e' * 32: 3}) == {'c' * 32, 'e' * 32}
+    assert cursor.statements[1] == ("SELECT `_row_id` FROM `stock` WHERE id IN (%s)", [3])
+    print("Change scope: ok")
+
+
+def test_stale_or_redelivered_delta_is_not_current():
+    change = {'table': 'stock', 'source': 'db', 'base_version': 40, 'version': 50}
+    assert delta_is_current(KeyCursor([[]]), change), "nothing applied yet"
+    assert delta_is_current(KeyCursor([[('40',)]]), change)
+    assert not delta_is_current(KeyCursor([[('45',)]]), change), "changes up to 45 were applied since it was computed"
+    assert delta_is_current(KeyCursor([[('9',)]]), {**change, 'base_version': 10}), "versions compare as numbers"
+    assert not delta_is_current(KeyCursor([]), {**change, 'retried': True})
+
+    cursor = KeyCursor([[('60',)]])
+    store_applied_version(cursor, 'stock', 'db', 50)
+    assert not any(sql.startswith('INSERT') for sql, _ in cursor.statements), "the applied version never goes back"
+    cursor = KeyCursor([[('40',)]])
+    store_applied_version(cursor, 'stock', 'db', 50)
+    assert cursor.statements[-1][1] == ['stock', 'db', '50']
+    print("Stale or redelivered delta is not current: ok")
+
+
+if __name__ == "__main__":
+    test_edits_to_different_cells_merge()
+    test_same_cell_uses_policy()
+    test_inserts_and_deletes()
+    test_delete_against_edit()
+    test_lww_uses_row_level_sheet_times()
+    test_change_scope()
+    test_stale_or_redelivered_delta_is_not_current()
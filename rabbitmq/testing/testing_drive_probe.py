@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand in for the Drive API on localhost before the sync modules read DRIVE_API_URL
+fake_drive = {'version': 1}
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({'version': str(fake_drive['version'])}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDriveHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+os.environ['DRIVE_API_URL'] = f"http://127.0.0.1:{server.server_address[1]}"
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from drive_watch import ChangeProbe, start_webhook_server
+
+
+class LocalResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+# Plays the part of gspread's authorized session: request(method, url, ...) -> response
+class LocalHttpClient:
+    def request(self, method, url, params=None, json=None):
+        with urllib.request.urlopen(url) as response:
+            return LocalResponse(response.read())
+
+
+probe = ChangeProbe(LocalHttpClient(), 'spreadsheet-id')
+results = []
+
+changed, version = probe.check()
+results.append(changed)  # first check always reports a change
+probe.mark_seen(version)
+
+changed, version = probe.check()
+results.append(changed)  # nothing changed
+
+fake_drive['version'] += 1
+changed, version = probe.check()
+results.append(changed)  # version bumped
+probe.mark_seen(version)
+
+# A push notification forces the next check to report a change
+token = 'local-token'
+webhook = start_webhook_server(0, token, probe.notify)
+request = urllib.request.Request(
+    f"http://127.0.0.1:{webhook.server_address[1]}/",
+    method='POST',
+    headers={'X-Goog-Channel-Token': token, 'X-Goog-Resource-State': 'update'}
+)
+urllib.request.urlopen(request)
+changed, version = probe.check()
+results.append(changed)
+probe.mark_seen(version)
+
+
+# A notification that lands while a check is fetching the version isn't lost
+class NotifyingHttpClient(LocalHttpClient):
+    def request(self, method, url, params=None, json=None):
+        probe.notify()
+        return super().request(method, url, params, json)
+
+
+probe.client = NotifyingHttpClient()
+probe.check()
+probe.client = LocalHttpClient()
+changed, version = probe.check()
+results.append(changed)
+
+if results == [True, False, True, True, True]:
+    print("Drive change probe and webhook behave correctly!")
+else:
+    print(f"Unexpected probe results: {results}")
@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import messages
+from blob_store import BlobStore
+from coalescer import merge_deltas
+from messages import DeltaRows, decode_change, encode_change
+
+CHANGE_SET = {'inserted': ['a' * 32], 'updated': [], 'deleted': ['b' * 32]}
+
+
+def sheet_delta():
+    delta_rows = DeltaRows()
+    rows = list(delta_rows.sheet_rows([['name', 'qty', '_row_id'], ['Ann', '1', 'a' * 32]]))
+    delta_rows.add('a' * 32, rows[1])
+    return delta_rows.delta(['b' * 32])
+
+
+def test_envelope_round_trip():
+    for message_format in ['json'] + (['msgpack'] if messages.msgpack is not None else []):
+        messages.MESSAGE_FORMAT = message_format
+        body = encode_change('a:b', 'sheet', CHANGE_SET, 10.0, sheet_delta(), '4', '5')
+        change = decode_change(body)
+        assert change['table'] == 'a:b' and change['source'] == 'sheet'
+        assert change['deleted'] == ['b' * 32] and change['detected_at'] == 10.0
+        assert change['delta']['rows'] == [['a' * 32, ['Ann', '1', 'a' * 32]]]
+        assert change['base_version'] == '4' and change['version'] == '5'
+    print("Envelope round trip: ok")
+
+
+def test_legacy_messages_still_decode():
+    assert decode_change(b'Sheet: 2024:db') == {
+        'table': 'Sheet: 2024', 'source': 'db', 'inserted': [], 'updated': [], 'deleted': []
+    }
+    assert decode_change('{"table": "people", "source": "db", "inserted": [], "updated": [1], "deleted": []}')['updated'] == [1]
+    try:
+        decode_change(b'{"v": 99, "table": "people", "source": "db"}')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a newer envelope version must be rejected")
+    print("Legacy messages still decode: ok")
+
+
+def test_msgpack_envelopes_of_any_size_decode():
+    if messages.msgpack is None:
+        return
+    messages.MESSAGE_FORMAT = 'msgpack'
+    try:
+        # 16 keys or more make a map16, which no longer starts with a fixmap byte
+        wide = {'table': 'people', 'source': 'db', **CHANGE_SET, **{f"extra_{i}": i for i in range(20)}}
+        body = messages.pack(wide)
+        assert body[:1] == messages.MSGPACK_PREFIX
+        assert decode_change(body)['extra_19'] == 19
+
+        legacy = messages.msgpack.packb({'table': 'people', 'source': 'db', **CHANGE_SET}, use_bin_type=True)
+        assert decode_change(legacy)['deleted'] == ['b' * 32], "unprefixed envelopes from older producers"
+    finally:
+        messages.MESSAGE_FORMAT = 'json'
+    print("Msgpack envelopes of any size decode: ok")
+
+
+def test_large_delta_uses_claim_check():
+    messages.MESSAGE_FORMAT = 'json'
+    with tempfile.TemporaryDirectory() as directory:
+        messages.blob_store = BlobStore(directory)
+        messages.CLAIM_CHECK_BYTES = 100
+        try:
+            body = encode_change('people', 'sheet', CHANGE_SET, 10.0, sheet_delta())
+            assert len(body) < 400 and b'"delta_ref"' in body
+            change = decode_change(body)
+            assert change['delta'] == sheet_delta()
+
+            messages.blob_store.delete(change['delta_ref'])
+            assert 'delta' not in decode_change(body), "a missing blob means no delta, not an error"
+        finally:
+            messages.CLAIM_CHECK_BYTES = 256 * 1024
+    print("Large delta uses claim check: ok")
+
+
+def test_repeated_key_drops_delta():
+    delta_rows = DeltaRows(['id', 'name'])
+    delta_rows.add(1, [1, 'Ann'])
+    delta_rows.add(1, [1, 'Ann again'])
+    assert delta_rows.delta([]) is None
+    print("Repeated key drops delta: ok")
+
+
+def test_sheet_rows_stamped_with_read_time():
+    delta_rows = DeltaRows(['name', '_row_id'])
+    delta_rows.add('a' * 32, ['Ann', 'a' * 32])
+    delta_rows.add('b' * 32, ['Bob', 'b' * 32])
+    delta_rows.stamp(42.0)
+    assert delta_rows.delta([])['times'] == [42.0, 42.0]
+    print("Sheet rows stamped with read time: ok")
+
+
+def test_contiguous_deltas_merge():
+    first = {'source': 'db', 'version': 5, 'delta': {
+        'headers': ['id', 'name'], 'rows': [[1, [1, 'Ann']], [2, [2, 'Bob']]], 'deleted': [3], 'times': [1.0, 2.0],
+    }}
+    second = {'source': 'db', 'base_version': 5, 'version': 7, 'delta': {
+        'headers': ['id', 'name'], 'rows': [[1, [1, 'Ann B']], [3, [3, 'Cid']]], 'deleted': [2], 'times': [3.0, 4.0],
+    }}
+    merged = merge_deltas(first, second)
+    assert merged['rows'] == [[1, [1, 'Ann B']], [3, [3, 'Cid']]]
+    assert merged['times'] == [3.0, 4.0] and merged['deleted'] == [2]
+
+    assert merge_deltas(first, {**second, 'base_version': 6}) is None, "a gap between versions drops the delta"
+    assert merge_deltas(first, {**second, 'source': 'sheet'}) is None
+    print("Contiguous deltas merge: ok")
+
+
+if __name__ == "__main__":
+    test_envelope_round_trip()
+    test_legacy_messages_still_decode()
+    test_msgpack_envelopes_of_any_size_decode()
+    test_large_delta_uses_claim_check()
+    test_repeated_key_drops_delta()
+    test_sheet_rows_stamped_with_read_time()
+    test_contiguous_deltas_merge()
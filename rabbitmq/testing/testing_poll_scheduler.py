@@ -0,0 +1,100 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from poll_scheduler import PollScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def scheduler_with(clock, **kwargs):
+    options = {'initial': 20, 'minimum': 5, 'maximum': 160, 'backoff': 2, 'budget_per_minute': 60, 'half_life': 3600}
+    options.update(kwargs)
+    return PollScheduler(clock=clock, **options)
+
+
+def test_quiet_tables_back_off():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock)
+    scheduler.track(['hot', 'cold'])
+    assert set(scheduler.due()) == {'hot', 'cold'}, "new tables are due at once"
+
+    intervals = []
+    for _ in range(5):
+        scheduler.record('cold', False)
+        intervals.append(scheduler.effective_interval('cold'))
+    assert intervals == [40, 80, 160, 160, 160], intervals
+
+    scheduler.record('hot', True)
+    assert scheduler.effective_interval('hot') == 5
+    clock.now += 5
+    assert scheduler.due() == ['hot']
+    print("Quiet tables back off, changed ones speed up: ok")
+
+
+def test_cadence_from_poll_start():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock)
+    scheduler.track(['people'])
+    started = clock.now
+    clock.now += 3  # the poll itself took 3s
+    scheduler.record('people', False, started)
+    assert scheduler.seconds_until_next() == 37
+    print("Due times count from poll start: ok")
+
+
+def test_budget_stretches_intervals():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock, budget_per_minute=12)
+    tables = [f"t{i}" for i in range(4)]
+    scheduler.track(tables)
+    for table in tables:
+        scheduler.record(table, True)
+    # Four tables every 5s would be 48 polls a minute against a budget of 12
+    assert scheduler.effective_interval('t0') == 20
+    print("Budget stretches every interval: ok")
+
+
+def test_bump_and_restore():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock)
+    scheduler.track(['orders'])
+    for _ in range(3):
+        scheduler.record('orders', False)
+    assert scheduler.due() == []
+    scheduler.bump('orders')
+    assert scheduler.due() == ['orders'] and scheduler.effective_interval('orders') == 5
+
+    scheduler.record('orders', False)
+    restored = scheduler_with(FakeClock())
+    restored.restore(scheduler.dump())
+    assert restored.effective_interval('orders') == 10
+    assert 'orders' in restored.describe()
+    print("Bumps and restored intervals: ok")
+
+
+def test_heat_lowers_the_ceiling():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock)
+    scheduler.track(['busy'])
+    for _ in range(3):
+        scheduler.record('busy', True)
+    for _ in range(6):
+        scheduler.record('busy', False)
+    # Three recent changes cap quiet backoff at 160 / (1 + 3)
+    assert scheduler.effective_interval('busy') == 40
+    print("Recent changes lower the backoff ceiling: ok")
+
+
+if __name__ == "__main__":
+    test_quiet_tables_back_off()
+    test_cadence_from_poll_start()
+    test_budget_stretches_intervals()
+    test_bump_and_restore()
+    test_heat_lowers_the_ceiling()
@@ -0,0 +1,126 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from row_identity import ROW_ID_COLUMN, SheetRowKeys, delete_legacy_copies, fingerprint_row, is_row_id, sheet_identity_key
+
+
+# Records the writes SheetRowKeys makes instead of calling the Sheets API
+class FakeSheet:
+    def __init__(self, title, col_count, values=()):
+        self.id = title
+        self.title = title
+        self.col_count = col_count
+        self.values = [list(row) for row in values]
+        self.calls = []
+
+    def get_values(self, a1_range):
+        first, last = (int(row) for row in a1_range.split(':'))
+        return self.values[first - 1:last]
+
+    def add_cols(self, count):
+        self.calls.append(('add_cols', count))
+        self.col_count += count
+
+    def batch_update(self, updates):
+        self.calls.append(('batch_update', updates))
+
+    def unhide_columns(self, start, end):
+        self.calls.append(('unhide_columns', start, end))
+
+    def hide_columns(self, start, end):
+        self.calls.append(('hide_columns', start, end))
+
+
+def test_first_sync_assigns_ids():
+    values = [['name', 'city'], ['Ann', 'Oslo'], [], ['Bob', 'Rome'], ['Cid', 'Lima']]
+    sheet = FakeSheet('people', 2, values)
+    keys = SheetRowKeys(sheet, values[0])
+    rows = list(keys.rows(values[1:]))
+
+    assert keys.write_headers == ['name', 'city', ROW_ID_COLUMN]
+    assert len(rows) == 3, "the blank row should be skipped"
+    assert all(is_row_id(row[2]) for row in rows)
+
+    keys.write_back()
+    updates = sheet.calls[1][1]
+    # One range per run of consecutive rows; the header cell joins the first (row 3 is blank)
+    assert [update['range'] for update in updates] == ['C1:C2', 'C4:C5']
+    assert ('hide_columns', 2, 3) in sheet.calls
+    print("First sync assigns ids: ok")
+
+
+def test_resync_keeps_ids():
+    existing = 'a' * 32
+    values = [['id', 'name', ROW_ID_COLUMN], ['7', 'Ann', existing], ['7', 'Ann copy', existing], ['', 'New', 'typed by hand']]
+    sheet = FakeSheet('people', 4, values)
+    keys = SheetRowKeys(sheet, values[0])
+    rows = list(keys.rows(values[1:]))
+
+    assert keys.write_headers == ['name', ROW_ID_COLUMN], "the DB id column is never written"
+    assert rows[0] == ['Ann', existing]
+    assert rows[1][1] != existing, "a copy-pasted row gets its own id"
+    assert is_row_id(rows[2][1])
+    assert len(keys.new_ids) == 2 and existing in keys.keys
+
+    assert keys.write_back() == 2
+    assert not any(call[0] == 'hide_columns' for call in sheet.calls), "column already existed"
+    print("Re-sync keeps ids: ok")
+
+
+def test_ids_not_written_to_moved_rows():
+    values = [['name', ROW_ID_COLUMN], ['Ann', ''], ['Bob', '']]
+    sheet = FakeSheet('people', 2, values)
+    keys = SheetRowKeys(sheet, values[0])
+    list(keys.rows(values[1:]))
+
+    # Someone inserts a row above Bob before the ids are written back
+    sheet.values.insert(2, ['Eve', ''])
+    assert keys.write_back() == 1
+    updates = sheet.calls[-1][1]
+    assert [update['range'] for update in updates] == ['B2:B2'], "only Ann's row still holds what was read"
+    print("Ids not written to moved rows: ok")
+
+
+# Answers fetchone/fetchall from a queue and records every statement
+class FakeCursor:
+    def __init__(self, results):
+        self.results = list(results)
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+def test_legacy_copies_only_once():
+    fingerprints = {fingerprint_row(['Ann'])}
+    cursor = FakeCursor([None])
+    assert delete_legacy_copies(cursor, 'people', ['name'], fingerprints) == 0
+    assert not any(statement.startswith('DELETE FROM `people`') for statement in cursor.statements), "no marker, app rows stay"
+
+    cursor = FakeCursor([(1,), [(4, 'Ann'), (5, 'Bob')]])
+    assert delete_legacy_copies(cursor, 'people', ['name'], fingerprints) == 1
+    assert cursor.statements[1].startswith('DELETE FROM _sync_legacy_copies'), "marker is cleared first"
+    print("Legacy copies only once: ok")
+
+
+def test_producer_keys():
+    key = sheet_identity_key('people')
+    assert key(0, ['name', ROW_ID_COLUMN]) == 1
+    assert key(1, ['Ann', 'b' * 32]) == 'b' * 32
+    assert key(2, ['Bob']) == 3, "rows without an id fall back to their row number"
+    print("Producer row keys: ok")
+
+
+if __name__ == "__main__":
+    test_first_sync_assigns_ids()
+    test_resync_keeps_ids()
+    test_ids_not_written_to_moved_rows()
+    test_legacy_copies_only_once()
+    test_producer_keys()
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+
+import mysql.connector
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import schema
+from schema import create_or_update_table, schema_catalog
+from type_inference import LOOKUP_KEYS, ColumnTypes, ensure_lookup_indexes
+
+
+class FakeCursor:
+    def __init__(self, results=()):
+        self.results = list(results)
+        self.statements = []
+        self.warning_count = 0
+
+    def execute(self, sql, params=()):
+        self.statements.append(sql)
+
+    def fetchall(self):
+        return self.results.pop(0) if self.results else []
+
+    def fetchone(self):
+        return None
+
+    def nextset(self):
+        return None
+
+
+def test_schema_race_reloads_catalog_and_retries():
+    attempts = []
+
+    def update_table_schema(cursor, sheet_name, headers, types):
+        attempts.append(schema_catalog.tables)
+        if len(attempts) == 1:
+            raise mysql.connector.errors.ProgrammingError(msg="Duplicate column name 'qty'", errno=1060)
+
+    original = schema.update_table_schema
+    schema.update_table_schema = update_table_schema
+    try:
+        schema_catalog.tables, schema_catalog.loaded_at = {'people': [('id', 'int')]}, time.monotonic()
+        create_or_update_table(FakeCursor(), 'people', ['name', 'qty'])
+        assert len(attempts) == 2 and attempts[1] is None, "the retry runs against a reloaded catalog"
+
+        def unknown_column(cursor, sheet_name, headers, types):
+            raise mysql.connector.errors.ProgrammingError(msg="Unknown column 'qty'", errno=1054)
+
+        schema.update_table_schema = unknown_column
+        try:
+            create_or_update_table(FakeCursor(), 'people', ['name'])
+        except mysql.connector.Error:
+            pass
+        else:
+            raise AssertionError("other errors must not be retried")
+    finally:
+        schema.update_table_schema = original
+    print("Schema race reloads catalog and retries: ok")
+
+
+def test_ddl_quotes_identifiers():
+    schema_catalog.tables, schema_catalog.loaded_at = {}, time.monotonic()
+    cursor = FakeCursor()
+    create_or_update_table(cursor, 'stock list', ['unit price', 'a`b'], [['1', 'x']])
+    create = next(sql for sql in cursor.statements if 'CREATE TABLE IF NOT EXISTS `stock list`' in sql)
+    assert '`unit price` ' in create and '`a``b` ' in create
+
+    schema_catalog.tables = {'stock list': [('id', 'int'), ('unit price', 'int'), ('row_version', 'bigint'), ('updated_at', 'timestamp')]}
+    schema_catalog.loaded_at = time.monotonic()
+    cursor = FakeCursor()
+    create_or_update_table(cursor, 'stock list', ['unit price', 'in stock'], [['1', 'yes']])
+    assert cursor.statements[0] == "ALTER TABLE `stock list` ADD COLUMN `in stock` VARCHAR(255)"
+    print("DDL quotes identifiers: ok")
+
+
+def test_lookup_index_follows_column_to_text():
+    LOOKUP_KEYS['people'] = ['email']
+    try:
+        cursor = FakeCursor([[('idx_lookup_email', 'email')]])
+        ColumnTypes('people', {'email': ('varchar',)}).widen_for(cursor, ['email'], [['x' * 300]])
+        assert cursor.statements[-1] == (
+            "ALTER TABLE `people` MODIFY COLUMN `email` TEXT, "
+            "DROP INDEX `idx_lookup_email`, ADD INDEX `idx_lookup_email` (`email`(191))"
+        )
+
+        # A column already widened to TEXT gets the prefix, whatever the sample says
+        cursor = FakeCursor([[], [('email', 'text')]])
+        assert ensure_lookup_indexes(cursor, 'people', ['email'])
+        assert cursor.statements[-1] == "ALTER TABLE `people` ADD INDEX `idx_lookup_email` (`email`(191))"
+    finally:
+        del LOOKUP_KEYS['people']
+    print("Lookup index follows column to TEXT: ok")
+
+
+if __name__ == "__main__":
+    test_schema_race_reloads_catalog_and_retries()
+    test_ddl_quotes_identifiers()
+    test_lookup_index_follows_column_to_text()
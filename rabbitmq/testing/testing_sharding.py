@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sharding import (
+    ATTEMPTS_HEADER, SYNC_EXCHANGE, SYNC_RETRY_EXCHANGE, declare_topology, parked_queue, retry_route, routing_key_for,
+    shard_queue
+)
+
+
+# Records the topology and routes a publish the way RabbitMQ would (direct
+# exchanges, dead-lettering with the original routing key)
+class FakeBroker:
+    def __init__(self):
+        self.bindings = {}  # (exchange, routing key) -> queue
+        self.queue_arguments = {}
+
+    def exchange_declare(self, exchange, exchange_type, durable):
+        pass
+
+    def queue_declare(self, queue, durable, arguments=None):
+        self.queue_arguments[queue] = arguments or {}
+
+    def queue_bind(self, queue, exchange, routing_key):
+        self.bindings[(exchange, routing_key)] = queue
+
+    def route(self, exchange, routing_key):
+        return routing_key if exchange == '' else self.bindings[(exchange, routing_key)]
+
+    # Where a message sitting in `queue` goes once its TTL runs out
+    def expire(self, queue, routing_key):
+        return self.route(self.queue_arguments[queue]['x-dead-letter-exchange'], routing_key)
+
+
+def test_twice_failed_message_is_not_lost():
+    broker = FakeBroker()
+    declare_topology(broker, 'conflict_queue', shard_count=4)
+    home = shard_queue('conflict_queue', int(routing_key_for('orders', 4)))
+
+    headers = None
+    for attempt in (1, 2):
+        exchange, routing_key, headers = retry_route('conflict_queue', 'orders', headers)
+        routing_key = routing_key_for('orders', 4)  # the consumer's shard count in this test
+        assert exchange == SYNC_RETRY_EXCHANGE and headers[ATTEMPTS_HEADER] == attempt
+        retry = broker.route(exchange, routing_key)
+        assert broker.queue_arguments[retry]['x-message-ttl'] > 0
+        assert broker.expire(retry, routing_key) == home, "after the delay it is back on its shard queue"
+    assert broker.bindings[(SYNC_EXCHANGE, routing_key)] == home
+    print("Twice-failed message is not lost: ok")
+
+
+def test_exhausted_and_unparseable_messages_are_parked():
+    exchange, routing_key, headers = retry_route('conflict_queue', 'orders', {ATTEMPTS_HEADER: 2}, max_attempts=3)
+    assert (exchange, routing_key, headers[ATTEMPTS_HEADER]) == ('', parked_queue('conflict_queue'), 3)
+    assert retry_route('conflict_queue', None, None)[:2] == ('', parked_queue('conflict_queue'))
+    print("Exhausted and unparseable messages are parked: ok")
+
+
+if __name__ == "__main__":
+    test_twice_failed_message_is_not_lost()
+    test_exhausted_and_unparseable_messages_are_parked()
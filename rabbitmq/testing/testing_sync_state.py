@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from row_index import RowIndex, db_row_key, has_changes, sheet_row_key
+from sync_state import SQLiteStateStore
+
+ROWS = [['id', 'name'], [1, 'Ann'], [2, 'Bob'], [3, 'Cid']]
+
+
+# Simulates one producer run: diff the same data, save, and "restart" on the same file
+def test_warm_restart_sees_no_changes(path):
+    store = SQLiteStateStore(path)
+    index = RowIndex(store, 'db')
+    first = index.diff('people', ROWS, sheet_row_key)
+    assert len(first['inserted']) == 4
+    store.save(index.take_dirty(), {'watermarks': {'people': 7}, 'drive_version': '123'})
+    store.close()
+
+    store = SQLiteStateStore(path)
+    index = RowIndex(store, 'db')
+    assert not has_changes(index.diff('people', ROWS, sheet_row_key))
+    assert store.get('watermarks') == {'people': 7} and store.get('drive_version') == '123'
+    assert store.get('missing', 'default') == 'default'
+
+    changed = index.diff('people', [ROWS[0], ROWS[1], [2, 'Bobby']], sheet_row_key)
+    assert changed == {'inserted': [], 'updated': [3], 'deleted': [4]}
+    store.save(index.take_dirty(), {})
+    store.close()
+
+    store = SQLiteStateStore(path)
+    assert set(store.load_fingerprints('db', 'people')) == {1, 2, 3}, "keys keep their int type"
+    store.close()
+    print("Warm restart sees no changes: ok")
+
+
+def test_apply_is_persisted(path):
+    store = SQLiteStateStore(path)
+    index = RowIndex(store, 'db')
+    index.apply('orders', [['a' * 32, 'x'], ['b' * 32, 'y']], [], db_row_key)
+    store.save(index.take_dirty(), {})
+    assert index.take_dirty() == [], "dirty keys are handed out once"
+
+    index = RowIndex(store, 'db')
+    change_set = index.apply('orders', [['a' * 32, 'x']], ['b' * 32], db_row_key)
+    assert change_set == {'inserted': [], 'updated': [], 'deleted': ['b' * 32]}
+    store.close()
+    print("Incremental applies are persisted: ok")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        test_warm_restart_sees_no_changes(os.path.join(directory, 'state.db'))
+        test_apply_is_persisted(os.path.join(directory, 'apply.db'))
@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from messages import decode_change
+from schema import schema_catalog
+from table_edits import apply_edits, grid_edits
+
+ANN_ID, BOB_ID, CID_ID = 'a' * 32, 'b' * 32, 'c' * 32
+
+
+class FakeCursor:
+    def __init__(self, results):
+        self.results = list(results)
+        self.statements = []
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, list(params)))
+        if sql.startswith('INSERT'):
+            self.lastrowid = 7
+
+    def executemany(self, sql, params):
+        self.statements.append((sql, [list(row) for row in params]))
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.fake_cursor = cursor
+        self.commits = 0
+
+    def cursor(self):
+        return self.fake_cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def test_batch_is_one_transaction_and_one_message():
+    schema_catalog.tables = {'people': [
+        ('id', 'int'), ('name', 'varchar(255)'), ('_row_id', 'char(32)'), ('row_version', 'bigint'), ('updated_at', 'timestamp'),
+    ]}
+    schema_catalog.loaded_at = time.monotonic()
+    cursor = FakeCursor([
+        [(3, 'Bob', BOB_ID, 100.0)],  # the row about to be deleted
+        [(1, 'Ann B', ANN_ID, 101.0), (7, 'Cid', CID_ID, 102.0)],  # the rows as written
+    ])
+    connection = FakeConnection(cursor)
+
+    message = apply_edits(
+        connection, 'people', 'id',
+        inserts=[{'name': 'Cid', 'id': None}], updates=[(1, {'name': 'Ann B'})], deletes=[3]
+    )
+    assert connection.commits == 1
+    kinds = [sql.split()[0] for sql, _ in cursor.statements]
+    assert kinds == ['SELECT', 'DELETE', 'UPDATE', 'INSERT', 'SELECT']
+    insert_sql, insert_params = cursor.statements[3]
+    assert '`id`' not in insert_sql and insert_params[0] == 'Cid' and len(insert_params[1]) == 32, "a new row gets a _row_id"
+
+    change = decode_change(message)
+    assert change['source'] == 'db' and change['table'] == 'people'
+    assert change['inserted'] == [CID_ID] and change['updated'] == [ANN_ID] and change['deleted'] == [BOB_ID]
+    assert change['delta']['headers'] == ['id', 'name', '_row_id']
+    assert change['delta']['rows'] == [[ANN_ID, [1, 'Ann B', ANN_ID]], [CID_ID, [7, 'Cid', CID_ID]]]
+    assert change['delta']['times'] == [101.0, 102.0]
+    assert apply_edits(connection, 'people', 'id') is None, "an empty batch writes and publishes nothing"
+    print("Batch is one transaction and one message: ok")
+
+
+def test_empty_fields_in_typed_columns_are_null():
+    schema_catalog.tables = {'stock': [
+        ('id', 'int'), ('name', 'varchar(255)'), ('qty', 'int'), ('price', 'decimal(10,2)'), ('added', 'date'),
+        ('_row_id', 'char(32)'), ('row_version', 'bigint'), ('updated_at', 'timestamp'),
+    ]}
+    schema_catalog.loaded_at = time.monotonic()
+    cursor = FakeCursor([[], [(4, '', None, None, None, ANN_ID, 100.0)]])
+    apply_edits(FakeConnection(cursor), 'stock', 'id', updates=[(4, {'name': '', 'qty': '', 'price': '1,234.50', 'added': ''})])
+    update_sql, update_params = next(statement for statement in cursor.statements if statement[0].startswith('UPDATE'))
+    assert update_params == [['', None, '1234.50', None, 4]], "text stays '', typed columns get NULL or MySQL's form"
+    print("Empty fields in typed columns are NULL: ok")
+
+
+def test_grid_edits_by_position():
+    state = {
+        'edited_rows': {0: {'name': 'Ann B', 'id': 99}, 1: {'name': 'gone anyway'}},
+        'added_rows': [{'name': 'Cid'}, {}],
+        'deleted_rows': [1],
+    }
+    inserts, updates, deletes = grid_edits([1, 3], state, 'id')
+    assert inserts == [{'name': 'Cid'}]
+    assert updates == [(1, {'name': 'Ann B'})], "the key is not editable and deleted rows aren't updated"
+    assert deletes == [3]
+    print("Grid edits by position: ok")
+
+
+if __name__ == "__main__":
+    test_batch_is_one_transaction_and_one_message()
+    test_empty_fields_in_typed_columns_are_null()
+    test_grid_edits_by_position()
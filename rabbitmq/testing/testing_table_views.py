@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from table_views import page_cursor, page_query
+
+COLUMNS = ['id', 'name', 'city']
+
+
+def test_first_page():
+    sql, params = page_query('people', COLUMNS, 'id', 'id', False, (), None, page_size=50)
+    assert sql == "SELECT `id`, `name`, `city` FROM `people` ORDER BY `id` ASC LIMIT %s"
+    assert params == [51], "one extra row tells whether there is a next page"
+    print("First page: ok")
+
+
+def test_next_page_by_key():
+    sql, params = page_query('people', COLUMNS, 'id', 'id', True, (), (90, 90), page_size=50)
+    assert "WHERE `id` < %s ORDER BY `id` DESC" in sql and params == [90, 51]
+    print("Next page by key: ok")
+
+
+def test_next_page_by_other_column():
+    after = page_cursor([42, 'Ann', 'Oslo'], COLUMNS, 'id', 'city')
+    assert after == ('Oslo', 42)
+    sql, params = page_query('people', COLUMNS, 'id', 'city', False, (('name', 'contains', '50%_'),), after, 10)
+    assert "`name` LIKE %s" in sql
+    assert "(`city` > %s OR (`city` = %s AND `id` > %s) OR `city` IS NULL)" in sql
+    assert sql.endswith("ORDER BY `city` IS NULL, `city` ASC, `id` ASC LIMIT %s")
+    assert params == ['%50\\%\\_%', 'Oslo', 'Oslo', 42, 11]
+
+    # Past the last non-NULL city only the NULL tail is left
+    sql, params = page_query('people', COLUMNS, 'id', 'city', False, (), (None, 7), 10)
+    assert "(`city` IS NULL AND `id` > %s)" in sql and params == [7, 11]
+    print("Next page by another column: ok")
+
+
+def test_empty_filter_takes_no_value():
+    sql, params = page_query('people', COLUMNS, 'id', 'id', False, (('city', 'is empty', 'ignored'),), None, 10)
+    assert "(`city` IS NULL OR `city` = '')" in sql and params == [11]
+    print("Empty filter: ok")
+
+
+if __name__ == "__main__":
+    test_first_page()
+    test_next_page_by_key()
+    test_next_page_by_other_column()
+    test_empty_filter_takes_no_value()
@@ -0,0 +1,80 @@
+import os
+import sys
+import urllib.request
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from telemetry import Registry, stage, stage_seconds, start_metrics_server
+
+
+def test_counter_and_gauge_rendering():
+    registry = Registry()
+    calls = registry.counter('api_calls_total', "API calls", ('kind',))
+    depth = registry.gauge('queue_depth', "Queue depth", ('queue',))
+    calls.inc(kind='read')
+    calls.inc(2, kind='read')
+    calls.inc(kind='write')
+    depth.set(5, queue='sync_queue_0')
+    depth.set(3, queue='sync_queue_0')
+
+    text = registry.render()
+    assert '# TYPE api_calls_total counter' in text
+    assert 'api_calls_total{kind="read"} 3' in text
+    assert 'api_calls_total{kind="write"} 1' in text
+    assert 'queue_depth{queue="sync_queue_0"} 3' in text
+    print("Counter and gauge rendering: ok")
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', "Latency", ('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        latency.observe(value, stage='read')
+
+    text = registry.render()
+    assert 'latency_seconds_bucket{stage="read",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{stage="read",le="1"} 3' in text
+    assert 'latency_seconds_bucket{stage="read",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{stage="read"} 4' in text
+    assert 'latency_seconds_sum{stage="read"} 6.05' in text
+    print("Histogram buckets are cumulative: ok")
+
+
+def test_callback_gauge_failure_is_skipped():
+    registry = Registry()
+    registry.callback_gauge('pool_in_use', "Pool", (), lambda: {(): 2})
+    registry.callback_gauge('broken', "Broken", (), lambda: 1 / 0)
+
+    text = registry.render()
+    assert 'pool_in_use 2' in text
+    assert '# TYPE broken gauge' in text
+    print("Callback gauge failure is skipped: ok")
+
+
+def test_stage_is_timed_even_on_error():
+    try:
+        with stage('test', 'failing'):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    counts = [value for name, key, value in stage_seconds.samples() if name.endswith('_count') and key == ('test', 'failing')]
+    assert counts == [1]
+    print("Stage is timed even on error: ok")
+
+
+def test_metrics_endpoint():
+    server = start_metrics_server(19109)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+            body = response.read().decode()
+        assert '# TYPE sync_stage_seconds histogram' in body
+    finally:
+        server.shutdown()
+    print("Metrics endpoint: ok")
+
+
+if __name__ == "__main__":
+    test_counter_and_gauge_rendering()
+    test_histogram_buckets_are_cumulative()
+    test_callback_gauge_failure_is_skipped()
+    test_stage_is_timed_even_on_error()
+    test_metrics_endpoint()
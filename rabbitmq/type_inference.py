@@ -0,0 +1,310 @@
+import logging
+import os
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from bulk_writer import quote_identifier
+
+# Rows looked at when choosing column types for a new table or column
+TYPE_SAMPLE_ROWS = int(os.getenv('TYPE_SAMPLE_ROWS', '1000'))
+
+
+# Parse a per-table column list like "orders:email,sku;customers:phone"
+def parse_table_columns(spec):
+    tables = {}
+    for table_spec in filter(None, spec.split(';')):
+        table, _, columns = table_spec.partition(':')
+        tables[table.strip()] = [column.strip() for column in columns.split(',') if column.strip()]
+    return tables
+
+
+# Columns users look rows up by; each gets a secondary index, over the first
+# 191 characters once the column is TEXT
+LOOKUP_KEYS = parse_table_columns(os.getenv('LOOKUP_KEYS', ''))
+LOOKUP_PREFIX = '(191)'
+
+INT_RANGE = (-2 ** 31, 2 ** 31 - 1)
+BIGINT_RANGE = (-2 ** 63, 2 ** 63 - 1)
+MAX_DECIMAL_PRECISION = 65
+MAX_DECIMAL_SCALE = 30
+VARCHAR_LENGTH = 255
+
+# No leading zeros, so zip codes and IDs like "007" stay text
+INTEGER_PATTERN = re.compile(r'^-?(0|[1-9]\d*)$')
+DECIMAL_PATTERN = re.compile(r'^-?(0|[1-9]\d*)\.(\d+)$')
+GROUPED_NUMBER_PATTERN = re.compile(r'^-?[1-9]\d{0,2}(,\d{3})+(\.\d+)?$')
+BOOLEAN_VALUES = {'TRUE': 1, 'FALSE': 0}
+
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y')
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%m/%d/%Y %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
+# Inferred types are tuples: ('int',), ('bigint',), ('decimal', integer digits,
+# scale), ('date',), ('datetime',), ('boolean',), ('varchar',), ('text',) or
+# None when every sampled value was empty.
+
+
+def parse_datetime(value, formats):
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+# Most specific type that can hold a single non-empty sheet value
+def classify_value(value):
+    value = value.strip()
+    if value.upper() in BOOLEAN_VALUES:
+        return ('boolean',)
+
+    number = value.replace(',', '') if GROUPED_NUMBER_PATTERN.match(value) else value
+    if INTEGER_PATTERN.match(number):
+        integer = int(number)
+        if INT_RANGE[0] <= integer <= INT_RANGE[1]:
+            return ('int',)
+        if BIGINT_RANGE[0] <= integer <= BIGINT_RANGE[1]:
+            return ('bigint',)
+        digits = len(number.lstrip('-'))
+        return ('decimal', digits, 0) if digits <= MAX_DECIMAL_PRECISION else ('varchar',)
+
+    match = DECIMAL_PATTERN.match(number)
+    if match:
+        digits, scale = len(match.group(1)), len(match.group(2))
+        if digits + scale <= MAX_DECIMAL_PRECISION and scale <= MAX_DECIMAL_SCALE:
+            return ('decimal', digits, scale)
+
+    if parse_datetime(value, DATE_FORMATS):
+        return ('date',)
+    if parse_datetime(value, DATETIME_FORMATS):
+        return ('datetime',)
+
+    return ('varchar',) if len(value) <= VARCHAR_LENGTH else ('text',)
+
+
+NUMERIC_RANK = {'int': 0, 'bigint': 1, 'decimal': 2}
+
+
+# Narrowest type that holds values of both types. Anything that can't be
+# reconciled falls back to text.
+def widen(current, incoming):
+    if current is None or current == incoming:
+        return incoming
+    if incoming is None:
+        return current
+
+    kinds = {current[0], incoming[0]}
+    if kinds <= set(NUMERIC_RANK):
+        if 'decimal' not in kinds:
+            return max(current, incoming, key=lambda inferred: NUMERIC_RANK[inferred[0]])
+        digits = max(decimal_digits(current), decimal_digits(incoming))
+        scale = max(decimal_scale(current), decimal_scale(incoming))
+        if digits + scale > MAX_DECIMAL_PRECISION or scale > MAX_DECIMAL_SCALE:
+            return ('varchar',)
+        return ('decimal', digits, scale)
+    if kinds == {'date', 'datetime'}:
+        return ('datetime',)
+    if 'text' in kinds:
+        return ('text',)
+    return ('varchar',)
+
+
+def decimal_digits(inferred):
+    if inferred[0] == 'decimal':
+        return inferred[1]
+    return 10 if inferred[0] == 'int' else 19
+
+
+def decimal_scale(inferred):
+    return inferred[2] if inferred[0] == 'decimal' else 0
+
+
+def infer_column_types(headers, sample_rows):
+    types = [None] * len(headers)
+    for row in sample_rows:
+        for index, value in enumerate(row[:len(headers)]):
+            if value is not None and str(value).strip() != '':
+                types[index] = widen(types[index], classify_value(str(value)))
+    return dict(zip(headers, types))
+
+
+def sql_type(inferred):
+    if inferred is None or inferred[0] == 'varchar':
+        return f'VARCHAR({VARCHAR_LENGTH})'
+    if inferred[0] == 'decimal':
+        return f'DECIMAL({inferred[1] + inferred[2]},{inferred[2]})'
+    return {
+        'int': 'INT',
+        'bigint': 'BIGINT',
+        'date': 'DATE',
+        'datetime': 'DATETIME',
+        'boolean': 'BOOLEAN',
+        'text': 'TEXT',
+    }[inferred[0]]
+
+
+# Read a MySQL column_type (from information_schema) back into an inferred type
+def parse_sql_type(column_type):
+    column_type = column_type.lower()
+    if column_type.startswith('tinyint(1)'):
+        return ('boolean',)
+    if column_type.startswith('int'):
+        return ('int',)
+    if column_type.startswith('bigint'):
+        return ('bigint',)
+    match = re.match(r'decimal\((\d+),(\d+)\)', column_type)
+    if match:
+        precision, scale = int(match.group(1)), int(match.group(2))
+        return ('decimal', precision - scale, scale)
+    if column_type == 'date':
+        return ('date',)
+    if column_type.startswith('datetime'):
+        return ('datetime',)
+    if column_type.endswith('text'):
+        return ('text',)
+    return ('varchar',)
+
+
+# Sheet value -> value MySQL accepts for the column. Empty cells become NULL
+# except in string columns, where they stay ''.
+def convert_value(value, inferred):
+    if inferred is None or inferred[0] in ('varchar', 'text'):
+        return value
+    if value is None or str(value).strip() == '':
+        return None
+
+    value = str(value).strip()
+    if inferred[0] == 'boolean':
+        return BOOLEAN_VALUES.get(value.upper(), value)
+    if inferred[0] in NUMERIC_RANK:
+        return value.replace(',', '') if GROUPED_NUMBER_PATTERN.match(value) else value
+    if inferred[0] == 'date':
+        parsed = parse_datetime(value, DATE_FORMATS)
+        return parsed.strftime('%Y-%m-%d') if parsed else value
+    if inferred[0] == 'datetime':
+        parsed = parse_datetime(value, DATETIME_FORMATS) or parse_datetime(value, DATE_FORMATS)
+        return parsed.strftime('%Y-%m-%d %H:%M:%S') if parsed else value
+    return value
+
+
+# One text form per value, whichever side it came from, so a sheet cell and the
+# MySQL value it was stored as compare equal ("1,234.50" and Decimal('1234.5'),
+# "TRUE" and 1, "3/4/2024" and date(2024, 3, 4)). The result is still valid
+# input for convert_value.
+def canonical_value(value, inferred):
+    if value is None:
+        return ''
+    if inferred is None or inferred[0] in ('varchar', 'text'):
+        return str(value)
+
+    text = str(value).strip()
+    if text == '':
+        return ''
+    if inferred[0] == 'boolean':
+        if text in ('0', '1'):
+            return 'TRUE' if text == '1' else 'FALSE'
+        return text.upper() if text.upper() in BOOLEAN_VALUES else text
+    if inferred[0] in NUMERIC_RANK:
+        try:
+            return format(Decimal(convert_value(text, inferred)).normalize(), 'f')
+        except InvalidOperation:
+            return text
+    return convert_value(text, inferred)
+
+
+# Column types for one table while rows are written. Before each chunk goes
+# out, any value that doesn't fit its column widens that column with
+# ALTER TABLE ... MODIFY, so a late "n/a" in a numeric column doesn't fail the sync.
+class ColumnTypes:
+    def __init__(self, table, types, on_schema_change=None):
+        self.table = table
+        # Columns with no sampled values were created as VARCHAR
+        self.types = {header: inferred or ('varchar',) for header, inferred in types.items()}
+        self.on_schema_change = on_schema_change
+
+    def widen_for(self, cursor, headers, rows):
+        widened = {}
+        for row in rows:
+            for header, value in zip(headers, row):
+                current = widened.get(header, self.types.get(header))
+                if current is None or current == ('text',) or value is None or str(value).strip() == '':
+                    continue
+                needed = widen(current, classify_value(str(value)))
+                if needed != current:
+                    widened[header] = needed
+
+        if widened:
+            modifications = [
+                f'MODIFY COLUMN {quote_identifier(header)} {sql_type(inferred)}' for header, inferred in widened.items()
+            ]
+            modifications += prefix_lookup_indexes(
+                cursor, self.table, [header for header, inferred in widened.items() if inferred == ('text',)]
+            )
+            cursor.execute(f"ALTER TABLE {quote_identifier(self.table)} {', '.join(modifications)}")
+            self.types.update(widened)
+            logging.info(f"Widened columns in '{self.table}': {', '.join(f'{h} -> {sql_type(t)}' for h, t in widened.items())}")
+            if self.on_schema_change:
+                self.on_schema_change()
+
+    def convert_rows(self, cursor, headers, rows):
+        self.widen_for(cursor, headers, rows)
+        column_types = [self.types.get(header) for header in headers]
+        return [[convert_value(value, inferred) for value, inferred in zip(row, column_types)] for row in rows]
+
+
+def lookup_index_name(column):
+    return f'idx_lookup_{column}'[:64]
+
+
+# TEXT columns are only indexable on a prefix (MySQL error 1170 otherwise)
+def lookup_index_clause(column, is_text):
+    return f"ADD INDEX {quote_identifier(lookup_index_name(column))} ({quote_identifier(column)}{LOOKUP_PREFIX if is_text else ''})"
+
+
+# Clauses that rebuild the lookup indexes over `columns` with a prefix, to go
+# in the same ALTER TABLE that turns those columns into TEXT
+def prefix_lookup_indexes(cursor, table, columns):
+    columns = [column for column in columns if column in LOOKUP_KEYS.get(table, [])]
+    if not columns:
+        return []
+    cursor.execute(
+        "SELECT index_name, column_name FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND sub_part IS NULL "
+        f"AND column_name IN ({', '.join(['%s'] * len(columns))})",
+        [table] + columns
+    )
+    clauses = []
+    for index_name, column in cursor.fetchall():
+        if index_name == lookup_index_name(column):
+            clauses += [f"DROP INDEX {quote_identifier(index_name)}", lookup_index_clause(column, True)]
+    return clauses
+
+
+# Add a secondary index for each of the table's LOOKUP_KEYS that doesn't have
+# one yet. Whether a column needs a prefix is read from the table itself, not
+# from the sampled types, which may be behind a column widened since.
+def ensure_lookup_indexes(cursor, table, columns):
+    wanted = [column for column in LOOKUP_KEYS.get(table, []) if column in columns]
+    if not wanted:
+        return False
+
+    cursor.execute(
+        "SELECT DISTINCT index_name FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s",
+        (table,)
+    )
+    existing = {row[0] for row in cursor.fetchall()}
+    cursor.execute(
+        "SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s",
+        (table,)
+    )
+    data_types = {column: data_type.lower() for column, data_type in cursor.fetchall()}
+
+    clauses = [
+        lookup_index_clause(column, data_types.get(column, '').endswith(('text', 'blob')))
+        for column in wanted if lookup_index_name(column) not in existing
+    ]
+
+    if clauses:
+        cursor.execute(f"ALTER TABLE {quote_identifier(table)} {', '.join(clauses)}")
+    return bool(clauses)